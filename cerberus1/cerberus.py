@@ -110,21 +110,13 @@ class Validator(object):
         self.document = None
         """ The document that is or was recently processed.
             Type: any :term:`mapping` """
-        self._errors = errors.ErrorList()
-        """ The list of errors that were encountered since the last document
-            processing was invoked.
-            Type: :class:`~cerberus.errors.ErrorList` """
+        self.__errors = None
         self.recent_error = None
         """ The last individual error that was submitted.
             Type: :class:`~cerberus.errors.ValidationError` """
-        self.document_error_tree = errors.DocumentErrorTree()
-        """ A tree representiation of encountered errors following the
-            structure of the document.
-            Type: :class:`~cerberus.errors.DocumentErrorTree` """
-        self.schema_error_tree = errors.SchemaErrorTree()
-        """ A tree representiation of encountered errors following the
-            structure of the schema.
-            Type: :class:`~cerberus.errors.SchemaErrorTree` """
+        self.__document_error_tree = None
+        self.__schema_error_tree = None
+        self.__child_validators = {}
         self.document_path = ()
         """ The path within the document to the current sub-document.
             Type: :class:`tuple` """
@@ -215,8 +207,12 @@ class Validator(object):
             self._errors.extend(args[0])
             self._errors.sort()
             for error in args[0]:
-                self.document_error_tree += error
-                self.schema_error_tree += error
+                # trees that were not requested yet are built from the
+                # error list when they are
+                if self.__document_error_tree is not None:
+                    self.__document_error_tree += error
+                if self.__schema_error_tree is not None:
+                    self.__schema_error_tree += error
                 self.error_handler.emit(error)
         elif len(args) == 2 and isinstance(args[1], _str_type):
             self._error(args[0], errors.CUSTOM, args[1])
@@ -254,6 +250,12 @@ class Validator(object):
             parameters of the parent are passed to the initialization, unless
             a parameter is given as an explicit *keyword*-parameter.
 
+            The instance is kept in a pool of the parent, keyed by the crumbs,
+            and handed out again with a fresh configuration on later calls
+            with the same crumbs. Validators reset their state at the start of
+            every processing, but state derived from the configuration in
+            ``__init__`` of subclasses is kept from the first call.
+
         :param document_crumb: Extends the
                                :attr:`~cerberus.Validator.document_path`
                                of the child-validator.
@@ -275,7 +277,17 @@ class Validator(object):
             child_config['root_allow_unknown'] = self.allow_unknown
             child_config['root_document'] = self.document
             child_config['root_schema'] = self.schema
-        child_validator = self.__class__(**child_config)
+
+        key = (document_crumb, schema_crumb)
+        child_validator = self.__child_validators.get(key)
+        if child_validator is None:
+            child_validator = self.__class__(**child_config)
+            self.__child_validators[key] = child_validator
+        else:
+            # like __init__, keep the error handler out of the configuration
+            child_config.pop('error_handler', None)
+            child_validator._config = child_config
+            child_validator.schema = child_config.get('schema', None)
 
         if document_crumb is None:
             child_validator.document_path = self.document_path
@@ -350,6 +362,41 @@ class Validator(object):
             DefinitionSchema(self, {'allow_unknown': value})
         self._config['allow_unknown'] = value
 
+    @property
+    def _errors(self):
+        """ The list of errors that were encountered since the last document
+            processing was invoked. It is created with the first error.
+            Type: :class:`~cerberus.errors.ErrorList` """
+        if self.__errors is None:
+            self.__errors = errors.ErrorList()
+        return self.__errors
+
+    @_errors.setter
+    def _errors(self, value):
+        self.__errors = value
+        self.__document_error_tree = None
+        self.__schema_error_tree = None
+
+    @property
+    def document_error_tree(self):
+        """ A tree representiation of encountered errors following the
+            structure of the document. It is built when it is first requested.
+            Type: :class:`~cerberus.errors.DocumentErrorTree` """
+        if self.__document_error_tree is None:
+            self.__document_error_tree = \
+                errors.DocumentErrorTree(self.__errors or ())
+        return self.__document_error_tree
+
+    @property
+    def schema_error_tree(self):
+        """ A tree representiation of encountered errors following the
+            structure of the schema. It is built when it is first requested.
+            Type: :class:`~cerberus.errors.SchemaErrorTree` """
+        if self.__schema_error_tree is None:
+            self.__schema_error_tree = \
+                errors.SchemaErrorTree(self.__errors or ())
+        return self.__schema_error_tree
+
     @property
     def errors(self):
         """ The errors of the last processing formatted by the handler that is
@@ -441,10 +488,8 @@ class Validator(object):
     # Document processing
 
     def __init_processing(self, document, schema=None):
-        self._errors = errors.ErrorList()
+        self._errors = None
         self.recent_error = None
-        self.document_error_tree = errors.DocumentErrorTree()
-        self.schema_error_tree = errors.SchemaErrorTree()
         self.document = copy(document)
 
         if schema is not None:
@@ -482,7 +527,7 @@ class Validator(object):
         self.__init_processing(document, schema)
         self.__normalize_mapping(self.document, self.schema)
         self.error_handler.end(self)
-        if self._errors and not always_return_document:
+        if self.__errors and not always_return_document:
             return None
         else:
             return self.document
@@ -562,7 +607,7 @@ class Validator(object):
             document_crumb=field, schema_crumb=(field, 'keyschema'),
             schema=schema)
         result = validator.normalized(document, always_return_document=True)
-        if validator._errors:
+        if validator.__errors:
             self._drop_nodes_from_errorpaths(validator._errors, [], [2, 4])
             self._error(validator._errors)
         for k in result:
@@ -585,7 +630,7 @@ class Validator(object):
             schema=schema)
         mapping[field] = validator.normalized(mapping[field],
                                               always_return_document=True)
-        if validator._errors:
+        if validator.__errors:
             self._drop_nodes_from_errorpaths(validator._errors, [], [2])
             self._error(validator._errors)
 
@@ -597,7 +642,7 @@ class Validator(object):
             purge_unknown=schema[field].get('purge_unknown', self.purge_unknown))  # noqa
         mapping[field] = validator.normalized(mapping[field],
                                               always_return_document=True)
-        if validator._errors:
+        if validator.__errors:
             self._error(validator._errors)
 
     def __normalize_sequence(self, field, mapping, schema):
@@ -610,7 +655,7 @@ class Validator(object):
         result = validator.normalized(document, always_return_document=True)
         for i in result:
             mapping[field][i] = result[i]
-        if validator._errors:
+        if validator.__errors:
             self._drop_nodes_from_errorpaths(validator._errors, [], [2])
             self._error(validator._errors)
 
@@ -748,7 +793,7 @@ class Validator(object):
 
         self.error_handler.end(self)
 
-        return not bool(self._errors)
+        return not self.__errors
 
     __call__ = validate
 
@@ -757,7 +802,7 @@ class Validator(object):
             validated document or :obj:`None` if validation failed. """
         always_return_document = kwargs.pop('always_return_document', False)
         self.validate(*args, **kwargs)
-        if self._errors and not always_return_document:
+        if self.__errors and not always_return_document:
             return None
         else:
             return self.document
@@ -1112,7 +1157,7 @@ class Validator(object):
             document_crumb=field, schema_crumb=(field, 'schema'),
             schema=schema, allow_unknown=self.allow_unknown)
         validator(dict(((i, v) for i, v in enumerate(value))), normalize=False)
-        if validator._errors:
+        if validator.__errors:
             self._drop_nodes_from_errorpaths(validator._errors, [], [2])
             self._error(field, errors.SEQUENCE_SCHEMA, validator._errors)
 
@@ -1198,7 +1243,7 @@ class Validator(object):
                 document_crumb=field, schema_crumb=schema_crumb,
                 schema=dict((k, schema) for k in value))
             validator(value, normalize=False)
-            if validator._errors:
+            if validator.__errors:
                 self._drop_nodes_from_errorpaths(validator._errors, [], [2])
                 self._error(field, errors.VALUESCHEMA, validator._errors)
 
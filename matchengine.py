@@ -4,32 +4,30 @@ import os
 import sys
 import json
 import time
-import yaml
 import logging
 import argparse
 import subprocess
 import pandas as pd
-import datetime as dt
 from pymongo import ASCENDING
 
 from matchengine.engine import MatchEngine
-from matchengine.utilities import get_db
+from matchengine.utilities import get_db, close_clients, materialize_oncotree, add_trials, load_trials, parse_yaml
+from matchengine.indexes import provision_indexes
+from matchengine.validation import validate_many
+from matchengine.export import export_results, export_path, EXPORT_FORMATS
+from matchengine.load import read_csv_chunks, read_parquet_chunks, read_arrow_chunks, match_columns, iter_chunks, \
+    load_clinical, load_genomic, CLINICAL_FIELDS, GENOMIC_FIELDS
 
 MONGO_URI = ""
 MONGO_DBNAME = "matchminer"
-MATCH_FIELDS = "mrn,sample_id,first_last,protocol_no,nct_id,genomic_alteration,tier,match_type," \
-               "trial_accrual_status,match_level,code,internal_id,ord_physician_name,ord_physician_email," \
-               "vital_status,oncotree_primary_diagnosis_name,true_hugo_symbol,true_protein_change," \
-               "true_variant_classification,variant_category,report_date,chromosome,position," \
-               "true_cdna_change,reference_allele,true_transcript_exon,canonical_strand,allele_fraction," \
-               "cnv_call,wildtype,_id"
 
 
 class Trial:
 
-    def __init__(self, db):
+    def __init__(self, db, workers=1):
 
         self.db = db
+        self.workers = workers
         self.load_dict = {
             'yml': self.yaml_to_mongo,
             'bson': self.bson_to_mongo,
@@ -40,23 +38,17 @@ class Trial:
         """
         If you specify the path to a directory, all files with extension YML will be added to MongoDB.
         If you specify the path to a specific YML file, it will add that file to MongoDB.
+        Trials replace the trial with the same protocol number and unchanged files are skipped.
 
         :param yml: Path to YML file.
         """
 
         # search directory for ymls
         if os.path.isdir(yml):
-            for y in os.listdir(yml):
-                ymlpath = os.path.join(yml, y)
-
-                # only add files of extension ".yml"
-                if ymlpath.split('.')[-1] != 'yml':
-                    continue
-
-                # convert yml to json format
-                add_trial(ymlpath, self.db)
+            count = add_trials(yml, self.db, self.workers)
         else:
-            add_trial(yml, self.db)
+            count = load_trials(self.db, [yml])
+        logging.info('Added or updated %d trials' % count)
 
     @staticmethod
     def bson_to_mongo(bson):
@@ -89,21 +81,33 @@ class Patient:
         self.load_dict = {
             'csv': self.load_csv,
             'pkl': self.load_pkl,
+            'parquet': self.load_parquet,
+            'arrow': self.load_arrow,
             'bson': self.load_bson
         }
         self.clinical_df = None
         self.genomic_df = None
 
     def load_csv(self, clinical, genomic):
-        """Load CSV file into a Pandas dataframe"""
-        self.clinical_df = pd.read_csv(clinical)
-        self.genomic_df = pd.read_csv(genomic, low_memory=False)
+        """Read CSV files in chunks of Pandas dataframes"""
+        self.clinical_df = read_csv_chunks(clinical)
+        self.genomic_df = read_csv_chunks(genomic)
 
     def load_pkl(self, clinical, genomic):
         """Load PKL file into a Pandas dataframe"""
         self.clinical_df = pd.read_pickle(clinical)
         self.genomic_df = pd.read_pickle(genomic)
 
+    def load_parquet(self, clinical, genomic):
+        """Read the columns used for matching from Parquet files one row group at a time"""
+        self.clinical_df = read_parquet_chunks(clinical, match_columns(self.db, CLINICAL_FIELDS))
+        self.genomic_df = read_parquet_chunks(genomic, match_columns(self.db, GENOMIC_FIELDS))
+
+    def load_arrow(self, clinical, genomic):
+        """Read the columns used for matching from Arrow IPC files one record batch at a time"""
+        self.clinical_df = read_arrow_chunks(clinical, match_columns(self.db, CLINICAL_FIELDS))
+        self.genomic_df = read_arrow_chunks(genomic, match_columns(self.db, GENOMIC_FIELDS))
+
     @staticmethod
     def load_bson(clinical, genomic):
         """Load bson file into MongoDB"""
@@ -155,7 +159,7 @@ def load(args):
     """
 
     db = get_db(args.mongo_uri)
-    t = Trial(db)
+    t = Trial(db, workers=args.load_workers)
     p = Patient(db)
 
     # Add trials to mongo
@@ -170,81 +174,29 @@ def load(args):
 
         if not is_bson:
 
-            # reformatting
-            for col in ['BIRTH_DATE', 'REPORT_DATE']:
-                try:
-                    p.clinical_df[col] = p.clinical_df[col].apply(lambda x: str(dt.datetime.strptime(x, '%Y-%m-%d')))
-                except ValueError as exc:
-                    if col == 'BIRTH_DATE':
-                        print '## WARNING ## Birth dates should be formatted %Y-%m-%d to be properly stored in MongoDB.'
-                        print '##         ## Birth dates may be malformed in the database and will therefore not match'
-                        print '##         ## trial age restrictions properly.'
-                        print '##         ## System error: \n%s' % exc
-
-            p.genomic_df['TRUE_TRANSCRIPT_EXON'] = p.genomic_df['TRUE_TRANSCRIPT_EXON'].apply(
-                lambda x: int(x) if x != '' and pd.notnull(x) else x)
-
             # Add clinical data to mongo
             logging.info('Adding clinical data to mongo...')
-            clinical_json = json.loads(p.clinical_df.T.to_json()).values()
-            for item in clinical_json:
-                for col in ['BIRTH_DATE', 'REPORT_DATE']:
-                    if col in item:
-                        item[col] = dt.datetime.strptime(str(item[col]), '%Y-%m-%d %X')
-
-            db.clinical.insert(clinical_json)
-
-            # Get clinical ids from mongo
-            logging.info('Adding clinical ids to genomic data...')
-            clinical_doc = list(db.clinical.find({}, {"_id": 1, "SAMPLE_ID": 1}))
-            clinical_dict = dict(zip([i['SAMPLE_ID'] for i in clinical_doc], [i['_id'] for i in clinical_doc]))
-
-            # pd -> json
-            if args.trial_format == 'pkl':
-                genomic_json = json.loads(p.genomic_df.to_json(orient='records'))
-            else:
-                genomic_json = json.loads(p.genomic_df.T.to_json()).values()
-
-            # Map clinical ids to genomic data
-            for item in genomic_json:
-                if item['SAMPLE_ID'] in clinical_dict:
-                    item["CLINICAL_ID"] = clinical_dict[item['SAMPLE_ID']]
-                else:
-                    item["CLINICAL_ID"] = None
+            count = load_clinical(db, iter_chunks(p.clinical_df), workers=args.load_workers)
+            logging.info('Added %d clinical documents' % count)
 
-            # Add genomic data to mongo
+            # Add genomic data with the clinical id of each sample to mongo
             logging.info('Adding genomic data to mongo...')
-            db.genomic.insert(genomic_json)
+            count = load_genomic(db, iter_chunks(p.genomic_df), workers=args.load_workers)
+            logging.info('Added %d genomic documents' % count)
 
         # Create index
         logging.info('Creating index...')
         db.genomic.create_index([("TRUE_HUGO_SYMBOL", ASCENDING), ("WILDTYPE", ASCENDING)])
 
+        # Store the oncotree ancestors of every diagnosis on the clinical documents
+        logging.info('Adding oncotree ancestors to clinical data...')
+        materialize_oncotree(db)
+
     elif args.clinical and not args.genomic or args.genomic and not args.clinical:
         logging.error('If loading patient information, please provide both clinical and genomic data.')
         sys.exit(1)
 
 
-def add_trial(yml, db):
-    """
-    Adds file in YAML format to MongoDB
-
-    :param yml: Path to file
-    :param db: MongoDB connection
-    """
-
-    with open(yml) as f:
-        t = yaml.load(f.read())
-        db.trial.insert_one(t)
-
-
-def export_results(connection_string, file_format, outpath):
-    """Return csv file containing the match results to the current working directory"""
-    cmd = "mongoexport --uri {3} -c trial_match --fields {0} " \
-          "--type {1} --out {2}.{1}".format(MATCH_FIELDS, file_format, outpath, connection_string)
-    subprocess.call(cmd.split(' '))
-
-
 def match(args):
     """
     Matches all trials in database to patients
@@ -255,8 +207,8 @@ def match(args):
     db = get_db(args.mongo_uri)
 
     while True:
-        me = MatchEngine(db)
-        me.find_trial_matches()
+        me = MatchEngine(db, in_memory=args.in_memory)
+        me.find_trial_matches(workers=args.workers, mongo_uri=args.mongo_uri, mode=args.write_mode)
 
         # exit if it is not set to run as a nightly automated daemon, otherwise sleep for a day
         if not args.daemon:
@@ -264,9 +216,11 @@ def match(args):
             # choose output file format
             if args.json_format:
                 file_format = 'json'
+            elif args.parquet_format:
+                file_format = 'parquet'
             elif args.outpath and len(args.outpath.split('.')) > 1:
                 file_format = args.outpath.split('.')[-1]
-                if file_format not in ['json', 'csv']:
+                if file_format not in EXPORT_FORMATS:
                     file_format = 'csv'
             else:
                 file_format = 'csv'
@@ -277,13 +231,79 @@ def match(args):
             else:
                 outpath = './results'
 
-            # export results
-            export_results(args.mongo_uri, file_format, outpath)
+            # export the matches of this run from the trial_match collection
+            export_results(db, export_path(outpath, file_format, args.compression), file_format, args.compression,
+                           open_only=args.open_only, mrns=args.mrns)
 
             break
         else:
             time.sleep(86400)   # sleep for 24 hours
 
+
+def index(args):
+    """
+    Creates the indexes for the queries the trials in the database generate
+
+    :param args: dry_run: Boolean flag; when true, only prints the indexes that would be created
+    """
+
+    db = get_db(args.mongo_uri)
+    advised, plans = provision_indexes(db, dry_run=args.dry_run)
+
+    if args.dry_run:
+        for collection, keys in advised:
+            print 'would create %s index %s' % (collection, keys)
+
+    print '%-10s %-7s %-40s %s' % ('collection', 'leaves', 'plan', 'shape')
+    for collection, shape, count, stages in plans:
+        fields = ', '.join('%s %s' % (field, kind) for field, kind in shape)
+        print '%-10s %-7d %-40s %s' % (collection, count, ' <- '.join(stages), fields)
+
+    scans = sum(1 for plan in plans if 'COLLSCAN' in plan[3])
+    print '%d of %d query shapes are collection scans' % (scans, len(plans))
+
+
+def validate(args):
+    """
+    Validates YML trial files against the trial schema. The errors of every trial are printed as soon as it is
+    validated and the exit status is 1 when any trial is invalid.
+
+    :param trials: Path to a YML trial file or a directory containing a file for each trial
+    :param workers: Number of processes the trials are validated in
+    """
+
+    if os.path.isdir(args.trials):
+        paths = [os.path.join(args.trials, yml) for yml in sorted(os.listdir(args.trials))
+                 if yml.split('.')[-1] == 'yml']
+    else:
+        paths = [args.trials]
+
+    # files that are not valid YAML are reported without being validated
+    parsed = []
+    invalid = 0
+    for path in paths:
+        with open(path) as f:
+            text = f.read()
+        try:
+            parsed.append((path, parse_yaml(text)))
+        except Exception as exc:
+            print '%s: %s' % (path, json.dumps({None: [str(exc)]}))
+            invalid += 1
+
+    results = validate_many([trial for _, trial in parsed], workers=args.workers, mongo_uri=args.mongo_uri)
+    for position, errors in results:
+        if errors:
+            print '%s: %s' % (parsed[position][0], json.dumps(errors, sort_keys=True))
+            invalid += 1
+        else:
+            print '%s: valid' % parsed[position][0]
+        sys.stdout.flush()
+
+    logging.info('%d of %d trials are valid' % (len(paths) - invalid, len(paths)))
+    if invalid:
+        sys.exit(1)
+
+
 if __name__ == '__main__':
 
     param_trials_help = 'Path to your trial data file or a directory containing a file for each trial.' \
@@ -297,7 +317,23 @@ if __name__ == '__main__':
     param_json_help = 'Set this flag to export your results in a .json file.'
     param_csv_help = 'Set this flag to export your results in a .csv file. Default.'
     param_outpath_help = 'Destination and name of your results file.'
+    param_parquet_help = 'Set this flag to export your results in a .parquet file. Requires pyarrow.'
+    param_compression_help = 'Compress the results file with gzip or zstd (requires zstandard). Parquet files are ' \
+                             'compressed per column with the given codec. Default is no compression.'
+    param_open_only_help = 'Set this flag to only export matches to open trials.'
+    param_mrn_help = 'Only export the matches of this MRN. Can be given more than once.'
+    param_in_memory_help = 'Set this flag to load the genomic collection into memory once and evaluate genomic ' \
+                           'criteria against it instead of querying MongoDB for every criterium.'
+    param_workers_help = 'Number of processes the trials are matched in. Default is 1.'
+    param_write_mode_help = 'How matches are written to the trial_match collection. "swap" replaces it at once, ' \
+                            '"incremental" only writes the matches that changed since the previous run. ' \
+                            'Default is swap.'
     param_trial_format_help = 'File format of input trial data. Default is YML.'
+    param_dry_run_help = 'Set this flag to print the indexes that would be created without creating them.'
+    param_validate_trials_help = 'Path to a YML trial file or a directory containing a file for each trial.'
+    param_validate_workers_help = 'Number of processes the trials are validated in. Default is 1.'
+    param_load_workers_help = 'Number of processes parsing trial files and of threads inserting patient data ' \
+                              'chunks into MongoDB. Default is 1.'
     param_patient_format_help = 'File format of input patient data (both clinical and genomic files). Default is CSV.'
 
     # mode parser.
@@ -320,8 +356,10 @@ if __name__ == '__main__':
                         dest='patient_format',
                         default='csv',
                         action='store',
-                        choices=['csv', 'pkl', 'bson'],
+                        choices=['csv', 'pkl', 'parquet', 'arrow', 'bson'],
                         help=param_patient_format_help)
+    subp_p.add_argument('--load-workers', dest='load_workers', required=False, type=int, default=1,
+                        help=param_load_workers_help)
     subp_p.set_defaults(func=load)
 
     # match
@@ -330,9 +368,42 @@ if __name__ == '__main__':
     subp_p.add_argument('--daemon', dest="daemon", required=False, action="store_true", help=param_daemon_help)
     subp_p.add_argument('--json', dest="json_format", required=False, action="store_true", help=param_json_help)
     subp_p.add_argument('--csv', dest="csv_format", required=False, action="store_true", help=param_csv_help)
+    subp_p.add_argument('--parquet', dest="parquet_format", required=False, action="store_true",
+                        help=param_parquet_help)
     subp_p.add_argument('-o', dest="outpath", required=False, help=param_outpath_help)
+    subp_p.add_argument('--compression', dest="compression", required=False, default=None,
+                        choices=['gzip', 'zstd'], help=param_compression_help)
+    subp_p.add_argument('--open-only', dest="open_only", required=False, action="store_true",
+                        help=param_open_only_help)
+    subp_p.add_argument('--mrn', dest="mrns", required=False, action="append", default=None, help=param_mrn_help)
+    subp_p.add_argument('--in-memory', dest="in_memory", required=False, action="store_true",
+                        help=param_in_memory_help)
+    subp_p.add_argument('--workers', dest="workers", required=False, type=int, default=1, help=param_workers_help)
+    subp_p.add_argument('--write-mode',
+                        dest='write_mode',
+                        default='swap',
+                        action='store',
+                        choices=['swap', 'incremental'],
+                        help=param_write_mode_help)
     subp_p.set_defaults(func=match)
 
+    # index
+    subp_p = subp.add_parser('index', help='Creates indexes for the queries of the trials in the database')
+    subp_p.add_argument('--mongo-uri', dest='mongo_uri', required=False, default=None, help=param_mongo_uri_help)
+    subp_p.add_argument('--dry-run', dest='dry_run', required=False, action='store_true', help=param_dry_run_help)
+    subp_p.set_defaults(func=index)
+
+    # validate
+    subp_p = subp.add_parser('validate', help='Validates trial files against the trial schema')
+    subp_p.add_argument('-t', dest='trials', required=True, help=param_validate_trials_help)
+    subp_p.add_argument('--mongo-uri', dest='mongo_uri', required=False, default=None, help=param_mongo_uri_help)
+    subp_p.add_argument('--workers', dest="workers", required=False, type=int, default=1,
+                        help=param_validate_workers_help)
+    subp_p.set_defaults(func=validate)
+
     # parse args.
     args = main_p.parse_args()
-    args.func(args)
+    try:
+        args.func(args)
+    finally:
+        close_clients()
@@ -0,0 +1,163 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import re
+import logging
+import numpy as np
+import pandas as pd
+
+from matchengine.utilities import values_equal, compare_values
+
+
+class ColumnarGenomic(object):
+    """
+    In-memory, column oriented copy of the genomic collection.
+
+    Every field is stored as an array of integer codes into the distinct values of that field (-1 for null or
+    missing values) plus a mask recording which documents contain the field at all. Query operators are
+    evaluated once per distinct value and broadcast to all documents through the codes, so a genomic leaf
+    costs a handful of vectorized operations instead of a round trip to Mongo.
+    """
+
+    def __init__(self, db, fields, batch_size=10000):
+        """
+        Loads the genomic collection into memory
+
+        :param db: Mongo connection
+        :param fields: Genomic fields to load. Queries can only reference these fields.
+        :param batch_size: Number of documents fetched per round trip while loading
+        """
+
+        self.fields = list(fields)
+
+        values = dict((field, []) for field in self.fields)
+        present = dict((field, []) for field in self.fields)
+
+        proj = dict.fromkeys(self.fields, 1)
+        for doc in db.genomic.find({}, proj).batch_size(batch_size):
+            for field in self.fields:
+                present[field].append(field in doc)
+                values[field].append(doc.get(field))
+
+        self.size = len(values[self.fields[0]]) if self.fields else 0
+        self.columns = dict((field, _Column(values.pop(field), present.pop(field))) for field in self.fields)
+
+        logging.info('Loaded %d genomic documents into memory' % self.size)
+
+    def evaluate(self, query):
+        """
+        Evaluates a Mongo query against all genomic documents
+
+        :param query: Mongo query built by "build_gquery"
+        :return: boolean mask over all genomic documents
+        """
+
+        mask = np.ones(self.size, dtype=bool)
+
+        for key, cond in query.iteritems():
+            if key == '$and':
+                for subquery in cond:
+                    mask &= self.evaluate(subquery)
+            elif key == '$or':
+                submask = np.zeros(self.size, dtype=bool)
+                for subquery in cond:
+                    submask |= self.evaluate(subquery)
+                mask &= submask
+            elif key.startswith('$'):
+                raise ValueError('Unsupported query operator %s' % key)
+            elif isinstance(cond, dict) and all(op.startswith('$') for op in cond):
+                for op, arg in cond.iteritems():
+                    mask &= self._evaluate_operator(key, op, arg)
+            else:
+                mask &= self._evaluate_operator(key, '$eq', cond)
+
+        return mask
+
+    def find(self, query, proj):
+        """
+        Returns the genomic documents that match a Mongo query, like "db.genomic.find"
+
+        :param query: Mongo query built by "build_gquery"
+        :param proj: Mongo projection
+        :return: list of genomic documents
+        """
+
+        idx = np.flatnonzero(self.evaluate(query))
+
+        columns = []
+        for field in proj:
+            if proj[field] and field in self.columns:
+                column = self.columns[field]
+                columns.append((field, column.take(idx), column.present[idx]))
+
+        docs = []
+        for i in range(len(idx)):
+            doc = {}
+            for field, values, present in columns:
+                if present[i]:
+                    doc[field] = values[i]
+            docs.append(doc)
+
+        return docs
+
+    def _evaluate_operator(self, field, op, arg):
+        """Evaluates a single query operator against every genomic document"""
+
+        if field not in self.columns:
+            raise ValueError('Genomic field %s is not loaded in memory' % field)
+
+        column = self.columns[field]
+
+        if op == '$exists':
+            return column.present.copy() if arg else ~column.present
+        elif op == '$ne':
+            return ~self._evaluate_operator(field, '$eq', arg)
+        elif op == '$nin':
+            return ~self._evaluate_operator(field, '$in', arg)
+        else:
+            return column.hits(op, arg)[column.codes]
+
+
+class _Column(object):
+    """A single dictionary encoded field of the genomic collection"""
+
+    def __init__(self, values, present):
+
+        self.codes, self.categories = pd.factorize(np.array(values, dtype=object))
+        self.categories = np.asarray(self.categories, dtype=object)
+        self.present = np.array(present, dtype=bool)
+        self.lookup = dict((val, code) for code, val in enumerate(self.categories))
+
+    def take(self, idx):
+        """Returns the values of the given documents; None for null or missing values"""
+        return np.append(self.categories, None)[self.codes[idx]]
+
+    def hits(self, op, arg):
+        """
+        Evaluates a query operator against the distinct values of the field
+
+        :return: boolean array with an entry per distinct value followed by an entry for null or missing values
+        """
+
+        hits = np.zeros(len(self.categories) + 1, dtype=bool)
+
+        if op == '$eq':
+            if isinstance(arg, re._pattern_type):
+                hits[:-1] = [isinstance(val, basestring) and arg.search(val) is not None for val in self.categories]
+            elif arg is None:
+                hits[-1] = True
+            else:
+                code = self.lookup.get(arg)
+                if code is not None and values_equal(self.categories[code], arg):
+                    hits[code] = True
+        elif op == '$in':
+            for item in arg:
+                hits |= self.hits('$eq', item)
+        elif op == '$regex':
+            pattern = re.compile(arg)
+            hits[:-1] = [isinstance(val, basestring) and pattern.search(val) is not None for val in self.categories]
+        elif op in ['$lt', '$lte', '$gt', '$gte']:
+            hits[:-1] = [compare_values(val, op, arg) for val in self.categories]
+        else:
+            raise ValueError('Unsupported query operator %s' % op)
+
+        return hits
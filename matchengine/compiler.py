@@ -0,0 +1,197 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+from collections import Mapping, Sequence
+
+from cerberus1 import schema_registry
+
+# expressions checking the value of a field against the cerberus types
+TYPE_CHECKS = {
+    'boolean': 'isinstance(value, bool)',
+    'dict': 'isinstance(value, Mapping)',
+    'float': 'isinstance(value, (float, int, long))',
+    'integer': 'isinstance(value, (int, long))',
+    'list': '(isinstance(value, Sequence) and not isinstance(value, basestring))',
+    'number': '(isinstance(value, (int, long, float)) and not isinstance(value, bool))',
+    'string': 'isinstance(value, basestring)'
+}
+
+# rules the compiler implements itself, custom rules are implemented by the checks given to "compile_schema"
+COMPILED_RULES = set(['allow_unknown', 'allowed', 'empty', 'nullable', 'required', 'schema', 'type'])
+
+
+def compile_schema(schema, checks=None, allow_unknown=False):
+    """
+    Generates a Python function that tells whether a document is valid against a fixed cerberus schema. The
+    function returns True exactly when cerberus1.Validator would validate the document without errors; it does not
+    report what is invalid, run the full validator for the error messages.
+
+    Only the rules of the matchengine schemas are supported: type, required, nullable, allowed, empty, schema and
+    boolean allow_unknown, plus the custom rules in "checks". Every check is called as
+    check(context, constraint, field, value) and returns whether the value is valid.
+
+    :param schema: Cerberus schema, nested schemas may be names of the cerberus1 schema registry
+    :param checks: Dictionary mapping the names of custom rules to their checks
+    :param allow_unknown: Boolean flag; when true, fields missing from the schema are valid
+    :return: Function taking a document and the context passed to the checks
+    """
+
+    return _SchemaCompiler(checks or {}).compile(schema, allow_unknown)
+
+
+class _SchemaCompiler(object):
+
+    def __init__(self, checks):
+        self.checks = checks
+        self.lines = []
+        self.namespace = {'Mapping': Mapping, 'Sequence': Sequence}
+        self.functions = {}
+
+    def compile(self, schema, allow_unknown):
+        name = self.mapping(schema, allow_unknown)
+        source = '\n'.join(self.lines)
+        exec compile(source, '<compiled schema>', 'exec') in self.namespace
+
+        validate = self.namespace[name]
+
+        def valid(document, context=None):
+            return validate(document, context)
+
+        valid.source = source
+        return valid
+
+    def constant(self, value):
+        name = '_c%d' % len(self.namespace)
+        self.namespace[name] = value
+        return name
+
+    def function(self, key, prefix):
+        """Returns the name of the function generated for key and whether it still has to be generated"""
+
+        if key in self.functions:
+            return self.functions[key], False
+        name = '_%s%d' % (prefix, len(self.functions))
+        self.functions[key] = name
+        return name, True
+
+    def mapping(self, schema, allow_unknown):
+        """Generates the validation function of the documents of a schema"""
+
+        if isinstance(schema, basestring):
+            resolved = schema_registry.get(schema)
+            if resolved is None:
+                raise ValueError('Schema %s is not registered' % schema)
+            key = (schema, allow_unknown)
+            schema = resolved
+        else:
+            key = (id(schema), allow_unknown)
+
+        if not isinstance(allow_unknown, bool):
+            raise ValueError('Only boolean allow_unknown can be compiled')
+
+        name, new = self.function(key, 'mapping')
+        if not new:
+            return name
+
+        # keep the schema alive, its id is part of the key
+        self.constant(schema)
+
+        body = ['if not isinstance(document, Mapping):', '    return False']
+        if not allow_unknown:
+            fields = self.constant(frozenset(schema))
+            body += ['for field in document:',
+                     '    if field not in %s:' % fields,
+                     '        return False']
+
+        for field, rules in schema.iteritems():
+            if not isinstance(rules, Mapping):
+                raise ValueError('Rules of field %s cannot be compiled' % field)
+            if rules.get('required') is True:
+                body += ['if %r not in document:' % field, '    return False']
+
+        for field, rules in schema.iteritems():
+            body += ['if %r in document:' % field, '    value = document[%r]' % field]
+            body += ['    ' + line for line in self.rules(rules, repr(field), allow_unknown)]
+
+        self.lines += ['def %s(document, context):' % name]
+        self.lines += ['    ' + line for line in body + ['return True']]
+        self.lines.append('')
+        return name
+
+    def items(self, rules, allow_unknown):
+        """Generates the validation function of the items of a list"""
+
+        if not isinstance(rules, Mapping):
+            raise ValueError('Rules of list items cannot be compiled')
+
+        name, new = self.function((id(rules), allow_unknown), 'items')
+        if not new:
+            return name
+        self.constant(rules)
+
+        body = self.rules(rules, 'field', allow_unknown)
+        self.lines += ['def %s(field, value, context):' % name]
+        self.lines += ['    ' + line for line in body + ['return True']]
+        self.lines.append('')
+        return name
+
+    def rules(self, rules, field, allow_unknown):
+        """Generates the statements validating "value", they return False on the first invalid rule"""
+
+        unknown = set(rules) - COMPILED_RULES - set(self.checks)
+        if unknown:
+            raise ValueError('Rules %s cannot be compiled' % ', '.join(sorted(unknown)))
+
+        # like in cerberus, a null value is only checked by the nullable rule
+        if rules.get('nullable'):
+            lines = ['if value is not None:']
+            indent = '    '
+        else:
+            lines = ['if value is None:', '    return False']
+            indent = ''
+
+        body = []
+        types = rules.get('type')
+        if types is not None:
+            types = [types] if isinstance(types, basestring) else list(types)
+            if any(t not in TYPE_CHECKS for t in types):
+                raise ValueError('Types %s cannot be compiled' % types)
+            body += ['if not (%s):' % ' or '.join(TYPE_CHECKS[t] for t in types), '    return False']
+
+        if 'allowed' in rules:
+            allowed = self.constant(frozenset(rules['allowed']))
+            body += ['if isinstance(value, basestring):',
+                     '    if value not in %s:' % allowed,
+                     '        return False',
+                     'elif isinstance(value, Sequence):',
+                     '    if not %s.issuperset(value):' % allowed,
+                     '        return False',
+                     'elif isinstance(value, int):',
+                     '    if value not in %s:' % allowed,
+                     '        return False']
+
+        if not rules.get('empty', True):
+            body += ['if isinstance(value, basestring) and len(value) == 0:', '    return False']
+
+        for rule in sorted(set(rules) & set(self.checks)):
+            check = self.constant(self.checks[rule])
+            constraint = self.constant(rules[rule])
+            body += ['if not %s(context, %s, %s, value):' % (check, constraint, field), '    return False']
+
+        if rules.get('schema') is not None:
+            body += self.schema(rules, types, allow_unknown)
+
+        return lines + [indent + line for line in body]
+
+    def schema(self, rules, types, allow_unknown):
+        """Generates the statements of the schema rule, the rule applies to list items or to a subdocument"""
+
+        if types == ['list']:
+            name = self.items(rules['schema'], allow_unknown)
+            return ['for index, item in enumerate(value):',
+                    '    if not %s(index, item, context):' % name,
+                    '        return False']
+        elif types == ['dict']:
+            name = self.mapping(rules['schema'], rules.get('allow_unknown', allow_unknown))
+            return ['if not %s(value, context):' % name, '    return False']
+
+        raise ValueError('The schema rule can only be compiled for the list or dict type')
@@ -2,13 +2,16 @@
 
 from cerberus1 import schema_registry
 import networkx as nx
-import gc
 import logging
+import multiprocessing
+from multiprocessing.util import Finalize
 
 from matchengine import schema
-from matchengine.validation import ConsentValidatorCerberus
+from matchengine.validation import ConsentValidatorCerberus, ValidationCache, is_valid_trial, validate_many
 from matchengine.utilities import *
-from matchengine.sort import add_sort_order
+from matchengine.columnar import ColumnarGenomic
+from matchengine.samples import SampleIndex
+from matchengine.writer import MatchWriter
 
 # logging
 logging.basicConfig(level=logging.DEBUG, format='[%(levelname)s] %(asctime)s: %(message)s', )
@@ -35,19 +38,73 @@ schema_registry.add('yaml_genomic_schema', schema.yaml_genomic_schema)
 schema_registry.add('yaml_clinical_schema', schema.yaml_clinical_schema)
 schema_registry.add('map', schema.map)
 
+# genomic fields copied into each trial match
+MATCH_PROJECTION = [
+    'SAMPLE_ID',
+    'TRUE_HUGO_SYMBOL',
+    'TRUE_PROTEIN_CHANGE',
+    'TRUE_VARIANT_CLASSIFICATION',
+    'VARIANT_CATEGORY',
+    'CNV_CALL',
+    'WILDTYPE',
+    'CHROMOSOME',
+    'POSITION',
+    'TRUE_CDNA_CHANGE',
+    'REFERENCE_ALLELE',
+    'TRUE_TRANSCRIPT_EXON',
+    'CANONICAL_STRAND',
+    'ALLELE_FRACTION',
+    'TIER',
+    'CLINICAL_ID',
+    'MMR_STATUS',
+    'ACTIONABILITY',
+    '_id'
+]
+
 
 class MatchEngine(object):
 
-    def __init__(self, db):
+    def __init__(self, db, in_memory=False, bootstrap=True, field_map=None, genomic_store=None):
         # get the database.
         self.db = db
 
-        # stores the complete list as easy lookup
-        self.all_match = set(self.db.clinical.distinct('SAMPLE_ID'))
+        # optionally evaluate genomic leaves against an in-memory copy of the genomic collection, either loaded
+        # here or an existing copy, e.g. the one of the parent process shared with match workers
+        self.in_memory = in_memory or genomic_store is not None
+        self.genomic_store = genomic_store
+        if self.in_memory and genomic_store is None:
+            self.genomic_store = ColumnarGenomic(self.db, MATCH_PROJECTION + ['STRUCTURAL_VARIANT_COMMENT'])
+
+        # fixed reference date so that age criteria translate into identical queries throughout a run
+        self.today = reference_date()
+
+        # per-run cache of leaf query results keyed by the normalized query
+        self.query_cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # collection statistics used to order the children of and/or nodes, gathered on first use
+        self.statistics = None
+
+        # per-run cache of the clinical fields copied into match documents keyed by SAMPLE_ID
+        self.clinical_cache = {}
+
+        # normalize table and protocol ids read once for all validated trials
+        self.validation_cache = ValidationCache(self.db)
+
+        # clinical documents carry the oncotree ancestors of their diagnosis when loaded with "materialize_oncotree"
+        self.oncotree_paths = self.db.clinical.find_one({}, {'_id': 1}) is not None and \
+            self.db.clinical.find_one({ONCOTREE_ANCESTORS: {'$exists': False}}, {'_id': 1}) is None
+
+        # dense integer per sample id so that match sets are stored as boolean masks
+        self.samples = SampleIndex(self.db.clinical.distinct('SAMPLE_ID'))
 
         # get mapping values between yml and db
-        self.bootstrap_map()
-        self.mapping = list(self.db.map.find())
+        if bootstrap:
+            self.bootstrap_map()
+
+        # engines that do not bootstrap the map use the default one until the map collection is filled
+        self.mapping = list(self.db.map.find()) or self.default_map()
 
         # add mmr/ms status mapping
         self.mapping.extend([
@@ -55,9 +112,21 @@ class MatchEngine(object):
             {'key_old': 'MS_STATUS', 'key_new': 'MMR_STATUS', 'values': {}}
         ])
 
+        # compiled field and value translation, optionally shared with another engine
+        self.field_map = field_map if field_map is not None else FieldMap(self.mapping)
+
     def bootstrap_map(self):
         """Loads the map into the database between yaml field names and their corresponding database field names"""
 
+        self.db.drop_collection("map")
+        self.db.map.insert_many(self.default_map())
+
+    @staticmethod
+    def default_map():
+        """
+        :return: Documents of the map between yaml field names and their corresponding database field names
+        """
+
         # define the mapping
         key_map = {
             'AGE_NUMERICAL': 'BIRTH_DATE',
@@ -104,9 +173,7 @@ class MatchEngine(object):
                 item['values'] = {}
             mapping.append(item)
 
-        # add to db
-        self.db.drop_collection("map")
-        self.db.map.insert_many(mapping)
+        return mapping
 
     @staticmethod
     def validate_yaml_format(data):
@@ -133,10 +200,40 @@ class MatchEngine(object):
         :return:
         """
 
-        v = ConsentValidatorCerberus(schema.parent_schema)
+        # most trials are valid, the validator only runs for the errors of invalid ones
+        if is_valid_trial(data_json, self.validation_cache):
+            return {}
+
+        v = ConsentValidatorCerberus(schema.parent_schema, cache=self.validation_cache)
         v.validate(data_json)
         return v.errors
 
+    def validate_many(self, documents, workers=1, mongo_uri=None):
+        """
+        Validates yaml specs like "validate_many" of matchengine.validation, with the validation cache of the
+        engine when they are validated in this process
+
+        :param documents: Iterable of trial dictionaries
+        :param workers: Number of processes the trials are validated in, they are validated in this process when 1
+        :param mongo_uri: Mongo URI the worker processes connect to
+        :return: Iterator over (index, errors) tuples, with the position of the trial in "documents" and its errors
+            as returned by "validate_yaml_data"; errors raised by it are reported under the key None
+        """
+
+        return validate_many(documents, workers, mongo_uri, cache=self.validation_cache)
+
+    def load_trials(self, paths, workers=1):
+        """
+        Loads YAML trial files like "load_trials" and adds the loaded trials to the validation cache, so that
+        trials validated afterwards are checked against them
+
+        :param paths: List of paths to YAML trial files
+        :param workers: Number of processes parsing files
+        :return: Number of trials written
+        """
+
+        return load_trials(self.db, paths, workers, cache=self.validation_cache)
+
     @staticmethod
     def _test_type(data):
         ''' returns the type
@@ -223,170 +320,533 @@ class MatchEngine(object):
 
     def run_query(self, node):
         """
-        Runs genomic or clinical query against Mongo database and returns a set of sample ids that matched
+        Runs genomic or clinical query against Mongo database and returns a set of sample ids that matched.
+        Results are cached for the duration of a matching run, keyed by the normalized query, so leaves
+        shared between trials are only queried once.
 
         :param node: node location with the trial match tree
-        :param db: database connection
 
         :returns
             matched_sample_ids: set of matched sample ids
             matched_genomic_info: genomic information regarding each match
         """
 
-        matched_genomic_info = []
+        key = self._cached_query(node)
+        if key is None:
+            return
+
+        mask, matched_genomic_info = self.query_cache[key]
+        return self.samples.to_set(mask), self._expand_genomic_info(mask, matched_genomic_info)
+
+    def _cached_query(self, node):
+        """
+        Makes sure the results of a leaf are in the query cache
+
+        :param node: node location with the trial match tree
+        :return: cache key of the leaf
+        """
+
+        leaf = self._prepare_leaf(node)
+        if leaf is None:
+            logging.info("bad match tree")
+            return
+
+        key, query, neg, sv = leaf
+        if key in self.query_cache:
+            self.cache_hits += 1
+            return key
 
         # execute query against genomic table
         if node['type'] == 'genomic':
+            self.query_cache[key] = self._run_genomic_query(query, neg, sv)
 
-            item = node['value']
+        # execute query against clinical table
+        else:
+            self.query_cache[key] = self._run_clinical_query(query)
 
-            # prepare genomic criteria
-            g, neg, sv = self.prepare_genomic_criteria(item)
+        self.cache_misses += 1
+        return key
 
-            # execute match
-            if len(g.keys()) == 0:
-                matched_sample_ids = list()
-            else:
+    def _prepare_leaf(self, node):
+        """
+        Translates a leaf into a Mongo query. The result is kept on the node since leaves are looked at both
+        when estimating their selectivity and when they are executed.
 
-                if neg:
-                    proj = {'SAMPLE_ID': 1}     # speeds up query
-                else:
-                    proj = {
-                        'SAMPLE_ID': 1,
-                        'TRUE_HUGO_SYMBOL': 1,
-                        'TRUE_PROTEIN_CHANGE': 1,
-                        'TRUE_VARIANT_CLASSIFICATION': 1,
-                        'VARIANT_CATEGORY': 1,
-                        'CNV_CALL': 1,
-                        'WILDTYPE': 1,
-                        'CHROMOSOME': 1,
-                        'POSITION': 1,
-                        'TRUE_CDNA_CHANGE': 1,
-                        'REFERENCE_ALLELE': 1,
-                        'TRUE_TRANSCRIPT_EXON': 1,
-                        'CANONICAL_STRAND': 1,
-                        'ALLELE_FRACTION': 1,
-                        'TIER': 1,
-                        'CLINICAL_ID': 1,
-                        'MMR_STATUS': 1,
-                        'ACTIONABILITY': 1,
-                        '_id': 1
-                    }
-
-                    # record pathologist's chromosomal rearrangement comment for downstream manual analysis
-                    if sv:
-                        proj['STRUCTURAL_VARIANT_COMMENT'] = 1
-
-                results = list(self.db.genomic.find(g, proj))
-
-                # if a negative query was match, the formatted genomic alteration will reflect the trial criteria
-                # and the genomic information will not be copied into the trial_match document
-                if neg:
-
-                    # If the yaml criterium was negative, then subtract the matched results from the total set
-                    matched_sample_ids = self.all_match - set(x['SAMPLE_ID']for x in results)
-                    alteration, is_variant = format_not_match(g)
-
-                    # add genomic alterations per sample id
-                    matched_genomic_info = [{
-                        'sample_id': sample_id,
-                        'match_type': is_variant,
-                        'genomic_alteration': alteration
-                    } for sample_id in matched_sample_ids]
+        :param node: node location with the trial match tree
+        :return: cache key, Mongo query, negative flag and structural variant flag of the leaf
+        """
 
-                else:
-                    for item in results:
+        if '_leaf' in node:
+            return node['_leaf']
 
-                        # format the genomic alteration that matched
-                        alteration, is_variant = format_genomic_alteration(item, g)
+        # prepare genomic criteria
+        if node['type'] == 'genomic':
+            g, neg, sv = self.prepare_genomic_criteria(node['value'])
+            leaf = (('genomic', query_key(g), neg), g, neg, sv)
 
-                        # add genomic information and alterations that matched per sample id
-                        genomic_info = {
-                            'match_type': is_variant,
-                            'genomic_alteration': alteration
-                        }
+        # prepare clinical criteria
+        elif node['type'] == 'clinical':
+            c = self.prepare_clinical_criteria(node['value'])
+            leaf = (('clinical', query_key(c), False), c, False, False)
 
-                        # copy genomic document projection into match
-                        for field in proj:
-                            if field in item:
-                                if field == '_id':
-                                    genomic_info['genomic_id'] = item[field]
-                                else:
-                                    genomic_info[field.lower()] = item[field]
+        else:
+            return
 
-                        # add unique matches by sample id
-                        matched_genomic_info.append(genomic_info)
+        node['_leaf'] = leaf
+        return leaf
 
-                    matched_sample_ids = set(item['SAMPLE_ID'] for item in results)
+    def _expand_genomic_info(self, mask, matched_genomic_info, sample_ids=None):
+        """
+        Copies the cached genomic information of a leaf. Matches are annotated further downstream so the
+        cached results are never handed out directly.
 
-        # execute query against clinical table
-        elif node['type'] == 'clinical':
+        :param mask: samples matched by the leaf
+        :param matched_genomic_info: cached genomic information of the leaf
+        :param sample_ids: Only return information regarding these sample ids
+        :return: genomic information regarding each match
+        """
 
-            item = node['value']
+        # negative leaves share a single alteration among all matched samples
+        if isinstance(matched_genomic_info, dict):
+            if sample_ids is None:
+                sample_ids = self.samples.to_set(mask)
+            return [dict(matched_genomic_info, sample_id=sample_id) for sample_id in sample_ids
+                    if self.samples.contains(mask, sample_id)]
 
-            # prepare clinical criteria
-            c = self.prepare_clinical_criteria(item)
+        if sample_ids is None:
+            return [dict(info) for info in matched_genomic_info]
+        return [dict(info) for info in matched_genomic_info if info['sample_id'] in sample_ids]
 
-            # execute match
-            if len(c.keys()) == 0:
-                matched_sample_ids = list()
-            else:
-                matched_sample_ids = set(self.db.clinical.find(c).distinct('SAMPLE_ID'))
+    def _run_genomic_query(self, g, neg, sv, results=None):
+        """
+        Executes a prepared genomic query against the genomic collection
+
+        :param g: Mongo query for the genomic collection
+        :param neg: Boolean flag; when true, the query is run negatively
+        :param sv: Boolean flag; when true, the query is on structural variants
+        :param results: Genomic documents matching the query when they were already fetched by the query planner
+        :return: mask of matched samples and the genomic information regarding each match. For negative
+        queries the genomic information is the alteration shared by all matched samples.
+        """
+
+        matched_genomic_info = []
+
+        # execute match
+        if len(g.keys()) == 0:
+            return self.samples.empty(), matched_genomic_info
 
+        if neg:
+            proj = {'SAMPLE_ID': 1}     # speeds up query
         else:
-            logging.info("bad match tree")
-            return
+            proj = dict.fromkeys(MATCH_PROJECTION, 1)
+
+            # record pathologist's chromosomal rearrangement comment for downstream manual analysis
+            if sv:
+                proj['STRUCTURAL_VARIANT_COMMENT'] = 1
+
+        if results is None and self.genomic_store is not None:
+            try:
+                results = self.genomic_store.find(g, proj)
+            except ValueError as exc:
+                logging.warning('Falling back to Mongo for genomic query %s: %s' % (g, exc))
+
+        if results is None:
+            results = list(self.db.genomic.find(g, proj))
+
+        # if a negative query was match, the formatted genomic alteration will reflect the trial criteria
+        # and the genomic information will not be copied into the trial_match document
+        if neg:
+
+            # If the yaml criterium was negative, then subtract the matched results from the total set
+            matched_samples = self.samples.complement(self.samples.mask(x['SAMPLE_ID'] for x in results))
+            alteration, is_variant = format_not_match(g)
+
+            # the same alteration is added per sample id when the match is expanded
+            matched_genomic_info = {
+                'match_type': is_variant,
+                'genomic_alteration': alteration
+            }
+
+        else:
+            for item in results:
 
-        # return a list of sample ids and match information
-        return matched_sample_ids, matched_genomic_info
+                # format the genomic alteration that matched
+                alteration, is_variant = format_genomic_alteration(item, g)
+
+                # add genomic information and alterations that matched per sample id
+                genomic_info = {
+                    'match_type': is_variant,
+                    'genomic_alteration': alteration
+                }
+
+                # copy genomic document projection into match
+                for field in proj:
+                    if field in item:
+                        if field == '_id':
+                            genomic_info['genomic_id'] = item[field]
+                        else:
+                            genomic_info[field.lower()] = item[field]
+
+                # add unique matches by sample id
+                matched_genomic_info.append(genomic_info)
+
+            matched_samples = self.samples.mask(item['SAMPLE_ID'] for item in results)
+
+        return matched_samples, matched_genomic_info
+
+    def _run_clinical_query(self, c):
+        """
+        Executes a prepared clinical query against the clinical collection
+
+        :param c: Mongo query for the clinical collection
+        :return: mask of matched samples and an empty list of genomic information
+        """
+
+        if len(c.keys()) == 0:
+            return self.samples.empty(), []
+
+        return self.samples.mask(self.db.clinical.find(c).distinct('SAMPLE_ID')), []
+
+    def plan_queries(self, trials):
+        """
+        Collects the leaves of the step, arm, and dose match trees of all given trials, removes duplicates,
+        and executes them in a few batched round trips before any match tree is evaluated. Results are stored
+        in the query cache so that "run_query" does not go back to the database.
+
+        Genomic leaves that name a gene are fetched together with one "$in" query per batch of genes and split
+        client-side. Clinical leaves are evaluated client-side against a single read of the clinical collection.
+        Anything else is executed as its own query.
+
+        :param trials: List of trial documents
+        """
+
+        genomic_leaves = {}
+        clinical_leaves = {}
+
+        for trial in trials:
+            for segment in iter_match_segments(trial):
+                match_tree = self.create_match_tree(segment['match'][0])
+                for node_id in match_tree.nodes():
+                    if match_tree.successors(node_id):
+                        continue
+
+                    node = match_tree.node[node_id]
+                    if node['type'] == 'genomic':
+                        g, neg, sv = self.prepare_genomic_criteria(node['value'])
+                        key = ('genomic', query_key(g), neg)
+                        if key not in self.query_cache:
+                            genomic_leaves[key] = (g, neg, sv)
+
+                    elif node['type'] == 'clinical':
+                        c = self.prepare_clinical_criteria(node['value'])
+                        key = ('clinical', query_key(c), False)
+                        if key not in self.query_cache:
+                            clinical_leaves[key] = c
+
+        round_trips = self._plan_genomic_queries(genomic_leaves)
+        round_trips += self._plan_clinical_queries(clinical_leaves)
+        self.cache_misses += len(genomic_leaves) + len(clinical_leaves)
+
+        logging.info('Planned %d distinct leaves in %d round trips' % (
+            len(genomic_leaves) + len(clinical_leaves), round_trips))
+
+    def _plan_genomic_queries(self, leaves, batch_size=500):
+        """
+        Executes genomic leaves grouped by gene and stores the results in the query cache
+
+        :param leaves: Dictionary mapping cache keys to prepared genomic queries
+        :param batch_size: Number of genes fetched per round trip
+        :return: Number of round trips
+        """
+
+        round_trips = 0
+        by_gene = {}
+        fields = set(['SAMPLE_ID'])
+
+        # nothing to batch when the genomic collection is held in memory
+        if self.genomic_store is not None:
+            for key, (g, neg, sv) in leaves.iteritems():
+                self.query_cache[key] = self._run_genomic_query(g, neg, sv)
+            return round_trips
+
+        for key, (g, neg, sv) in leaves.iteritems():
+            criteria = g['$and'][0] if '$and' in g else g
+            hugo = criteria.get('TRUE_HUGO_SYMBOL')
+            query_fields_, operators = query_fields(g)
+
+            # leaves without a single gene, or that cannot be evaluated client-side, are executed on their own
+            if not isinstance(hugo, dict) or hugo.keys() != ['$eq'] or not operators <= CLIENT_SIDE_OPERATORS:
+                self.query_cache[key] = self._run_genomic_query(g, neg, sv)
+                round_trips += 1
+                continue
+
+            by_gene.setdefault(hugo['$eq'], []).append(key)
+            fields.update(query_fields_)
+
+        # projection that covers both the query fields and the fields copied into the matches
+        proj = dict.fromkeys(fields | set(MATCH_PROJECTION), 1)
+        results = dict((key, []) for keys in by_gene.itervalues() for key in keys)
+
+        genes = sorted(by_gene)
+        for i in range(0, len(genes), batch_size):
+            for doc in self.db.genomic.find({'TRUE_HUGO_SYMBOL': {'$in': genes[i:i + batch_size]}}, proj):
+                for key in by_gene.get(doc.get('TRUE_HUGO_SYMBOL'), []):
+                    if match_document(doc, leaves[key][0]):
+                        results[key].append(doc)
+            round_trips += 1
+
+        for key, docs in results.iteritems():
+            g, neg, sv = leaves[key]
+            self.query_cache[key] = self._run_genomic_query(g, neg, sv, results=docs)
+
+        return round_trips
+
+    def _plan_clinical_queries(self, leaves):
+        """
+        Executes clinical leaves client-side against a single read of the clinical collection and stores the
+        results in the query cache
+
+        :param leaves: Dictionary mapping cache keys to prepared clinical queries
+        :return: Number of round trips
+        """
+
+        round_trips = 0
+        client_side = {}
+        fields = set(['SAMPLE_ID'])
+
+        for key, c in leaves.iteritems():
+            query_fields_, operators = query_fields(c)
+            if len(c.keys()) == 0 or not operators <= CLIENT_SIDE_OPERATORS:
+                self.query_cache[key] = self._run_clinical_query(c)
+                round_trips += int(len(c.keys()) > 0)
+            else:
+                client_side[key] = c
+                fields.update(query_fields_)
+
+        if not client_side:
+            return round_trips
+
+        # group documents by diagnosis, or by oncotree ancestor, so that most leaves only look at a handful of
+        # candidates
+        diagnosis = 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME'
+        clinical = list(self.db.clinical.find({}, dict.fromkeys(fields, 1)))
+        by_diagnosis = {}
+        unindexed = []
+        for doc in clinical:
+            if isinstance(doc.get(diagnosis), basestring):
+                by_diagnosis.setdefault(doc[diagnosis], []).append(doc)
+            else:
+                unindexed.append(doc)
+
+        by_ancestor = {}
+        unindexed_ancestors = []
+        if ONCOTREE_ANCESTORS in fields:
+            for doc in clinical:
+                if isinstance(doc.get(ONCOTREE_ANCESTORS), list):
+                    for code in doc[ONCOTREE_ANCESTORS]:
+                        by_ancestor.setdefault(code, []).append(doc)
+                else:
+                    unindexed_ancestors.append(doc)
+        round_trips += 1
+
+        for key, c in client_side.iteritems():
+            candidates = clinical
+            if isinstance(c.get(diagnosis), dict) and '$in' in c[diagnosis]:
+                candidates = unindexed + [doc for name in set(c[diagnosis]['$in'])
+                                          for doc in by_diagnosis.get(name, [])]
+            elif isinstance(c.get(ONCOTREE_ANCESTORS), dict) and '$in' in c[ONCOTREE_ANCESTORS]:
+                candidates = unindexed_ancestors + [doc for code in set(c[ONCOTREE_ANCESTORS]['$in'])
+                                                    for doc in by_ancestor.get(code, [])]
+
+            self.query_cache[key] = (self.samples.mask(doc['SAMPLE_ID'] for doc in candidates
+                                                       if 'SAMPLE_ID' in doc and match_document(doc, c)), [])
+
+        return round_trips
 
     def traverse_match_tree(self, g):
         """ Finds matches for a given match tree
 
+        Children of and/or nodes are evaluated in order of their estimated selectivity and the evaluation stops
+        as soon as an and node is empty or an or node contains every sample. Genomic leaves that were skipped
+        are only executed when the tree has matches, to add their genomic information to the matched samples.
+
         :param g: diGraph match tree
         :return: match set for a tree
         """
 
-        tree_genomic = {}
-        for node_id in list(nx.dfs_postorder_nodes(g, source=1)):
+        leaves = {}
+        skipped = []
+        estimates = {}
+        mask = self._evaluate_node(g, 1, leaves, skipped, estimates)
 
-            # get node and its child
-            node = g.node[node_id]
-            successors = g.successors(node_id)
+        final_sample_ids = self.samples.to_set(mask)
 
-            # if leaf node then execute query
-            if len(successors) == 0:
-                matched_sample_ids, matched_genomic_info = self.run_query(node)
+        if final_sample_ids:
+            for node_id in skipped:
+                key = self._cached_query(g.node[node_id])
+                leaves[node_id] = self.query_cache[key]
 
-                node['matched_sample_ids'] = matched_sample_ids
-                node['matched_genomic_info'] = matched_genomic_info
+        # genomic information is only gathered for the final samples, in the order of the leaves
+        tree_genomic = dict((sample_id, []) for sample_id in final_sample_ids)
+        for node_id in nx.dfs_postorder_nodes(g, source=1):
+            if node_id not in leaves:
+                continue
 
-                for match in node['matched_genomic_info']:
-                    if match['sample_id'] not in tree_genomic:
-                        tree_genomic[match['sample_id']] = [match]
-                    else:
-                        tree_genomic[match['sample_id']].append(match)
+            leaf_mask, matched_genomic_info = leaves[node_id]
+            for match in self._expand_genomic_info(leaf_mask, matched_genomic_info, final_sample_ids):
+                tree_genomic[match['sample_id']].append(match)
+
+        final_genomic_infos = [tree_genomic[i] for i in final_sample_ids]
+
+        return final_sample_ids, final_genomic_infos
+
+    def _evaluate_node(self, g, node_id, leaves, skipped, estimates):
+        """
+        Evaluates a node of a match tree
 
-            # else apply logic based on and/or
+        :param g: diGraph match tree
+        :param node_id: node to evaluate
+        :param leaves: Dictionary collecting the cached results of every executed leaf
+        :param skipped: List collecting the genomic leaves that were skipped
+        :param estimates: Dictionary of estimated node sizes
+        :return: mask of matched samples
+        """
+
+        # get node and its child
+        node = g.node[node_id]
+        successors = g.successors(node_id)
+
+        # if leaf node then execute query
+        if len(successors) == 0:
+            key = self._cached_query(node)
+            if key is None:
+                node['matched_sample_ids'] = self.samples.empty()
             else:
+                node['matched_sample_ids'] = self.query_cache[key][0]
+                leaves[node_id] = self.query_cache[key]
+
+            return node['matched_sample_ids']
+
+        # and nodes start with their most selective child, or nodes with their least selective one
+        if node['type'] in ['and', 'or']:
+            successors = sorted(successors, key=lambda child: self._estimate_node(g, child, estimates),
+                                reverse=node['type'] == 'or')
+
+        mask = None
+        for i, child in enumerate(successors):
+            child_mask = self.samples.resize(self._evaluate_node(g, child, leaves, skipped, estimates))
+
+            if mask is None:
+                mask = child_mask.copy()
+            elif node['type'] == 'and':
+                mask = self.samples.resize(mask)
+                mask &= child_mask
+            elif node['type'] == 'or':
+                mask = self.samples.resize(mask)
+                mask |= child_mask
+
+            # the remaining children can not change the result. Samples without a clinical document have no MRN
+            # to report a match for, so an or node is complete once it contains every clinical sample.
+            if (node['type'] == 'and' and not mask.any()) or (node['type'] == 'or' and self.samples.covers(mask)):
+                for sibling in successors[i + 1:]:
+                    skipped.extend(n for n in nx.dfs_postorder_nodes(g, source=sibling)
+                                   if not g.successors(n) and g.node[n]['type'] == 'genomic')
+                break
+
+        node['matched_sample_ids'] = mask
+        return mask
+
+    def _estimate_node(self, g, node_id, estimates):
+        """
+        Estimates the number of samples matching a node of a match tree. Leaves that were already executed
+        are exact, other leaves are estimated from the number of genomic documents per gene and the number of
+        clinical documents per diagnosis.
 
-                node['matched_sample_ids'] = set([])
-                node['matched_sample_ids'].update(g.node[successors[0]]['matched_sample_ids'])
-                node['matched_genomic_info'] = g.node[successors[0]]['matched_genomic_info']
+        :param g: diGraph match tree
+        :param node_id: node to estimate
+        :param estimates: Dictionary of estimated node sizes
+        :return: estimated number of matching samples
+        """
 
-                for i in range(1, len(successors)):
-                    s_list = g.node[successors[i]]['matched_sample_ids']
+        if node_id in estimates:
+            return estimates[node_id]
 
-                    if node['type'] == 'and':
-                        node['matched_sample_ids'].intersection_update(s_list)
+        node = g.node[node_id]
+        successors = g.successors(node_id)
+        universe = self.samples.universe
 
-                    elif node['type'] == 'or':
-                        node['matched_sample_ids'].update(s_list)
+        if successors:
+            sizes = [self._estimate_node(g, child, estimates) for child in successors]
+            if node['type'] == 'and':
+                estimate = min(sizes)
+            else:
+                estimate = min(universe, sum(sizes))
 
-        final_sample_ids = g.node[1]['matched_sample_ids']
-        final_genomic_infos = [tree_genomic[i] for i in final_sample_ids]
+        else:
+            leaf = self._prepare_leaf(node)
+            if leaf is None:
+                estimate = 0
+            elif leaf[0] in self.query_cache:
+                estimate = int(self.query_cache[leaf[0]][0].sum())
+            elif node['type'] == 'genomic':
+                estimate = self._estimate_genomic(leaf[1], leaf[2])
+            else:
+                estimate = self._estimate_clinical(leaf[1])
 
-        return final_sample_ids, final_genomic_infos
+        estimates[node_id] = estimate
+        return estimate
+
+    def _estimate_genomic(self, g, neg):
+        """Estimates the number of samples matching a genomic query from the number of documents per gene"""
+
+        universe = self.samples.universe
+        criteria = g['$and'][0] if '$and' in g else g
+        hugo = criteria.get('TRUE_HUGO_SYMBOL')
+
+        if not isinstance(hugo, dict) or hugo.keys() != ['$eq']:
+            return universe
+
+        estimate = min(universe, self._statistics()['genomic'].get(hugo['$eq'], 0))
+        if neg:
+            return universe - estimate
+        return estimate
+
+    def _estimate_clinical(self, c):
+        """Estimates the number of samples matching a clinical query from the number of documents per diagnosis"""
+
+        for field in ['ONCOTREE_PRIMARY_DIAGNOSIS_NAME', ONCOTREE_ANCESTORS]:
+            diagnosis = c.get(field)
+            if isinstance(diagnosis, dict) and diagnosis.keys() == ['$in']:
+                counts = self._statistics()[field]
+                return min(self.samples.universe, sum(counts.get(name, 0) for name in set(diagnosis['$in'])
+                                                      if isinstance(name, basestring)))
+
+        return self.samples.universe
+
+    def _statistics(self):
+        """Counts the genomic documents per gene and the clinical documents per diagnosis, once per run"""
+
+        if self.statistics is None:
+            self.statistics = {
+                'genomic': self._count_by(self.db.genomic, 'TRUE_HUGO_SYMBOL'),
+                'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': self._count_by(self.db.clinical, 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME'),
+                ONCOTREE_ANCESTORS: {}
+            }
+
+            if self.oncotree_paths:
+                self.statistics[ONCOTREE_ANCESTORS] = self._count_by(self.db.clinical, ONCOTREE_ANCESTORS, True)
+
+        return self.statistics
+
+    @staticmethod
+    def _count_by(collection, field, unwind=False):
+        """Returns the number of documents per value of a field; array fields are counted per element"""
+
+        pipeline = [{'$group': {'_id': '$' + field, 'count': {'$sum': 1}}}]
+        if unwind:
+            pipeline.insert(0, {'$unwind': '$' + field})
+
+        return dict((item['_id'], item['count']) for item in collection.aggregate(pipeline))
 
     def prepare_clinical_criteria(self, item):
         """
@@ -412,7 +872,7 @@ class MatchEngine(object):
         for field in item:
 
             # this maps yaml field names to those stored in the database through the database collection "map"
-            norm_field, _ = normalize_fields(self.mapping, field)
+            norm_field, _ = self.field_map.field(field)
             txt = item[field]
 
             # this constructs the mongo query
@@ -420,11 +880,19 @@ class MatchEngine(object):
 
         # stolen Jimbo's code for adding all the oncotree nodes
         if 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME' in c:
-            c['ONCOTREE_PRIMARY_DIAGNOSIS_NAME'] = self._search_oncotree_diagnosis(onco_tree, c)
+            paths = None
+            if self.oncotree_paths:
+                paths = self._search_oncotree_ancestors(onco_tree, c)
+
+            if paths is not None:
+                del c['ONCOTREE_PRIMARY_DIAGNOSIS_NAME']
+                c.update(paths)
+            else:
+                c['ONCOTREE_PRIMARY_DIAGNOSIS_NAME'] = self._search_oncotree_diagnosis(onco_tree, c)
 
         # translate yaml age restrictions into proper mongo query dates
         if 'BIRTH_DATE' in c:
-            c['BIRTH_DATE'] = search_birth_date(c)
+            c['BIRTH_DATE'] = search_birth_date(c, self.today)
 
         return c
 
@@ -457,7 +925,7 @@ class MatchEngine(object):
         for field, val in item.iteritems():
 
             # this maps the yaml field names to those stored in the database through the database collection "map"
-            norm_field, norm_val = normalize_values(self.mapping, field, val)
+            norm_field, norm_val = self.field_map.value(field, val)
             txt = norm_val
 
             # this constructs the mongo query
@@ -485,12 +953,17 @@ class MatchEngine(object):
 
         return g, track_neg, track_sv
 
-    def find_trial_matches(self):
+    def find_trial_matches(self, plan=True, workers=1, mongo_uri=None, mode='swap'):
         """
         Iterates through all match clauses of all trials located in the database and matches patients to trials
         based on their clinical and genomic documents.
 
-        :return: Dictionary containing matches
+        :param plan: Boolean flag; when true, all leaf queries are executed in batches before matching
+        :param workers: Number of processes the trials are split across
+        :param mongo_uri: Mongo URI the worker processes connect to
+        :param mode: "swap" replaces the trial_match collection with a single rename, "incremental" only writes
+            the matches that changed since the previous run
+        :return: Number of documents written to the trial_match collection
         """
 
         # all MRNs and trials in the database
@@ -501,11 +974,46 @@ class MatchEngine(object):
         # create a map between sample id and MRN
         mrn_map = samples_from_mrns(self.db, mrns)
 
+        # start every run with an empty query cache and have every process match against the same reference date
+        self.today = reference_date()
+        self.query_cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.statistics = None
+        self.clinical_cache = {}
+
+        # matches are written to a staging collection as trials finish and swapped in once they are sorted
+        writer = MatchWriter(self.db, mode=mode)
+        if workers > 1 and len(all_trials) > 1:
+            self._match_trials_parallel(all_trials, mrn_map, plan, workers, mongo_uri, writer)
+        else:
+            self.match_trials(all_trials, mrn_map, plan, writer)
+
+        count = writer.close()
+        logging.info('Number of trial matches: %s' % str(count))
+        return writer.inserted + writer.updated + writer.deleted
+
+    def match_trials(self, trials, mrn_map, plan=True, writer=None):
+        """
+        Finds the matches at the step, arm, and dose levels of the given trials
+
+        :param trials: List of trial documents
+        :param mrn_map: Dictionary mapping patient sample ids to MRNs
+        :param plan: Boolean flag; when true, all leaf queries are executed in batches before matching
+        :param writer: Optional MatchWriter that receives the matches of each trial as soon as it is matched
+        :return: List of trial matches in trial order, empty when a writer is given
+        """
+
+        # execute all leaf queries up front
+        if plan:
+            logging.info('Planning leaf queries.')
+            self.plan_queries(trials)
+
         # initialize trial matches
         trial_matches = []
 
         # for all trials check for matches on the dose, arm, and step levels and keep track of what is found
-        for trial in all_trials:
+        for trial in trials:
 
             logging.info('Matching trial %s' % trial['protocol_no'])
 
@@ -532,20 +1040,42 @@ class MatchEngine(object):
                         if 'match' in dose:
                             trial_matches = self._assess_match(mrn_map, trial_matches, trial, dose, 'dose', trial_status)
 
-        trial_match_df = pd.DataFrame.from_dict(trial_matches)
+            if writer is not None:
+                writer.write(trial_matches)
+                trial_matches = []
+
+        logging.info('Query cache: %d hits, %d misses' % (self.cache_hits, self.cache_misses))
+
+        return trial_matches
+
+    def _match_trials_parallel(self, trials, mrn_map, plan, workers, mongo_uri, writer):
+        """
+        Splits the trials into contiguous chunks that are matched by a pool of worker processes, each with its
+        own Mongo client and engine. Chunks are written in trial order so the result equals a serial run.
 
-        # force garbage collector to remove unused object after conversion to df
-        del trial_matches
-        gc.collect()
+        :param trials: List of trial documents
+        :param mrn_map: Dictionary mapping patient sample ids to MRNs
+        :param plan: Boolean flag; when true, all leaf queries are executed in batches before matching
+        :param workers: Number of worker processes
+        :param mongo_uri: Mongo URI the worker processes connect to
+        :param writer: MatchWriter that receives the matches of each chunk as soon as it is matched
+        """
 
-        # sort
-        logging.info('Sorting trial matches.')
-        trial_matches_df = add_sort_order(trial_match_df)
-        logging.info('Number of trial matches: %s' % str(trial_match_df.shape[0]))
+        # several chunks per worker so that a few large trials do not leave the other workers idle
+        chunk_size = max(1, len(trials) // (workers * 4))
+        chunks = [trials[i:i + chunk_size] for i in range(0, len(trials), chunk_size)]
+        logging.info('Matching %d trials in %d chunks across %d workers' % (len(trials), len(chunks), workers))
 
-        # add to db
-        logging.info('Adding trial matches to database')
-        add_matches(trial_matches_df, self.db)
+        # the in-memory genomic store, when loaded, reaches the forked workers without being copied or reloaded
+        pool = multiprocessing.Pool(processes=min(workers, len(chunks)), initializer=_init_match_worker,
+                                    initargs=(mongo_uri, self.genomic_store, self.field_map, self.today, mrn_map,
+                                              plan))
+        try:
+            for chunk in pool.imap(_match_worker, chunks, chunksize=1):
+                writer.write(chunk)
+        finally:
+            pool.close()
+            pool.join()
 
     def _assess_match(self, mrn_map, trial_matches, trial, trial_segment, match_segment, trial_status):
         """
@@ -565,20 +1095,7 @@ class MatchEngine(object):
         match_tree = self.create_match_tree(trial_segment['match'][0])
         sample_ids, ginfos = self.traverse_match_tree(match_tree)
 
-        clinical = []
-        if sample_ids:
-            cproj = {
-                    'SAMPLE_ID': 1,
-                    'ORD_PHYSICIAN_NAME': 1,
-                    'ORD_PHYSICIAN_EMAIL': 1,
-                    'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': 1,
-                    'REPORT_DATE': 1,
-                    'VITAL_STATUS': 1,
-                    'FIRST_LAST': 1,
-                    'GENDER': 1,
-                    '_id': 1
-                }
-            clinical = list(self.db.clinical.find({'SAMPLE_ID': {'$in': list(sample_ids)}}, cproj))
+        clinical = self._clinical_documents(sample_ids)
 
         # add to master list if any sample ids matched
         for sample in ginfos:
@@ -598,14 +1115,12 @@ class MatchEngine(object):
                         match[trial_key] = trial[trial_key]
 
                 # copy clinical document
-                if clinical:
-                    for citem in clinical:
-                        if citem['SAMPLE_ID'] == alteration['sample_id']:
-                            for field in citem:
-                                if field == '_id':
-                                    match['clinical_id'] = citem[field]
-                                else:
-                                    match[field.lower()] = citem[field]
+                for citem in clinical.get(alteration['sample_id'], []):
+                    for field in citem:
+                        if field == '_id':
+                            match['clinical_id'] = citem[field]
+                        else:
+                            match[field.lower()] = citem[field]
 
                 # add internal id
                 if match_segment == 'dose':
@@ -627,10 +1142,41 @@ class MatchEngine(object):
 
         return trial_matches
 
+    def _clinical_documents(self, sample_ids):
+        """
+        Returns the clinical fields copied into the match documents of the given samples. Samples are
+        fetched from the database the first time they match and served from the per-run cache afterwards.
+
+        :param sample_ids: Set of matching sample ids
+        :return: Dictionary mapping each sample id to its clinical documents
+        """
+
+        missing = [sample_id for sample_id in sample_ids if sample_id not in self.clinical_cache]
+        if missing:
+            cproj = {
+                    'SAMPLE_ID': 1,
+                    'ORD_PHYSICIAN_NAME': 1,
+                    'ORD_PHYSICIAN_EMAIL': 1,
+                    'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': 1,
+                    'REPORT_DATE': 1,
+                    'VITAL_STATUS': 1,
+                    'FIRST_LAST': 1,
+                    'GENDER': 1,
+                    '_id': 1
+                }
+            for sample_id in missing:
+                self.clinical_cache[sample_id] = []
+            for citem in self.db.clinical.find({'SAMPLE_ID': {'$in': missing}}, cproj):
+                self.clinical_cache[citem['SAMPLE_ID']].append(citem)
+
+        return self.clinical_cache
+
     @staticmethod
     def _search_oncotree_diagnosis(onco_tree, c):
         """Add all the oncotree nodes """
 
+        index = oncotree_index(onco_tree)
+
         nodes = []
         tmpc = {'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': {}}
         for key in c['ONCOTREE_PRIMARY_DIAGNOSIS_NAME'].keys():
@@ -643,31 +1189,20 @@ class MatchEngine(object):
             for txt in diagnoses:
                 if txt.endswith("_LIQUID_") or txt.endswith("_SOLID_"):
 
-                    # build the nodes for liquid.
-                    node1 = oncotreenx.lookup_text(onco_tree, "Lymph")
-                    node2 = oncotreenx.lookup_text(onco_tree, "Blood")
-
-                    nodes1 = list(nx.dfs_tree(onco_tree, node1))
-                    nodes2 = list(nx.dfs_tree(onco_tree, node2))
-                    nodes = list(set(nodes1).union(set(nodes2)))
-
-                    # if its really solid take the inverse.
+                    # liquid tumors are below lymph and blood, solid tumors are everything else
                     if txt == "_SOLID_":
-                        all_nodes = set(list(onco_tree.nodes()))
-                        tmp_nodes = all_nodes - set(nodes)
-                        nodes = list(tmp_nodes)
+                        nodes = index.solid
+                    else:
+                        nodes = index.liquid
 
                 else:
-                    # get tree node.
-                    node = oncotreenx.lookup_text(onco_tree, txt)
-
-                    # get its children.
-                    if onco_tree.has_node(node):
-                        # list of nodes.
-                        nodes = list(nx.dfs_tree(onco_tree, node))
+                    # get the tree node and its children.
+                    descendants = index.descendants(txt)
+                    if descendants is not None:
+                        nodes = descendants
 
-                        # replace it with free text.
-                nodes_txt = [onco_tree.node[n]['text'] for n in nodes]
+                # the index is shared, the lists below are extended in place
+                nodes_txt = list(nodes)
 
                 if key == '$eq':
                     key = '$in'
@@ -692,6 +1227,46 @@ class MatchEngine(object):
 
         return tmpc['ONCOTREE_PRIMARY_DIAGNOSIS_NAME']
 
+    @staticmethod
+    def _search_oncotree_ancestors(onco_tree, c):
+        """
+        Translates diagnosis criteria into criteria on the oncotree ancestors and tumor types stored on clinical
+        documents by "materialize_oncotree". A document matches a diagnosis when the diagnosis' node is one of
+        its ancestors.
+
+        :param onco_tree: oncotree built by "build_oncotree"
+        :param c: Mongo query for clinical collection
+        :return: Mongo criteria, or None when they can not be expressed on the materialized fields
+        """
+
+        index = oncotree_index(onco_tree)
+
+        paths = {}
+        for key, diagnoses in c['ONCOTREE_PRIMARY_DIAGNOSIS_NAME'].iteritems():
+            if not isinstance(diagnoses, list):
+                diagnoses = [diagnoses]
+
+            op = '$nin' if key in ['$ne', '$nin'] else '$in'
+            for txt in diagnoses:
+                if txt.endswith("_LIQUID_") or txt.endswith("_SOLID_"):
+                    field = ONCOTREE_TUMOR_TYPE
+                    values = ['solid' if txt == "_SOLID_" else 'liquid']
+                else:
+                    field = ONCOTREE_ANCESTORS
+                    values = [index.nodes[txt]] if txt in index.nodes else []
+
+                paths.setdefault(field, {}).setdefault(op, []).extend(values)
+
+        # a diagnosis or a tumor type would need an "$or" across both fields
+        if len([name for name in paths if '$in' in paths[name]]) > 1:
+            return None
+
+        for field in paths:
+            for op in paths[field]:
+                paths[field][op] = sorted(set(paths[field][op]))
+
+        return paths
+
     def _recursive_create(self, parent_id, data, G):
         child_id_set = ['protocol_id', 'arm_internal_id', 'level_internal_id', 'step_internal_id']
         key_set = set(['treatment_list', 'step', 'arm', 'dose_level'])
@@ -743,4 +1318,30 @@ class MatchEngine(object):
             match_tree = self.create_match_tree(content)
 
             # embed it in trial tree.
-            G.node[n]['match_tree'] = match_tree
\ No newline at end of file
+            G.node[n]['match_tree'] = match_tree
+
+
+# state of a match worker process, set once by "_init_match_worker"
+_worker = {}
+
+
+def _init_match_worker(mongo_uri, genomic_store, field_map, today, mrn_map, plan):
+    """
+    Opens a Mongo client and creates a matchengine in a freshly started worker process. Workers are forked from
+    the parent, so its in-memory genomic store is shared copy-on-write instead of being loaded again. The
+    client is closed when the pool shuts the worker down.
+    """
+
+    Finalize(None, close_clients, exitpriority=10)
+    me = MatchEngine(get_db(mongo_uri), bootstrap=False, field_map=field_map, genomic_store=genomic_store)
+    me.today = today
+
+    _worker['me'] = me
+    _worker['mrn_map'] = mrn_map
+    _worker['plan'] = plan
+
+
+def _match_worker(trials):
+    """Matches a chunk of trials in a worker process"""
+    return _worker['me'].match_trials(trials, _worker['mrn_map'], _worker['plan'])
+
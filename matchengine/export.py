@@ -0,0 +1,259 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import csv
+import gzip
+import math
+import logging
+import itertools
+from collections import OrderedDict
+from bson import json_util
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# trial match fields written to the results file
+EXPORT_FIELDS = [
+    'mrn',
+    'sample_id',
+    'first_last',
+    'protocol_no',
+    'nct_id',
+    'genomic_alteration',
+    'tier',
+    'match_type',
+    'trial_accrual_status',
+    'match_level',
+    'code',
+    'internal_id',
+    'ord_physician_name',
+    'ord_physician_email',
+    'vital_status',
+    'oncotree_primary_diagnosis_name',
+    'true_hugo_symbol',
+    'true_protein_change',
+    'true_variant_classification',
+    'variant_category',
+    'report_date',
+    'chromosome',
+    'position',
+    'true_cdna_change',
+    'reference_allele',
+    'true_transcript_exon',
+    'canonical_strand',
+    'allele_fraction',
+    'cnv_call',
+    'wildtype',
+    '_id'
+]
+
+EXPORT_FORMATS = ['csv', 'json', 'parquet']
+
+COMPRESSIONS = ['gzip', 'zstd']
+
+# file extension of every format and compression
+EXTENSIONS = {'csv': 'csv', 'json': 'json', 'parquet': 'parquet', 'gzip': 'gz', 'zstd': 'zst'}
+
+# number of trial matches fetched per round trip and written per Parquet row group
+EXPORT_BATCH_SIZE = 5000
+
+# typed Parquet columns, all other columns are strings
+PARQUET_TYPES = {
+    'tier': 'int64',
+    'position': 'int64',
+    'true_transcript_exon': 'int64',
+    'allele_fraction': 'double',
+    'wildtype': 'bool'
+}
+
+
+def export_path(outpath, file_format, compression=None):
+    """
+    :param outpath: Path of the results file without extension
+    :param file_format: "csv", "json" or "parquet"
+    :param compression: None, "gzip" or "zstd", Parquet files are compressed internally
+    :return: Path with the extension of the format and compression
+    """
+
+    path = '%s.%s' % (outpath, EXTENSIONS[file_format])
+    if compression and file_format != 'parquet':
+        path = '%s.%s' % (path, EXTENSIONS[compression])
+    return path
+
+
+def export_query(open_only=False, mrns=None):
+    """
+    :param open_only: Boolean flag; when true, only matches to open trials are exported
+    :param mrns: List of MRNs whose matches are exported, all when None
+    :return: Mongo query of the exported trial matches
+    """
+
+    query = {}
+    if open_only:
+        query['trial_accrual_status'] = 'open'
+    if mrns:
+        query['mrn'] = {'$in': list(mrns)}
+    return query
+
+
+def iter_matches(db, query=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    :param db: Mongo database
+    :param query: Mongo query of the exported trial matches
+    :param batch_size: Number of trial matches fetched per round trip
+    :return: Cursor over the exported fields of the trial matches
+    """
+
+    projection = dict((field, 1) for field in EXPORT_FIELDS)
+    return db.trial_match.find(query or {}, projection).batch_size(batch_size)
+
+
+def export_matches(matches, path, file_format='csv', compression=None, fields=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Streams trial matches into a CSV, newline delimited JSON or Parquet file. Fields a match does not have
+    are written as empty values.
+
+    :param matches: Iterable of trial match dictionaries, e.g. a cursor of "iter_matches"
+    :param path: Path of the results file
+    :param file_format: "csv", "json" or "parquet"
+    :param compression: None, "gzip" or "zstd". Parquet files are compressed per column instead of as a whole.
+    :param fields: List of exported fields, EXPORT_FIELDS when None
+    :param batch_size: Number of trial matches per Parquet row group
+    :return: Number of exported trial matches
+    """
+
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError('Unknown export format %s' % file_format)
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression %s' % compression)
+
+    fields = fields or EXPORT_FIELDS
+    if file_format == 'parquet':
+        count = _write_parquet(matches, path, fields, compression, batch_size)
+    else:
+        f, raw = _open(path, compression)
+        try:
+            if file_format == 'csv':
+                count = _write_csv(matches, f, fields)
+            else:
+                count = _write_json(matches, f, fields)
+        finally:
+            f.close()
+            raw.close()
+
+    logging.info('Exported %d trial matches to %s' % (count, path))
+    return count
+
+
+def _open(path, compression):
+    raw = open(path, 'wb')
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='wb'), raw
+    elif compression == 'zstd':
+        if zstandard is None:
+            raw.close()
+            raise ImportError('zstd compression requires zstandard')
+        return zstandard.ZstdCompressor().stream_writer(raw), raw
+    return raw, raw
+
+
+def _write_csv(matches, f, fields):
+    writer = csv.writer(f)
+    writer.writerow(fields)
+
+    count = 0
+    for match in matches:
+        writer.writerow([_csv_value(match.get(field)) for field in fields])
+        count += 1
+    return count
+
+
+def _csv_value(val):
+    if val is None or (isinstance(val, float) and math.isnan(val)):
+        return ''
+    elif isinstance(val, bool):
+        return 'true' if val else 'false'
+    elif isinstance(val, unicode):
+        return val.encode('utf-8')
+    elif isinstance(val, (int, long, float)):
+        return val
+    return str(val)
+
+
+def _write_json(matches, f, fields):
+    count = 0
+    for match in matches:
+        doc = OrderedDict((field, match.get(field)) for field in fields)
+        f.write(json_util.dumps(doc) + '\n')
+        count += 1
+    return count
+
+
+def _write_parquet(matches, path, fields, compression, batch_size):
+    if pa is None:
+        raise ImportError('Writing Parquet files requires pyarrow')
+
+    schema = pa.schema([pa.field(field, pa.type_for_alias(PARQUET_TYPES.get(field, 'string'))) for field in fields])
+    writer = pq.ParquetWriter(path, schema, compression=compression or 'snappy')
+
+    count = 0
+    matches = iter(matches)
+    try:
+        while True:
+            batch = list(itertools.islice(matches, batch_size))
+            if not batch:
+                break
+
+            arrays = []
+            for field in fields:
+                kind = PARQUET_TYPES.get(field, 'string')
+                arrays.append(pa.array([_parquet_value(match.get(field), kind) for match in batch],
+                                       type=pa.type_for_alias(kind)))
+
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            count += len(batch)
+    finally:
+        writer.close()
+
+    return count
+
+
+def _parquet_value(val, kind):
+    if val is None or (isinstance(val, float) and math.isnan(val)):
+        return None
+
+    try:
+        if kind == 'int64':
+            return int(val)
+        elif kind == 'double':
+            return float(val)
+        elif kind == 'bool':
+            return bool(val)
+    except (TypeError, ValueError):
+        return None
+
+    return val if isinstance(val, basestring) else str(val)
+
+
+def export_results(db, path, file_format='csv', compression=None, open_only=False, mrns=None):
+    """
+    Exports the trial matches that pass the filters
+
+    :param db: Mongo database
+    :param path: Path of the results file
+    :param file_format: "csv", "json" or "parquet"
+    :param compression: None, "gzip" or "zstd"
+    :param open_only: Boolean flag; when true, only matches to open trials are exported
+    :param mrns: List of MRNs whose matches are exported, all when None
+    :return: Number of exported trial matches
+    """
+
+    matches = iter_matches(db, export_query(open_only, mrns))
+    return export_matches(matches, path, file_format, compression)
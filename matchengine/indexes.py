@@ -0,0 +1,236 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import logging
+import itertools
+
+from matchengine.engine import MatchEngine
+from matchengine.utilities import iter_match_segments, ONCOTREE_ANCESTORS, ONCOTREE_TUMOR_TYPE
+
+# operators the query planner can answer with an exact index lookup
+EQUALITY_OPERATORS = ['$eq', '$in', '$all']
+
+# operators that scan a range of index keys
+RANGE_OPERATORS = ['$gt', '$gte', '$lt', '$lte', '$regex']
+
+# how a field is filtered, from most to least selective for an index
+KINDS = ['eq', 'range', 'other']
+
+# array fields, a compound index may contain only one of them
+ARRAY_FIELDS = [ONCOTREE_ANCESTORS, ONCOTREE_TUMOR_TYPE]
+
+# most indexes advised per collection, each index slows down loading
+MAX_INDEXES = 10
+
+# queries the engine issues regardless of the trials: samples by MRN and by SAMPLE_ID, and genomic documents by gene
+FIXED_QUERIES = [
+    ('clinical', {'MRN': {'$in': []}}),
+    ('clinical', {'SAMPLE_ID': {'$in': []}}),
+    ('genomic', {'TRUE_HUGO_SYMBOL': {'$in': []}})
+]
+
+
+def query_shapes(query):
+    """
+    Reduces a query to the fields it filters on and how it filters them. A query with an "$or" has one shape
+    per branch.
+
+    :param query: Mongo query
+    :return: List of shapes, each a sorted tuple of (field, kind) where kind is "eq", "range" or "other"
+    """
+
+    # alternative shapes of every part of the conjunction
+    parts = []
+    for field, val in query.iteritems():
+        if field == '$and':
+            parts.extend(query_shapes(q) for q in val)
+        elif field == '$or':
+            parts.append([shape for q in val for shape in query_shapes(q)])
+        else:
+            parts.append([((field, _kind(val)), )])
+
+    shapes = []
+    for combination in itertools.product(*parts):
+        fields = {}
+        for shape in combination:
+            for field, kind in shape:
+                fields[field] = min(fields.get(field, kind), kind, key=KINDS.index)
+
+        shape = tuple(sorted(fields.iteritems()))
+        if shape and shape not in shapes:
+            shapes.append(shape)
+
+    return shapes
+
+
+def _kind(val):
+    if not isinstance(val, dict):
+        return 'eq'
+
+    kinds = []
+    for op, arg in val.iteritems():
+        if op in EQUALITY_OPERATORS or (op == '$exists' and not arg):
+            kinds.append('eq')
+        elif op in RANGE_OPERATORS:
+            kinds.append('range')
+        else:
+            kinds.append('other')
+
+    return min(kinds, key=KINDS.index) if kinds else 'eq'
+
+
+def collect_query_shapes(me, trials):
+    """
+    Derives the shapes of the queries the engine issues for the leaves of the given trials' match trees
+
+    :param me: MatchEngine
+    :param trials: List of trial documents
+    :return: Dictionary mapping (collection, shape) to an example query and the number of leaves with that shape
+    """
+
+    shapes = {}
+
+    def add(collection, query):
+        for shape in query_shapes(query):
+            example, count = shapes.get((collection, shape), (query, 0))
+            shapes[(collection, shape)] = (example, count + 1)
+
+    for collection, query in FIXED_QUERIES:
+        add(collection, query)
+
+    for trial in trials:
+        for segment in iter_match_segments(trial):
+            match_tree = me.create_match_tree(segment['match'][0])
+            for node_id in match_tree.nodes():
+                if match_tree.successors(node_id):
+                    continue
+
+                node = match_tree.node[node_id]
+                if node['type'] == 'genomic':
+                    add('genomic', me.prepare_genomic_criteria(node['value'])[0])
+                elif node['type'] == 'clinical':
+                    add('clinical', me.prepare_clinical_criteria(node['value']))
+
+    return shapes
+
+
+def index_for_shape(shape, frequency=None):
+    """
+    Orders the fields of a shape into index keys: equality fields first, then range fields. Fields of the same
+    kind are ordered by how many shapes use them, so that indexes share prefixes. Fields filtered otherwise
+    (e.g. "$ne", "$nin") do not bound the index scan and are left out.
+
+    :param shape: Tuple of (field, kind)
+    :param frequency: Dictionary mapping field to the number of shapes it appears in
+    :return: List of (field, 1) index keys, empty when no field can be looked up in an index
+    """
+
+    frequency = frequency or {}
+    fields = sorted([(field, kind) for field, kind in shape if kind != 'other'],
+                    key=lambda x: (KINDS.index(x[1]), -frequency.get(x[0], 0), x[0]))
+
+    keys = []
+    array = False
+    for field, _ in fields:
+        if field in ARRAY_FIELDS:
+            if array:
+                continue
+            array = True
+        keys.append((field, 1))
+
+    return keys
+
+
+def advise_indexes(db, shapes):
+    """
+    :param db: Mongo database
+    :param shapes: Dictionary mapping (collection, shape) to the number of leaves with that shape
+    :return: List of (collection, index keys) of the indexes that are missing, leaving out indexes that are a
+        prefix of an existing or another advised index. At most MAX_INDEXES per collection, for the shapes
+        with the most leaves.
+    """
+
+    frequency = {}
+    for collection, shape in shapes:
+        for field, kind in shape:
+            if kind != 'other':
+                frequency[(collection, field)] = frequency.get((collection, field), 0) + 1
+
+    advised = {}
+    leaves = {}
+    for (collection, shape), count in shapes.iteritems():
+        counts = dict((field, n) for (c, field), n in frequency.iteritems() if c == collection)
+        keys = tuple(index_for_shape(shape, counts))
+        if keys:
+            advised.setdefault(collection, set()).add(keys)
+            leaves[(collection, keys)] = leaves.get((collection, keys), 0) + count
+
+    indexes = []
+    for collection in sorted(advised):
+        existing = [tuple((field, 1) for field, _ in index['key'])
+                    for index in db[collection].index_information().values()]
+        candidates = sorted(advised[collection], key=lambda keys: (-leaves[(collection, keys)], keys))
+        missing = []
+        for keys in candidates:
+            covered = [other for other in candidates + existing
+                       if other != keys and len(other) >= len(keys) and other[:len(keys)] == keys]
+            if keys not in existing and not covered:
+                missing.append((collection, list(keys)))
+
+        indexes.extend(missing[:MAX_INDEXES])
+
+    return indexes
+
+
+def explain_stages(collection, query):
+    """
+    :param collection: Mongo collection
+    :param query: Mongo query
+    :return: Stages of the winning plan, outermost first
+    """
+
+    plan = collection.find(query).explain()
+    plan = plan.get('queryPlanner', {}).get('winningPlan', plan)
+
+    stages = []
+    while plan:
+        stage = plan.get('stage')
+        if 'indexName' in plan:
+            stage = '%s %s' % (stage, plan['indexName'])
+        stages.append(stage)
+        plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0]
+
+    return stages
+
+
+def provision_indexes(db, dry_run=False, field_map=None):
+    """
+    Creates the indexes for the query shapes of all trials in the database and explains which shapes would
+    still be answered with a collection scan. The map collection is read as it is, not bootstrapped.
+
+    :param db: Mongo database
+    :param dry_run: Boolean flag; when true, the advised indexes are returned but not created
+    :param field_map: FieldMap translating the trial fields, defaults to the one of the map collection
+    :return: List of the advised (collection, keys) and list of (collection, shape, leaves, stages) of every
+    query shape, most frequent shapes of each collection first
+    """
+
+    me = MatchEngine(db, bootstrap=False, field_map=field_map)
+    trials = list(db.trial.find({}, {'protocol_no': 1, 'treatment_list': 1}))
+    shapes = collect_query_shapes(me, trials)
+    logging.info('Found %d query shapes in %d trials' % (len(shapes), len(trials)))
+
+    advised = advise_indexes(db, dict((key, count) for key, (_, count) in shapes.iteritems()))
+    if not dry_run:
+        for collection, keys in advised:
+            logging.info('Creating %s index %s' % (collection, keys))
+            db[collection].create_index(keys)
+
+    plans = []
+    for (collection, shape), (query, count) in sorted(shapes.iteritems(), key=lambda x: (x[0][0], -x[1][1])):
+        try:
+            stages = explain_stages(db[collection], query)
+        except Exception as exc:
+            stages = ['unknown (%s)' % exc]
+        plans.append((collection, shape, count, stages))
+
+    return advised, plans
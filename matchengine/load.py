@@ -0,0 +1,346 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import time
+import logging
+import threading
+import pandas as pd
+from multiprocessing.pool import ThreadPool
+
+from matchengine.engine import MATCH_PROJECTION
+from matchengine.utilities import iter_match_segments
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# number of rows read, converted and inserted at a time
+CHUNK_SIZE = 100000
+
+# clinical date columns, expected in format %Y-%m-%d
+CLINICAL_DATES = ['BIRTH_DATE', 'REPORT_DATE']
+
+# identifier and text columns that are always read as strings, so that their type does not depend on the chunk
+STRING_FIELDS = ['MRN', 'SAMPLE_ID', 'TRUE_HUGO_SYMBOL', 'TRUE_PROTEIN_CHANGE', 'CHROMOSOME']
+
+# clinical columns read by the engine, either as criteria or copied into the trial matches
+CLINICAL_FIELDS = [
+    'MRN',
+    'SAMPLE_ID',
+    'ONCOTREE_PRIMARY_DIAGNOSIS_NAME',
+    'BIRTH_DATE',
+    'GENDER',
+    'REPORT_DATE',
+    'ORD_PHYSICIAN_NAME',
+    'ORD_PHYSICIAN_EMAIL',
+    'VITAL_STATUS',
+    'FIRST_LAST'
+]
+
+# genomic columns read by the engine, the clinical id is added when loading
+GENOMIC_FIELDS = [field for field in MATCH_PROJECTION if field not in ['_id', 'CLINICAL_ID']] + \
+    ['STRUCTURAL_VARIANT_COMMENT']
+
+
+def read_csv_chunks(path, chunksize=CHUNK_SIZE):
+    """
+    :param path: Path to a CSV file
+    :param chunksize: Number of rows per chunk
+    :return: Iterator over data frames of at most chunksize rows
+    """
+
+    columns = pd.read_csv(path, nrows=0).columns
+    dtype = dict((field, str) for field in STRING_FIELDS if field in columns)
+    return pd.read_csv(path, chunksize=chunksize, dtype=dtype, low_memory=False)
+
+
+def match_columns(db, fields):
+    """
+    :param db: Mongo database
+    :param fields: List of column names the engine reads
+    :return: The given columns, the database fields of the map collection and the fields of the clinical and
+        genomic criteria of the trials in the database
+    """
+
+    mapping = dict((item['key_old'], item['key_new']) for item in db.map.find({}, {'key_old': 1, 'key_new': 1}))
+
+    columns = list(fields)
+    for field in mapping.values() + _criteria_fields(db):
+        field = mapping.get(field, field)
+        if field not in columns:
+            columns.append(field)
+    return columns
+
+
+def _criteria_fields(db):
+    fields = set()
+
+    def walk(node):
+        if isinstance(node, list):
+            for item in node:
+                walk(item)
+        elif isinstance(node, dict):
+            for key, val in node.iteritems():
+                if key in ['clinical', 'genomic'] and isinstance(val, dict):
+                    fields.update(field.upper() for field in val)
+                else:
+                    walk(val)
+
+    for trial in db.trial.find({'treatment_list': {'$exists': True}}, {'treatment_list': 1}):
+        for segment in iter_match_segments(trial):
+            walk(segment['match'])
+
+    return sorted(fields)
+
+
+def read_parquet_chunks(path, columns=None):
+    """
+    Reads a Parquet file one row group at a time from a memory map. Only the requested columns are decoded and
+    typed columns (dates, integers, floats) are kept as they are.
+
+    :param path: Path to a Parquet file
+    :param columns: List of columns to read, columns missing from the file are ignored. All columns when None.
+    :return: Iterator over data frames, one per row group
+    """
+
+    _require_pyarrow()
+    parquet = pq.ParquetFile(pa.memory_map(path, 'r'))
+    columns = _project(parquet.schema.names, columns)
+    for i in range(parquet.num_row_groups):
+        yield _to_pandas(parquet.read_row_group(i, columns=columns))
+
+
+def read_arrow_chunks(path, columns=None):
+    """
+    Reads an Arrow IPC (Feather version 2) file one record batch at a time from a memory map. Record batches
+    reference the mapped file directly, only the requested columns are converted to data frames.
+
+    :param path: Path to an Arrow file
+    :param columns: List of columns to read, columns missing from the file are ignored. All columns when None.
+    :return: Iterator over data frames, one per record batch
+    """
+
+    _require_pyarrow()
+    reader = pa.ipc.open_file(pa.memory_map(path, 'r'))
+    columns = _project(reader.schema.names, columns)
+    indices = [reader.schema.get_field_index(column) for column in columns]
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i)
+        table = pa.Table.from_arrays([batch.column(j) for j in indices], names=columns)
+        yield _to_pandas(table)
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError('Reading Parquet and Arrow files requires pyarrow')
+
+
+def _project(names, columns):
+    if columns is None:
+        return list(names)
+    return [column for column in names if column in columns]
+
+
+def _to_pandas(table):
+    # dates stay datetime64 columns, identifiers are strings like in the CSV reader
+    df = table.to_pandas(date_as_object=False)
+    for field in STRING_FIELDS:
+        if field not in df or df[field].dtype == object:
+            continue
+
+        # integer columns with nulls would be converted to floats and formatted as "123.0"
+        column = df[field]
+        if pa.types.is_integer(table.schema.field(field).type):
+            column = pd.Series(table.column(field).to_pandas(integer_object_nulls=True), index=df.index)
+        df[field] = column.where(pd.isnull(column), column.astype(str))
+    return df
+
+
+def iter_chunks(data, chunksize=CHUNK_SIZE):
+    """
+    :param data: Data frame or iterator over data frames
+    :param chunksize: Number of rows per chunk of a data frame
+    :return: Iterator over data frames
+    """
+
+    if isinstance(data, pd.DataFrame):
+        return (data[i:i + chunksize] for i in range(0, len(data.index), chunksize))
+    return data
+
+
+def load_clinical(db, chunks, workers=1):
+    """
+    Converts the clinical dates and inserts the clinical documents one chunk at a time
+
+    :param db: Mongo database
+    :param chunks: Iterator over clinical data frames
+    :param workers: Number of threads inserting chunks
+    :return: Number of inserted documents
+    """
+
+    inserter = ChunkInserter(db.clinical, workers)
+    try:
+        warned = False
+        for df in chunks:
+            df = df.copy()
+            for col in CLINICAL_DATES:
+                if col not in df:
+                    continue
+
+                try:
+                    dates = pd.to_datetime(df[col], format='%Y-%m-%d')
+                except ValueError as exc:
+                    if col == 'BIRTH_DATE' and not warned:
+                        logging.warning('Birth dates should be formatted %%Y-%%m-%%d to be properly stored in MongoDB. '
+                                        'Birth dates may be malformed in the database and will therefore not match '
+                                        'trial age restrictions properly. System error: %s' % exc)
+                        warned = True
+                    dates = pd.to_datetime(df[col], errors='coerce')
+
+                df[col] = pd.Series(dates.dt.to_pydatetime(), index=df.index, dtype=object)
+
+            inserter.insert(df)
+
+        return inserter.close()
+    finally:
+        inserter.terminate()
+
+
+def load_genomic(db, chunks, workers=1):
+    """
+    Converts the exon numbers, adds the clinical id of every sample and inserts the genomic documents one chunk
+    at a time. The clinical documents have to be loaded first.
+
+    :param db: Mongo database
+    :param chunks: Iterator over genomic data frames
+    :param workers: Number of threads inserting chunks
+    :return: Number of inserted documents
+    """
+
+    clinical = pd.DataFrame(list(db.clinical.find({}, {'_id': 1, 'SAMPLE_ID': 1})), columns=['_id', 'SAMPLE_ID'])
+    clinical = clinical.drop_duplicates('SAMPLE_ID', keep='last').rename(columns={'_id': 'CLINICAL_ID'})
+
+    inserter = ChunkInserter(db.genomic, workers)
+    try:
+        for df in chunks:
+            if 'TRUE_TRANSCRIPT_EXON' in df:
+                exon = pd.to_numeric(df['TRUE_TRANSCRIPT_EXON'], errors='coerce')
+                exon = exon.dropna().astype(int).astype(object)
+                df = df.assign(TRUE_TRANSCRIPT_EXON=exon.combine_first(df['TRUE_TRANSCRIPT_EXON'].astype(object)))
+
+            if 'CLINICAL_ID' in df:
+                df = df.drop('CLINICAL_ID', axis=1)
+            df = df.merge(clinical, how='left', on='SAMPLE_ID', sort=False)
+
+            inserter.insert(df)
+
+        return inserter.close()
+    finally:
+        inserter.terminate()
+
+
+class ChunkInserter(object):
+    """
+    Inserts data frames into a collection from a pool of threads. The threads share the connection pool of the
+    collection's client and insert with unordered bulk writes. Reading and converting the next chunks continues
+    while earlier chunks are inserted, with at most two chunks per thread waiting, so memory stays bounded.
+    Call "close" once all chunks are queued, or "terminate" when loading fails.
+    """
+
+    def __init__(self, collection, workers=1):
+        """
+        :param collection: Mongo collection
+        :param workers: Number of inserting threads, chunks are inserted by the calling thread when 1
+        """
+
+        self.collection = collection
+        self.workers = max(1, workers)
+        self.pool = ThreadPool(self.workers) if self.workers > 1 else None
+        self.slots = threading.BoundedSemaphore(2 * self.workers)
+        self.pending = []
+
+        # documents inserted and seconds spent inserting per thread
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def insert(self, df):
+        """
+        :param df: Data frame
+        """
+
+        if self.pool is None:
+            self._insert(df)
+            return
+
+        self.slots.acquire()
+        try:
+            self.pending.append(self.pool.apply_async(self._insert, (df, )))
+        except Exception:
+            self.slots.release()
+            raise
+
+        # surface errors of finished chunks early
+        while self.pending and self.pending[0].ready():
+            self.pending.pop(0).get()
+
+    def close(self):
+        """
+        Waits for all chunks to be inserted and logs the throughput of every thread
+
+        :return: Number of inserted documents
+        """
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            for result in self.pending:
+                result.get()
+
+        for name, (count, seconds) in sorted(self.stats.iteritems()):
+            logging.info('%s: %s inserted %d documents in %.1fs (%.0f docs/sec)' %
+                         (self.collection.name, name, count, seconds, count / seconds if seconds else 0))
+
+        return sum(count for count, _ in self.stats.itervalues())
+
+    def terminate(self):
+        """
+        Stops the threads after a failure: chunks that are being inserted are finished, queued chunks are dropped.
+        Does nothing after "close".
+        """
+
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+    def _insert(self, df):
+        try:
+            start = time.time()
+            count = insert_records(self.collection, df)
+            seconds = time.time() - start
+
+            name = threading.current_thread().name
+            with self.lock:
+                stats = self.stats.setdefault(name, [0, 0.0])
+                stats[0] += count
+                stats[1] += seconds
+        finally:
+            if self.pool is not None:
+                self.slots.release()
+
+
+def insert_records(collection, df):
+    """
+    Inserts the rows of a data frame with native Python values and missing values as null
+
+    :param collection: Mongo collection
+    :param df: Data frame
+    :return: Number of inserted documents
+    """
+
+    if len(df.index) == 0:
+        return 0
+
+    records = df.astype(object).where(pd.notnull(df), None).to_dict('records')
+    collection.insert_many(records, ordered=False)
+    return len(records)
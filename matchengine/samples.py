@@ -0,0 +1,87 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import numpy as np
+
+
+class SampleIndex(object):
+    """
+    Assigns every SAMPLE_ID a dense integer so that sets of samples can be stored as boolean masks.
+
+    The index is seeded with the sample ids of the clinical collection, which make up the universe that
+    negative criteria are taken against. Sample ids seen later (e.g. genomic documents without a clinical
+    document) are appended, so masks created earlier may be shorter than the index and are padded on use.
+    """
+
+    def __init__(self, sample_ids):
+        """
+        :param sample_ids: SAMPLE_IDs of the clinical collection
+        """
+
+        self.sample_ids = []
+        self.positions = {}
+        for sample_id in sample_ids:
+            self.add(sample_id)
+
+        self.universe = len(self.sample_ids)
+
+    def __len__(self):
+        return len(self.sample_ids)
+
+    def add(self, sample_id):
+        """Returns the position of a sample id, assigning the next free position to unseen ones"""
+
+        pos = self.positions.get(sample_id)
+        if pos is None:
+            pos = self.positions[sample_id] = len(self.sample_ids)
+            self.sample_ids.append(sample_id)
+
+        return pos
+
+    def mask(self, sample_ids):
+        """
+        :param sample_ids: Iterable of sample ids
+        :return: boolean mask with the positions of the given sample ids set
+        """
+
+        positions = [self.add(sample_id) for sample_id in sample_ids]
+        mask = np.zeros(len(self), dtype=bool)
+        mask[positions] = True
+        return mask
+
+    def empty(self):
+        return np.zeros(len(self), dtype=bool)
+
+    def complement(self, mask):
+        """Returns the samples of the clinical collection that are not in the mask"""
+
+        result = np.zeros(len(self), dtype=bool)
+        result[:self.universe] = True
+        result[:len(mask)] &= ~mask
+        return result
+
+    def resize(self, mask):
+        """Pads a mask created before sample ids were appended to the index"""
+
+        if len(mask) == len(self):
+            return mask
+
+        result = np.zeros(len(self), dtype=bool)
+        result[:len(mask)] = mask
+        return result
+
+    def covers(self, mask):
+        """Returns true when the mask contains every sample of the clinical collection"""
+        return self.universe > 0 and len(mask) >= self.universe and mask[:self.universe].all()
+
+    def contains(self, mask, sample_id):
+        pos = self.positions.get(sample_id)
+        return pos is not None and pos < len(mask) and mask[pos]
+
+    def to_set(self, mask):
+        """
+        :param mask: boolean mask
+        :return: set of the sample ids in the mask
+        """
+
+        sample_ids = self.sample_ids
+        return set(sample_ids[pos] for pos in np.flatnonzero(mask))
@@ -1,10 +1,27 @@
 """Copyright 2016 Dana-Farber Cancer Institute"""
 
+import numpy as np
 import pandas as pd
+import itertools
 import logging
+from pymongo import UpdateMany
 
 logging.basicConfig(level=logging.DEBUG, format='[%(levelname)s] %(message)s', )
 
+# fields of a trial match document that determine its sort order
+SORT_FIELDS = [
+    'sample_id',
+    'protocol_no',
+    'mmr_status',
+    'tier',
+    'variant_category',
+    'wildtype',
+    'match_type',
+    'cancer_type_match',
+    'coordinating_center',
+    'genomic_alteration'
+]
+
 
 def add_sort_order(trial_match_df):
     """
@@ -15,56 +32,205 @@ def add_sort_order(trial_match_df):
     (4) Then sort by coordinating center (DFCI > MGH)
     (5) Then sort by reverse protocol number (high > low)
 
-    :param trial_matches: List of trial match dictionaries
-    :return: List of trial match dictionaries with two additional columns:
-        (1) sort_order: Order in which to display the matches
-        (2) freq: Frequency with which this trial match appears throughout the entire patient cohort
+    The sort values of all matches are computed as columns, reduced to their minimum per (sample_id, protocol_no)
+    and ranked within each sample with a single lexsort. Within a sample, protocols with the same reverse protocol
+    number are ordered by descending protocol_no.
+
+    :param trial_matches: Data frame or list of trial match dictionaries
+    :return: Data frame of the trial matches with an additional sort_order column, the order in which to display
+        the matches. Matches that are not sorted have a sort_order of -1.
     """
 
+    if not isinstance(trial_match_df, pd.DataFrame):
+        trial_match_df = pd.DataFrame(trial_match_df)
+
     if len(trial_match_df.index) == 0:
         return trial_match_df
 
     f1 = (trial_match_df['vital_status'] == 'alive')
     f2 = (trial_match_df['trial_accrual_status'] == 'open')
     f3 = (trial_match_df['genomic_alteration'].str.strip().str.title() != 'Structural Variation')
-    all_sample_ids = trial_match_df.sample_id.unique().tolist()
-    master_sort_order = {}
+    df = trial_match_df[f1 & f2 & f3]
+    if len(df.index) == 0:
+        trial_match_df['sort_order'] = -1
+        return trial_match_df
 
-    for sample_id in all_sample_ids:
-        f4 = (trial_match_df['sample_id'] == sample_id)
-        df = trial_match_df[f1 & f2 & f3 & f4]
-        matches = df.T.to_dict().values()
+    keys = ['sample_id', 'protocol_no']
+    sort_order = sort_orders(df)
+    idx = pd.MultiIndex.from_arrays([trial_match_df[key] for key in keys])
+    trial_match_df['sort_order'] = sort_order.reindex(idx).fillna(-1).astype(int).values
+    return trial_match_df
 
-        # The sort order dictionary keeps track of the priority for each sort category for each match
-        # Index 0 is sorted by tier with values 0 to 7
-        # Index 1 is sorted by match type with values 0 to 1
-        # Index 2 is sorted by cancer type match with values 0 to 2
-        # Index 3 is sorted by coordinating center with values 0 to 1
-        # Index 4 is sorted by reverse protocol number
-        sort_order = {}
 
-        for match in matches:
+def sort_orders(df):
+    """
+    Ranks the trial matches of any number of samples with the logic of "add_sort_order"
 
-            idx = (match['sample_id'], match['protocol_no'])
-            if idx not in sort_order:
-                sort_order[idx] = []
+    :param df: Data frame of the trial matches to sort: matches of alive patients to open trials that are not
+        structural variants
+    :return: Series of the sort order of every (sample_id, protocol_no) pair, indexed by both
+    """
 
-            sort_order = sort_by_tier(match, sort_order)
-            sort_order = sort_by_match_type(match, sort_order)
-            sort_order = sort_by_cancer_type(match, sort_order)
-            sort_order = sort_by_coordinating_center(match, sort_order)
+    keys = ['sample_id', 'protocol_no']
+    cols = ['tier', 'match_type', 'cancer_type', 'coordinating_center']
+    sort_values = pd.DataFrame({
+        'sample_id': df['sample_id'],
+        'protocol_no': df['protocol_no'],
+        'tier': tier_values(df),
+        'match_type': match_type_values(df),
+        'cancer_type': cancer_type_values(df),
+        'coordinating_center': coordinating_center_values(df)
+    }, columns=keys + cols)
 
-        sort_order = sort_by_reverse_protocol_no(matches, sort_order)
+    # lowest value of every sort category per sample and protocol
+    sort_values = sort_values.groupby(keys, sort=False).min().reset_index()
 
-        # for k, v in sort_order.iteritems():
-        #     print '%s | %s' % (k, v)
+    # reverse protocol number: rank of the protocol within the sample, highest protocol number first
+    protocol_number = sort_values['protocol_no'].str.split('-').str[0].astype(int)
+    sample = pd.factorize(sort_values['sample_id'])[0]
+    order = np.lexsort((-pd.factorize(sort_values['protocol_no'], sort=True)[0], -protocol_number.values, sample))
+    rev_protocol_no = np.empty(len(order), dtype=int)
+    rev_protocol_no[order] = rank_within(sample[order])
 
-        master_sort_order = final_sort(sort_order, master_sort_order)
+    # rank all sort categories within the sample
+    order = np.lexsort([rev_protocol_no] + [sort_values[col].values for col in cols[::-1]] + [sample])
+    sort_order = np.empty(len(order), dtype=int)
+    sort_order[order] = rank_within(sample[order])
 
-    trial_match_df['sort_order'] = trial_match_df.apply(lambda x: master_sort_order[(x['sample_id'], x['protocol_no'])]
-                                                        if (x['sample_id'], x['protocol_no']) in master_sort_order
-                                                        else -1, axis=1)
-    return trial_match_df
+    return pd.Series(sort_order, index=pd.MultiIndex.from_arrays([sort_values[key] for key in keys]))
+
+
+def rank_within(groups):
+    """
+    :param groups: Sorted array of group numbers
+    :return: Position of every element within its group
+    """
+
+    positions = np.arange(len(groups))
+    starts = np.r_[0, np.flatnonzero(groups[1:] != groups[:-1]) + 1]
+    return positions - np.repeat(starts, np.diff(np.r_[starts, len(groups)]))
+
+
+def tier_values(df):
+    """Vectorized "sort_by_tier" """
+
+    def column(field):
+        return df[field] if field in df else pd.Series(None, index=df.index, dtype=object)
+
+    conditions = [
+        column('mmr_status').notnull(),
+        column('tier') == 1,
+        column('tier') == 2,
+        column('variant_category') == 'CNV',
+        column('tier') == 3,
+        column('tier') == 4,
+        column('wildtype').map(lambda x: x is True).astype(bool)
+    ]
+    return np.select(conditions, range(len(conditions)), default=len(conditions))
+
+
+def match_type_values(df):
+    """Vectorized "sort_by_match_type" """
+
+    if 'match_type' not in df:
+        return np.full(len(df.index), 2, dtype=int)
+    return np.select([df['match_type'] == 'variant', df['match_type'] == 'gene'], [0, 1], default=2)
+
+
+def cancer_type_values(df):
+    """Vectorized "sort_by_cancer_type" """
+
+    if 'cancer_type_match' not in df:
+        return np.full(len(df.index), 2, dtype=int)
+    cancer_type = df['cancer_type_match']
+    return np.select([cancer_type == 'specific', cancer_type.isin(['all_solid', 'all_liquid'])], [0, 1], default=2)
+
+
+def coordinating_center_values(df):
+    """Vectorized "sort_by_coordinating_center" """
+
+    if 'coordinating_center' not in df:
+        return np.ones(len(df.index), dtype=int)
+    return np.where(df['coordinating_center'] == 'Dana-Farber Cancer Institute', 0, 1)
+
+
+def add_sort_order_collection(collection, batch_size=1000, frame_size=10000):
+    """
+    Adds the sort order of "add_sort_order" to trial match documents stored in a collection. The matches are
+    read in frames of whole samples of about "frame_size" matches that are ranked at once, so only the sort fields
+    of one frame are held in memory. Within a sample, protocols with the same reverse protocol number are ordered
+    by descending protocol_no.
+
+    :param collection: Collection of trial match documents that have a sort_order of -1
+    :param batch_size: Number of sort order updates sent per bulk write
+    :param frame_size: Number of matches ranked at once
+    :return: Number of (sample_id, protocol_no) pairs that were given a sort order
+    """
+
+    # served by the (sample_id, protocol_no) index
+    proj = dict.fromkeys(SORT_FIELDS, 1)
+    proj['_id'] = 0
+    query = {'vital_status': 'alive', 'trial_accrual_status': 'open'}
+    cursor = collection.find(query, proj).sort([('sample_id', 1), ('protocol_no', 1)])
+
+    count = 0
+    frame = []
+    for _, docs in itertools.groupby(cursor, key=lambda x: x['sample_id']):
+
+        # structural variants are not sorted
+        frame.extend(match for match in docs if not is_structural_variation(match))
+        if len(frame) >= frame_size:
+            count += _write_sort_orders(collection, frame, batch_size)
+            frame = []
+
+    if frame:
+        count += _write_sort_orders(collection, frame, batch_size)
+
+    return count
+
+
+def _write_sort_orders(collection, matches, batch_size):
+
+    requests = [UpdateMany({'sample_id': idx[0], 'protocol_no': idx[1]}, {'$set': {'sort_order': int(sort_order)}})
+                for idx, sort_order in sort_orders(pd.DataFrame(matches)).iteritems()]
+    for i in range(0, len(requests), batch_size):
+        collection.bulk_write(requests[i:i + batch_size], ordered=False)
+    return len(requests)
+
+
+def is_structural_variation(match):
+    alteration = match.get('genomic_alteration')
+    return isinstance(alteration, basestring) and alteration.strip().title() == 'Structural Variation'
+
+
+def sort_sample(matches):
+    """
+    Computes the sort values of all trial matches of a single sample
+
+    :param matches: List of trial match dictionaries of one sample
+    :return: Dictionary mapping (sample_id, protocol_no) to its five sort values
+    """
+
+    # The sort order dictionary keeps track of the priority for each sort category for each match
+    # Index 0 is sorted by tier with values 0 to 7
+    # Index 1 is sorted by match type with values 0 to 1
+    # Index 2 is sorted by cancer type match with values 0 to 2
+    # Index 3 is sorted by coordinating center with values 0 to 1
+    # Index 4 is sorted by reverse protocol number
+    sort_order = {}
+
+    for match in matches:
+
+        idx = (match['sample_id'], match['protocol_no'])
+        if idx not in sort_order:
+            sort_order[idx] = []
+
+        sort_order = sort_by_tier(match, sort_order)
+        sort_order = sort_by_match_type(match, sort_order)
+        sort_order = sort_by_cancer_type(match, sort_order)
+        sort_order = sort_by_coordinating_center(match, sort_order)
+
+    return sort_by_reverse_protocol_no(matches, sort_order)
 
 
 def sort_by_tier(match, sort_order):
@@ -5,13 +5,37 @@ import os
 import sys
 import yaml
 import json
+import hashlib
 import logging
+import threading
+import multiprocessing
 import pandas as pd
 import datetime as dt
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import MongoClient, ReplaceOne
 
 import oncotreenx
 from matchengine.settings import months, TUMOR_TREE, mmr_map, mmr_map_rev
+from matchengine.writer import MatchWriter
+
+# LibYAML based loader, several times faster than the pure Python loader and constructing the same documents
+YAML_LOADER = getattr(yaml, 'CLoader', yaml.Loader)
+
+# collection holding the content hash of every loaded trial file
+TRIAL_CACHE = 'trial_cache'
+
+# options of the shared Mongo clients and the environment variables overriding them
+CLIENT_OPTIONS = {
+    'maxPoolSize': ('MONGO_MAX_POOL_SIZE', 100),
+    'connectTimeoutMS': ('MONGO_CONNECT_TIMEOUT_MS', 20000),
+    'serverSelectionTimeoutMS': ('MONGO_SERVER_SELECTION_TIMEOUT_MS', 30000),
+    'socketTimeoutMS': ('MONGO_SOCKET_TIMEOUT_MS', None),
+    'readPreference': ('MONGO_READ_PREFERENCE', 'primary')
+}
+
+# one client per URI, options and process; clients must not be shared with forked processes
+_clients = {}
+_clients_lock = threading.Lock()
 
 
 def build_gquery(field, txt):
@@ -98,9 +122,147 @@ def build_cquery(c, norm_field, txt):
     return c
 
 
+# oncotree parsed once per process by "build_oncotree"
+_oncotree = []
+
+# clinical fields holding the oncotree codes of all ancestors of the primary diagnosis and its tumor types
+# (solid, liquid), added by "materialize_oncotree"
+ONCOTREE_ANCESTORS = 'ONCOTREE_PRIMARY_DIAGNOSIS_ANCESTORS'
+ONCOTREE_TUMOR_TYPE = 'ONCOTREE_PRIMARY_DIAGNOSIS_TUMOR_TYPE'
+
+
 def build_oncotree():
-    """Builds oncotree"""
-    return oncotreenx.build_oncotree(file_path=TUMOR_TREE)
+    """Builds oncotree. The tree is parsed once per process and shared between callers, so it must not be modified."""
+
+    if not _oncotree:
+        _oncotree.append(oncotreenx.build_oncotree(file_path=TUMOR_TREE))
+
+    return _oncotree[0]
+
+
+def oncotree_index(onco_tree):
+    """Returns the OncotreeIndex of an oncotree. It is built on first use and kept on the tree."""
+
+    if 'index' not in onco_tree.graph:
+        onco_tree.graph['index'] = OncotreeIndex(onco_tree)
+
+    return onco_tree.graph['index']
+
+
+class OncotreeIndex(object):
+    """
+    Precomputed lookups on an oncotree.
+
+    Nodes are numbered in depth-first order (Euler tour), so the subtree of a node is the contiguous interval
+    between its entry and exit positions and expanding a diagnosis into all of its subtypes is a list slice.
+    """
+
+    def __init__(self, onco_tree):
+        """
+        :param onco_tree: oncotree built by "build_oncotree"
+        """
+
+        self.text = dict((node, onco_tree.node[node]['text']) for node in onco_tree.nodes())
+        self.parent = dict((node, parent) for parent, node in onco_tree.edges())
+
+        # the first node carrying a text wins, like "oncotreenx.lookup_text"
+        self.nodes = {}
+        self.all_nodes = {}
+        for node in onco_tree.nodes():
+            self.nodes.setdefault(self.text[node], node)
+            self.all_nodes.setdefault(self.text[node], []).append(node)
+
+        # depth-first numbering of every node reachable from the roots, visiting children like "nx.dfs_tree"
+        self.order = []
+        self.intervals = {}
+        roots = [node for node in onco_tree.nodes() if onco_tree.in_degree(node) == 0]
+        for root in roots:
+            stack = [(root, False)]
+            while stack:
+                node, done = stack.pop()
+                if done:
+                    self.intervals[node] = (self.intervals[node], len(self.order))
+                    continue
+
+                self.intervals[node] = len(self.order)
+                self.order.append(node)
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(onco_tree.successors(node)))
+
+        # liquid tumors are those below lymph and blood, everything else is solid
+        liquid = set(self._subtree(self.nodes["Lymph"])).union(set(self._subtree(self.nodes["Blood"])))
+        solid = set(onco_tree.nodes()) - liquid
+
+        self.liquid_nodes = liquid
+        self.liquid = [self.text[n] for n in liquid]
+        self.solid = [self.text[n] for n in solid]
+
+    def _subtree(self, node):
+        """Returns a node and all of its descendants, iterated in the same order as "nx.dfs_tree" """
+        start, end = self.intervals[node]
+        return dict.fromkeys(self.order[start:end])
+
+    def descendants(self, txt):
+        """
+        :param txt: oncotree node text
+        :return: texts of the node and all of its descendants, None if the text is not in the tree
+        """
+
+        node = self.nodes.get(txt)
+        if node is None or node not in self.intervals:
+            return None
+
+        return [self.text[n] for n in self._subtree(node)]
+
+    def ancestors(self, txt):
+        """
+        :param txt: oncotree node text
+        :return: sorted oncotree codes of every node carrying the text and all of their ancestors
+        """
+
+        codes = set()
+        for node in self.all_nodes.get(txt, []):
+            while node is not None and node not in codes:
+                codes.add(node)
+                node = self.parent.get(node)
+
+        return sorted(codes)
+
+    def tumor_types(self, txt):
+        """
+        :param txt: oncotree node text
+        :return: sorted tumor types ("liquid", "solid") of the nodes carrying the text
+        """
+
+        return sorted(set('liquid' if node in self.liquid_nodes else 'solid' for node in self.all_nodes.get(txt, [])))
+
+
+def materialize_oncotree(db):
+    """
+    Adds the oncotree codes of all ancestors of each clinical document's primary diagnosis and its tumor types to
+    the clinical collection and indexes them, so that diagnosis criteria are matched on a single indexed value
+    instead of a list of every descendant diagnosis.
+
+    :param db: Mongo connection
+    """
+
+    index = oncotree_index(build_oncotree())
+
+    for name in db.clinical.distinct('ONCOTREE_PRIMARY_DIAGNOSIS_NAME'):
+        if isinstance(name, basestring):
+            db.clinical.update_many({'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': name}, {'$set': {
+                ONCOTREE_ANCESTORS: index.ancestors(name),
+                ONCOTREE_TUMOR_TYPE: index.tumor_types(name)
+            }})
+
+    # documents without a diagnosis, so that every clinical document carries the fields
+    db.clinical.update_many({ONCOTREE_ANCESTORS: {'$exists': False}}, {'$set': {
+        ONCOTREE_ANCESTORS: [],
+        ONCOTREE_TUMOR_TYPE: []
+    }})
+
+    db.clinical.create_index(ONCOTREE_ANCESTORS)
+    db.clinical.create_index(ONCOTREE_TUMOR_TYPE)
 
 
 def normalize_fields(mapping, field):
@@ -144,6 +306,200 @@ def normalize_values(mapping, field, val):
         return field, val
 
 
+class FieldMap(object):
+    """
+    Translation of yaml field names and values into database field names and values, compiled once from the
+    "map" collection. Gives the same results as "normalize_fields" and "normalize_values" with dictionary lookups
+    instead of scanning the mapping on every call. Instances are not modified after construction, so a single
+    instance can be shared between engines.
+    """
+
+    def __init__(self, mapping):
+        """
+        :param mapping: Documents of the "map" collection
+        """
+
+        self._fields = {}
+        self._values = {}
+        for item in mapping:
+
+            # the first mapping of a yaml field wins, the last value map of a database field wins
+            self._fields.setdefault(item['key_old'], item['key_new'])
+            self._values[item['key_new']] = dict(item['values'])
+
+    def field(self, field):
+        """
+        :param field: yaml field name
+        :return: database field name and the map of its values
+        """
+
+        field = field.upper()
+        field = self._fields.get(field, field)
+        return field, self._values[field]
+
+    def value(self, field, val):
+        """
+        :param field: yaml field name
+        :param val: yaml value, optionally negated with a leading "!"
+        :return: database field name and value
+        """
+
+        field, mapping = self.field(field)
+
+        # exclude "!" from mapping
+        if isinstance(val, basestring) and val[0] == "!":
+            if val[1:] in mapping:
+                return field, '!%s' % str(mapping[val[1:]])
+        elif val in mapping:
+            return field, mapping[val]
+
+        return field, val
+
+
+def query_key(query):
+    """Returns a hashable representation of a Mongo query so that it can be used as a cache key"""
+
+    if isinstance(query, dict):
+        return frozenset((key, query_key(val)) for key, val in query.iteritems())
+    elif isinstance(query, (list, tuple)):
+        return tuple(query_key(item) for item in query)
+    elif isinstance(query, re._pattern_type):
+        return query.pattern, query.flags
+    else:
+        return query
+
+
+def query_fields(query):
+    """Returns the set of document fields and the set of operators referenced by a Mongo query"""
+
+    fields = set()
+    operators = set()
+
+    for key, cond in query.iteritems():
+        if key in ['$and', '$or']:
+            operators.add(key)
+            for subquery in cond:
+                subfields, suboperators = query_fields(subquery)
+                fields.update(subfields)
+                operators.update(suboperators)
+        else:
+            fields.add(key)
+            if isinstance(cond, dict) and all(op.startswith('$') for op in cond):
+                operators.update(cond.keys())
+            else:
+                operators.add('$eq')
+
+    return fields, operators
+
+
+# operators that can be evaluated client-side by "match_document"
+CLIENT_SIDE_OPERATORS = set(['$and', '$or', '$eq', '$ne', '$in', '$nin', '$regex', '$exists',
+                             '$lt', '$lte', '$gt', '$gte'])
+
+
+def match_document(doc, query):
+    """
+    Evaluates a Mongo query against a document client-side, following Mongo's semantics for missing fields,
+    null values and array fields. Only the operators listed in CLIENT_SIDE_OPERATORS are supported.
+
+    :param doc: Mongo document
+    :param query: Mongo query
+    :return: True if the document matches the query
+    """
+
+    for key, cond in query.iteritems():
+        if key == '$and':
+            if not all(match_document(doc, subquery) for subquery in cond):
+                return False
+        elif key == '$or':
+            if not any(match_document(doc, subquery) for subquery in cond):
+                return False
+        elif key.startswith('$'):
+            raise ValueError('Unsupported query operator %s' % key)
+        elif isinstance(cond, dict) and all(op.startswith('$') for op in cond):
+            for op, arg in cond.iteritems():
+                if not _match_operator(doc, key, op, arg):
+                    return False
+        elif not _match_operator(doc, key, '$eq', cond):
+            return False
+
+    return True
+
+
+def _match_operator(doc, field, op, arg):
+    """Evaluates a single query operator against the value of a document field"""
+
+    val = doc.get(field)
+
+    # array fields match if any of their elements match
+    candidates = val if isinstance(val, list) else [val]
+
+    if op == '$eq':
+        return values_equal(val, arg) or any(values_equal(item, arg) for item in candidates)
+    elif op == '$ne':
+        return not _match_operator(doc, field, '$eq', arg)
+    elif op == '$in':
+        return any(_match_operator(doc, field, '$eq', item) for item in arg)
+    elif op == '$nin':
+        return not _match_operator(doc, field, '$in', arg)
+    elif op == '$regex':
+        return any(isinstance(item, basestring) and re.search(arg, item) is not None for item in candidates)
+    elif op == '$exists':
+        return (field in doc) == bool(arg)
+    elif op in ['$lt', '$lte', '$gt', '$gte']:
+        return any(compare_values(item, op, arg) for item in candidates)
+    else:
+        raise ValueError('Unsupported query operator %s' % op)
+
+
+def values_equal(val, arg):
+    """
+    Mongo equality; compiled regular expressions in a query match string values
+
+    :param val: Value of a document field
+    :param arg: Value or compiled regular expression of the query
+    :return: Boolean
+    """
+
+    if isinstance(arg, re._pattern_type):
+        return isinstance(val, basestring) and arg.search(val) is not None
+
+    # booleans and numbers are distinct types in Mongo
+    if isinstance(val, bool) != isinstance(arg, bool):
+        return False
+
+    return val == arg
+
+
+def compare_values(val, op, arg):
+    """
+    Mongo range comparison; values are only comparable to values of the same type bracket
+
+    :param val: Value of a document field
+    :param op: "$lt", "$lte", "$gt" or "$gte"
+    :param arg: Value of the query
+    :return: Boolean
+    """
+
+    brackets = [(bool,), (int, long, float), (basestring,), (dt.datetime,)]
+    for bracket in brackets:
+        if isinstance(arg, bracket):
+            if not isinstance(val, bracket) or (bracket != (bool,) and isinstance(val, bool)):
+                return False
+            break
+    else:
+        return False
+
+    if op == '$lt':
+        return val < arg
+    elif op == '$lte':
+        return val <= arg
+    elif op == '$gt':
+        return val > arg
+    else:
+        return val >= arg
+
+
 def samples_from_mrns(db, mrns):
     """Returns a dictionary mapping each MRN to all of its associated SAMPLE_IDs"""
 
@@ -159,7 +515,7 @@ def samples_from_mrns(db, mrns):
     return mrn_map
 
 
-def search_birth_date(c):
+def search_birth_date(c, today=None):
     """Converts query to filter by birth date based on the given age"""
     txt = c['BIRTH_DATE']['$eq']
 
@@ -182,7 +538,8 @@ def search_birth_date(c):
     abs_age = str(txt[idx:])
 
     # date today
-    today = dt.datetime.today()
+    if today is None:
+        today = dt.datetime.today()
 
     # calculate date to query
     if '.' in abs_age:
@@ -197,6 +554,15 @@ def search_birth_date(c):
     return {key: query_date}
 
 
+def reference_date():
+    """
+    Returns today's date truncated to the millisecond precision with which Mongo stores dates, so that
+    queries evaluated client-side compare dates exactly like the database does
+    """
+    today = dt.datetime.today()
+    return today.replace(microsecond=today.microsecond // 1000 * 1000)
+
+
 def get_months(abs_age, today):
     """Given a decimal, returns the number of months and number of years to subtract from today"""
 
@@ -225,29 +591,115 @@ def get_months(abs_age, today):
     return month, year
 
 
-def add_trials(trial_path, db):
+def add_trials(trial_path, db, workers=1, cache=None):
     """Adds all ymls in the "trial_path" to the db"""
 
-    inserted_ids = 0
+    paths = [os.path.join(trial_path, yml) for yml in sorted(os.listdir(trial_path)) if yml.split('.')[-1] == 'yml']
+    return load_trials(db, paths, workers, cache)
 
-    # search directory for ymls
-    for yml in os.listdir(trial_path):
-        ymlpath = os.path.join(trial_path, yml)
 
-        # only add files of extension ".yml"
-        if yml.split('.')[-1] != 'yml':
+def load_trials(db, paths, workers=1, cache=None):
+    """
+    Parses YAML trial files and upserts the trials by protocol number with a single bulk write. Trials without
+    a protocol number are upserted by the id the trial cache recorded for their file. Files whose content hash
+    is in the trial cache and whose trial is still in the database are neither parsed nor written. Files that
+    cannot be parsed are logged and skipped.
+
+    :param db: Mongo database
+    :param paths: List of paths to YAML trial files
+    :param workers: Number of processes parsing files
+    :param cache: ValidationCache that the written trials are added to, so that its validators see them
+    :return: Number of trials written
+    """
+
+    paths = [os.path.abspath(path) for path in paths]
+    loaded = dict((doc['_id'], doc) for doc in db[TRIAL_CACHE].find({'_id': {'$in': paths}}))
+    protocol_nos = set(db.trial.distinct('protocol_no'))
+    trial_ids = [doc['trial_id'] for doc in loaded.itervalues() if doc.get('trial_id') is not None]
+    trial_ids = set(doc['_id'] for doc in db.trial.find({'_id': {'$in': trial_ids}}, {'_id': 1}))
+
+    # files that changed since they were loaded
+    changed = []
+    for path in paths:
+        with open(path) as f:
+            text = f.read()
+
+        digest = hashlib.sha1(text).hexdigest()
+        cached = loaded.get(path)
+        if cached and cached['hash'] == digest and (cached.get('protocol_no') in protocol_nos or
+                                                    cached.get('trial_id') in trial_ids):
+            continue
+        changed.append((path, digest, text))
+
+    logging.info('Parsing %d of %d trial files, %d are unchanged' %
+                 (len(changed), len(paths), len(paths) - len(changed)))
+    if not changed:
+        return 0
+
+    texts = [item[2] for item in changed]
+    if workers > 1 and len(changed) > 1:
+        pool = multiprocessing.Pool(min(workers, len(changed)))
+        try:
+            results = pool.map(_parse_trial, texts, chunksize=max(1, len(texts) // (4 * workers)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_parse_trial, texts)
+
+    # later files replace earlier files of the same trial
+    requests = []
+    hashes = []
+    trials = []
+    for (path, digest, _), (trial, error) in zip(changed, results):
+        if error is not None:
+            logging.error('Could not parse %s, the file is skipped: %s' % (path, error))
             continue
 
-        # convert yml to json format
-        with open(ymlpath) as f:
-            t = yaml.load(f.read())
+        protocol_no = trial.get('protocol_no')
+        trial_id = None
+        if protocol_no is None:
+            # the file keeps its trial id between loads, so that a changed file replaces its trial
+            cached = loaded.get(path) or {}
+            trial_id = trial['_id'] = cached.get('trial_id') or ObjectId()
+            requests.append(ReplaceOne({'_id': trial_id}, trial, upsert=True))
+        else:
+            requests.append(ReplaceOne({'protocol_no': protocol_no}, trial, upsert=True))
+        trials.append(trial)
+        hashes.append(ReplaceOne({'_id': path}, {'_id': path, 'hash': digest, 'protocol_no': protocol_no,
+                                                 'trial_id': trial_id}, upsert=True))
+
+    if not requests:
+        return 0
+
+    db.trial.create_index('protocol_no')
+    db.trial.bulk_write(requests, ordered=True)
+    db[TRIAL_CACHE].bulk_write(hashes, ordered=False)
+    if cache is not None:
+        for trial in trials:
+            cache.add_trial(trial)
+    return len(requests)
+
+
+def parse_yaml(text):
+    """
+    :param text: YAML document
+    :return: Parsed document
+    """
+
+    return yaml.load(text, Loader=YAML_LOADER)
+
 
-            # add trial to db
-            result = db.trial.insert_one(t)
-            if result.inserted_id:
-                inserted_ids += 1
+def _parse_trial(text):
+    try:
+        trial = parse_yaml(text)
+    except yaml.YAMLError as exc:
+        return None, str(exc)
 
-    return inserted_ids
+    # empty files and YAML scalars or lists are not trials
+    if not isinstance(trial, dict):
+        return None, 'the document is a %s, not a mapping' % type(trial).__name__
+    return trial, None
 
 
 def format_genomic_alteration(g, query):
@@ -373,8 +825,16 @@ def format_query(g, gene=False):
     return alteration
 
 
-def add_matches(trial_matches_df, db):
-    """Add the match table to the database or update what already exists theres"""
+def add_matches(trial_matches_df, db, mode='replace'):
+    """
+    Add the match table to the database or update what already exists theres
+
+    :param trial_matches_df: Sorted trial matches
+    :param db: Mongo database
+    :param mode: "replace" drops the collection and inserts the matches, "swap" and "incremental" write them
+        with a MatchWriter (see matchengine.writer)
+    :return: Number of documents written
+    """
 
     if 'clinical_id' in trial_matches_df.columns:
         trial_matches_df['clinical_id'] = trial_matches_df['clinical_id'].apply(lambda x: str(x))
@@ -386,11 +846,22 @@ def add_matches(trial_matches_df, db):
         trial_matches_df['report_date'] = trial_matches_df['report_date'].apply(
             lambda x: dt.datetime.strftime(x, '%Y-%m-%d %X') if pd.notnull(x) else x)
 
-    if len(trial_matches_df.index) > 0:
-        db.trial_match.drop()
+    if len(trial_matches_df.index) == 0:
+        return 0
+
+    if mode != 'replace':
+        writer = MatchWriter(db, mode=mode, sort=False)
         for i in range(0, trial_matches_df.shape[0], 1000):
-            records = json.loads(trial_matches_df[i:i + 1000].T.to_json()).values()
-            db.trial_match.insert_many(records)
+            writer.write(json.loads(trial_matches_df[i:i + 1000].T.to_json()).values())
+        writer.close()
+        return writer.inserted + writer.updated + writer.deleted
+
+    db.trial_match.drop()
+    for i in range(0, trial_matches_df.shape[0], 1000):
+        records = json.loads(trial_matches_df[i:i + 1000].T.to_json()).values()
+        db.trial_match.insert_many(records)
+
+    return trial_matches_df.shape[0]
 
 
 def get_db(uri):
@@ -423,10 +894,57 @@ def get_db(uri):
         logging.error("MONGO_URI not set in SECRETS_JSON")
     else:
         os.environ["MONGO_URI"] = MONGO_URI
-        connection = MongoClient(MONGO_URI)
+        connection = get_client(MONGO_URI)
         return connection["matchminer"]
 
 
+def client_options(**options):
+    """
+    :param options: MongoClient options overriding the configured ones
+    :return: Options of the shared Mongo clients: CLIENT_OPTIONS, overridden by their environment variables and
+        the given options
+    """
+
+    configured = {}
+    for option, (envar, default) in CLIENT_OPTIONS.iteritems():
+        val = os.getenv(envar, default)
+        if val is not None and option != 'readPreference':
+            val = int(val)
+        configured[option] = val
+
+    configured.update(options)
+    return configured
+
+
+def get_client(uri, **options):
+    """
+    Returns the shared Mongo client of a URI. Every process creates its own client on first use, which keeps a
+    connection pool of at most "maxPoolSize" connections shared by all its threads, engines and validators.
+
+    :param uri: Mongo URI
+    :param options: MongoClient options overriding the configured ones, see "client_options"
+    :return: MongoClient
+    """
+
+    options = client_options(**options)
+    key = (uri, os.getpid(), tuple(sorted(options.iteritems())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            logging.debug('Connecting to MongoDB with %s' % ', '.join('%s=%s' % item for item in key[2]))
+            client = MongoClient(uri, **options)
+            _clients[key] = client
+    return client
+
+
+def close_clients():
+    """Closes the shared Mongo clients of this process"""
+
+    with _clients_lock:
+        for key in [key for key in _clients if key[1] == os.getpid()]:
+            _clients.pop(key).close()
+
+
 def get_structural_variants(g):
     """
     Performs a string search for the structural variant.
@@ -464,6 +982,26 @@ def clean_query_for_msi(g):
     return g
 
 
+def iter_match_segments(trial):
+    """
+    Yields every step, arm, and dose level of a trial that carries a match clause
+
+    :param trial: Entire trial object
+    """
+
+    for step in trial['treatment_list']['step']:
+        if 'match' in step:
+            yield step
+
+        for arm in step['arm']:
+            if 'match' in arm:
+                yield arm
+
+            for dose in arm['dose_level']:
+                if 'match' in dose:
+                    yield dose
+
+
 def get_cancer_type_match(trial):
     """
     Determines if the trial has criteria to match all solid or all liquid tumors in it.
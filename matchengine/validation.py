@@ -1,19 +1,119 @@
 """Copyright 2016 Dana-Farber Cancer Institute"""
 
 import os
+import threading
+import multiprocessing
+from multiprocessing.util import Finalize
 
-from cerberus1 import Validator
+from cerberus1 import Validator, DocumentError
 from cerberus1 import schema_registry
 from matchengine import schema as sch
-from matchengine.utilities import get_db
+from matchengine.compiler import compile_schema
+from matchengine.utilities import get_db, close_clients
+
+# schemas of match clauses, registered once so that the match validator can be built once
+schema_registry.add('yaml_match_schema', sch.yaml_match_schema)
+schema_registry.add('yaml_genomic_schema', sch.yaml_genomic_schema)
+schema_registry.add('yaml_clinical_schema', sch.yaml_clinical_schema)
+
+# trial fields whose values must not be in the trial collection yet
+UNIQUE_FIELDS = sorted(field for field, rules in sch.parent_schema.iteritems() if rules.get('unique'))
+
+# match clause validator of every thread; a validator holds the state of the document it validates and resets it
+# at the start of every validation, so it can be reused by one thread at a time
+_match_validators = threading.local()
+
+
+class ValidationCache(object):
+    """
+    Caches the database lookups of ConsentValidatorCerberus: the normalize table, with its values as sets, and the
+    values of unique fields in the trial collection. A validator shares its cache with its child validators and a
+    cache can be shared by the validators of many documents. It is never refreshed by itself: call "invalidate"
+    when the normalize table changed and "add_trial" when a trial is inserted, as "load_trials" does.
+    """
+
+    def __init__(self, db):
+        """
+        :param db: Mongo database
+        """
+
+        self.db = db
+        self.lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        """Drops all cached values, they are read from the database again on next use"""
+
+        with self.lock:
+            self._normalize = None
+            self._normalize_loaded = False
+            self._unique = {}
+
+    def normalize(self):
+        """
+        :return: Dictionary mapping "oncotree_primary_diagnosis" and "hugo_symbol" (when the table has it) to the
+            set of their valid values, None when there is no normalize table
+        """
+
+        with self.lock:
+            if not self._normalize_loaded:
+                table = self.db['normalize'].find_one()
+                if table:
+                    values = table.get('values', {})
+                    self._normalize = {
+                        'oncotree_primary_diagnosis': set(values.get('oncotree_primary_diagnosis', {}).values())
+                    }
+                    if 'hugo_symbol' in values:
+                        self._normalize['hugo_symbol'] = set(values['hugo_symbol'])
+                self._normalize_loaded = True
+
+            return self._normalize
+
+    def unique_values(self, field):
+        """
+        :param field: Trial field
+        :return: Set of the values of the field in the trial collection
+        """
+
+        with self.lock:
+            if field not in self._unique:
+                self._unique[field] = set(self.db.trial.distinct(field))
+            return self._unique[field]
+
+    def add_unique(self, field, value):
+        """
+        Adds the value of a unique field of a trial that was inserted
+
+        :param field: Trial field
+        :param value: Value of the field
+        """
+
+        self.unique_values(field).add(value)
+
+    def add_trial(self, trial):
+        """
+        Adds the values of the unique fields of a trial that was inserted or replaced
+
+        :param trial: Trial dictionary
+        """
+
+        for field in UNIQUE_FIELDS:
+            if trial.get(field) is not None:
+                self.add_unique(field, trial[field])
+
 
 class ConsentValidatorCerberus(Validator):
 
     def __init__(self, schema, *args, **kwargs):
         super(ConsentValidatorCerberus, self).__init__(schema, *args, **kwargs)
-        self.schema = schema
-        MONGO_URI = os.getenv("MONGO_URI")
-        self.db = get_db(MONGO_URI)
+
+        # child validators are created with the configuration of their parent and share its cache
+        self.cache = kwargs.get('cache')
+        if self.cache is None:
+            MONGO_URI = os.getenv("MONGO_URI")
+            self.cache = ValidationCache(get_db(MONGO_URI))
+            self._config['cache'] = self.cache
+        self.db = self.cache.db
 
     def _validate_consented(self, consented, field, value):
 
@@ -26,15 +126,12 @@ class ConsentValidatorCerberus(Validator):
             self._error(field, "Not consented")
 
     def _validate_match(self, match, field, value):
-        schema_registry.add('yaml_match_schema', sch.yaml_match_schema)
-        schema_registry.add('yaml_genomic_schema', sch.yaml_genomic_schema)
-        schema_registry.add('yaml_clinical_schema', sch.yaml_clinical_schema)
-        v = Validator(sch.yaml_match_schema)
-
+        v = match_validator()
         v.validate(value[0])
 
-        if len(v.errors) > 0:
-            self._error(field, v.errors)
+        errors = v.errors
+        if len(errors) > 0:
+            self._error(field, 'invalid match clause: %s' % errors)
 
     def _validate_normalized(self, normalized, field, value):
         ''' use normalization dictionary to control values
@@ -42,39 +139,182 @@ class ConsentValidatorCerberus(Validator):
         in the dictionary'''
 
         # load the mapping
-        normalize_table = self.db['normalize'].find_one()
+        normalize_table = self.cache.normalize()
 
         if not normalize_table:
             return
 
-        for key, val in value.iteritems():
-            if (isinstance(val, str) or isinstance(val, unicode)) and val[0] == "!":
-                val = val[1:]
-
+        for key, val in _unnormalized_values(normalize_table, value):
             if key == 'oncotree_primary_diagnosis':
-                if val not in normalize_table['values']['oncotree_primary_diagnosis'].values():
-                    self._error(field, "%s is not a valid value for oncotree_primary_diagnosis" % val)
-
-            elif key == 'hugo_symbol':
-                if 'hugo_symbol' in normalize_table['values'] and val not in normalize_table['values']['hugo_symbol']:
-                    self._error(422, "%s is not a valid hugo symbol" % val)
-
-            elif isinstance(val, dict):
-                self._validate_normalized(normalized, field, val)
-
-            elif isinstance(val, list):
-                for subitem in val:
-                    if isinstance(subitem, dict):
-                        self._validate_normalized(normalized, field, subitem)
+                self._error(field, "%s is not a valid value for oncotree_primary_diagnosis" % val)
+            else:
+                self._error(422, "%s is not a valid hugo symbol" % val)
 
     def _validate_unique(self, unique, field, value):
         """Rejects validation if the database already contains the given value in the given field"""
-        ids = self.db.trial.find().distinct(field)
-        if value in ids:
+        ids = self.cache.unique_values(field)
+        if _contains(ids, value):
             # TODO get the error handler to work with self._error
             raise ValueError("%s is not a unique protocol id" % str(value))
 
 
+def match_validator():
+    """
+    :return: Validator of match clauses of the calling thread, the schema is expanded once per thread
+    """
+
+    v = getattr(_match_validators, 'validator', None)
+    if v is None:
+        v = Validator(sch.yaml_match_schema)
+        _match_validators.validator = v
+    return v
+
+
+def _contains(values, val):
+    try:
+        return val in values
+    except TypeError:
+        return False
+
+
+def _unnormalized_values(normalize_table, value):
+    """
+    :param normalize_table: Normalize table as returned by "ValidationCache.normalize"
+    :param value: Treatment list or part of it
+    :return: Iterator over the (key, value) pairs of the diagnoses and hugo symbols missing from the table
+    """
+
+    for key, val in value.iteritems():
+        if (isinstance(val, str) or isinstance(val, unicode)) and val[0] == "!":
+            val = val[1:]
+
+        if key == 'oncotree_primary_diagnosis':
+            if not _contains(normalize_table['oncotree_primary_diagnosis'], val):
+                yield key, val
+
+        elif key == 'hugo_symbol':
+            if 'hugo_symbol' in normalize_table and not _contains(normalize_table['hugo_symbol'], val):
+                yield key, val
+
+        elif isinstance(val, dict):
+            for item in _unnormalized_values(normalize_table, val):
+                yield item
+
+        elif isinstance(val, list):
+            for subitem in val:
+                if isinstance(subitem, dict):
+                    for item in _unnormalized_values(normalize_table, subitem):
+                        yield item
+
+
+def _check_match(cache, match, field, value):
+    return _match_is_valid(value[0])
+
+
+def _check_normalized(cache, normalized, field, value):
+    normalize_table = cache.normalize()
+    return not normalize_table or next(_unnormalized_values(normalize_table, value), None) is None
+
+
+def _check_unique(cache, unique, field, value):
+    return not _contains(cache.unique_values(field), value)
+
+
+# compiled equivalents of the match clause validator and of ConsentValidatorCerberus with the trial schema
+_match_is_valid = compile_schema(sch.yaml_match_schema)
+_trial_is_valid = compile_schema(sch.parent_schema, checks={
+    'match': _check_match,
+    'normalized': _check_normalized,
+    'unique': _check_unique
+})
+
+
+def is_valid_trial(trial, cache):
+    """
+    Fast path of trial validation: tells whether ConsentValidatorCerberus would find no errors in the trial, without
+    building child validators and error trees. Only run the full validator for the errors of invalid trials.
+
+    :param trial: Trial dictionary
+    :param cache: ValidationCache of the database the trial is validated against
+    :return: Boolean flag
+    """
+
+    try:
+        return _trial_is_valid(trial, cache)
+    except Exception:
+        # the full validator raises the same error or reports it
+        return False
+
+
+def trial_errors(trial, validator):
+    """
+    Validates a trial with the compiled schema and, when it is invalid, with a reused validator for the errors.
+    Errors that abort the validation, like a duplicate protocol id or a trial that is not a dictionary, are
+    reported under the key None instead of being raised.
+
+    :param trial: Trial dictionary
+    :param validator: ConsentValidatorCerberus with the trial schema, it can be reused for any number of trials
+    :return: Dictionary of errors, empty when the trial is valid
+    """
+
+    try:
+        if is_valid_trial(trial, validator.cache):
+            return {}
+
+        validator.validate(trial)
+        return validator.errors
+    except (ValueError, DocumentError) as exc:
+        return {None: [str(exc)]}
+
+
+def validate_many(documents, workers=1, mongo_uri=None, cache=None):
+    """
+    Validates yaml specs in a pool of worker processes, each reusing its own validator and validation cache.
+    Results are yielded as soon as a trial is validated, in the order they finish.
+
+    :param documents: Iterable of trial dictionaries
+    :param workers: Number of processes the trials are validated in, they are validated in this process when 1
+    :param mongo_uri: Mongo URI of the trial and normalize collections
+    :param cache: ValidationCache used when the trials are validated in this process, a new one when None
+    :return: Iterator over (index, errors) tuples, with the position of the trial in "documents" and its errors
+        as returned by "trial_errors"
+    """
+
+    if workers <= 1:
+        cache = cache if cache is not None else ValidationCache(get_db(mongo_uri))
+        validator = ConsentValidatorCerberus(sch.parent_schema, cache=cache)
+        for index, document in enumerate(documents):
+            yield index, trial_errors(document, validator)
+        return
+
+    pool = multiprocessing.Pool(processes=workers, initializer=_init_validation_worker, initargs=(mongo_uri, ))
+    try:
+        for result in pool.imap_unordered(_validation_worker, enumerate(documents), chunksize=8):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+# state of a validation worker process, set once by "_init_validation_worker"
+_validation_worker_state = {}
+
+
+def _init_validation_worker(mongo_uri):
+    """Opens a Mongo client and creates the trial validator of a freshly started worker process"""
+
+    Finalize(None, close_clients, exitpriority=10)
+    cache = ValidationCache(get_db(mongo_uri))
+    _validation_worker_state['validator'] = ConsentValidatorCerberus(sch.parent_schema, cache=cache)
+
+
+def _validation_worker(item):
+    """Validates one trial in a worker process"""
+
+    index, document = item
+    return index, trial_errors(document, _validation_worker_state['validator'])
+
+
 def check_consent(clinical):
 
     # check conset.
@@ -0,0 +1,199 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import json
+import math
+import uuid
+import hashlib
+import itertools
+import logging
+import datetime as dt
+from pymongo import InsertOne, UpdateOne
+
+from matchengine.sort import add_sort_order_collection
+
+# indexes of the trial match collection, built on the staging collection before it is swapped in
+TRIAL_MATCH_INDEXES = [
+    [('sample_id', 1), ('protocol_no', 1)],
+    [('mrn', 1)],
+    [('protocol_no', 1)]
+]
+
+WRITE_MODES = ['swap', 'incremental']
+
+
+class MatchWriter(object):
+    """
+    Streams trial matches into a staging collection in batches, so that matches do not have to be kept
+    until all trials are matched. Closing the writer adds the sort order, builds the indexes and then
+    either swaps the staging collection in for the trial match collection with a single rename ("swap")
+    or applies only the differences to it ("incremental").
+
+    Documents are stored as "add_matches" stores them: ids as strings, the report date formatted, NaN as
+    null and every field that some match has set on all of them. Every document carries a "match_key",
+    a hash of its content, which identifies unchanged matches between runs.
+    """
+
+    def __init__(self, db, collection='trial_match', batch_size=1000, mode='swap', sort=True):
+        """
+        :param db: Mongo database
+        :param collection: Name of the collection that receives the matches
+        :param batch_size: Number of matches per insert
+        :param mode: "swap" or "incremental"
+        :param sort: Boolean flag; when false, the sort_order of the matches is kept as it is
+        """
+
+        if mode not in WRITE_MODES:
+            raise ValueError('Unknown write mode %s' % mode)
+
+        self.db = db
+        self.collection = collection
+        # every run stages into its own collection, so that concurrent runs do not drop each other's matches
+        self.staging = db['%s_staging_%s' % (collection, uuid.uuid4().hex)]
+        self.mode = mode
+        self.sort = sort
+
+        self.batch_size = batch_size
+        self.batch = []
+        self.count = 0
+
+        # documents inserted, updated and deleted in the trial match collection
+        self.inserted = 0
+        self.updated = 0
+        self.deleted = 0
+
+        # number of documents per field, used to set fields that only some matches have
+        self.fields = {}
+
+        # number of matches per match key; identical matches are told apart by their position in the run. Unlike
+        # the batch, it holds one entry per distinct match of the run, roughly 100 bytes each
+        self.seen = {}
+
+    def write(self, matches):
+        """
+        :param matches: List of trial match dictionaries
+        """
+
+        for match in matches:
+            doc = self._document(match)
+            key = doc['match_key']
+            self.seen[key] = self.seen.get(key, 0) + 1
+            if self.seen[key] > 1:
+                doc['match_key'] = hashlib.sha1('%s%d' % (key, self.seen[key])).hexdigest()
+
+            self.batch.append(doc)
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.staging.insert_many(self.batch)
+            self.batch = []
+
+    def close(self):
+        """
+        Sorts the staged matches and moves them into the trial match collection. The collection is left
+        as it is when there are no matches.
+
+        :return: Number of trial matches
+        """
+
+        self.flush()
+        if not self.count:
+            self.staging.drop()
+            logging.info('No trial matches, %s is left unchanged' % self.collection)
+            return 0
+
+        for field, count in self.fields.iteritems():
+            if count < self.count:
+                self.staging.update_many({field: {'$exists': False}}, {'$set': {field: None}})
+
+        for index in TRIAL_MATCH_INDEXES:
+            self.staging.create_index(index)
+        self.staging.create_index('match_key')
+
+        if self.sort:
+            logging.info('Sorting trial matches.')
+            add_sort_order_collection(self.staging)
+
+        if self.mode == 'incremental' and self.db[self.collection].find_one({'match_key': {'$exists': True}}):
+            self._apply_changes()
+            self.staging.drop()
+        else:
+            self.staging.rename(self.collection, dropTarget=True)
+            self.inserted = self.count
+
+        logging.info('Wrote %d trial match documents to %s: %d inserted, %d updated, %d deleted' %
+                     (self.inserted + self.updated + self.deleted, self.collection, self.inserted, self.updated,
+                      self.deleted))
+        return self.count
+
+    def _apply_changes(self):
+        """
+        Inserts the staged matches the trial match collection does not have yet, updates the sort order of
+        the ones it has and deletes the ones that are not staged, one batch of match keys at a time.
+        """
+
+        target = self.db[self.collection]
+        target.create_index('match_key')
+
+        # new and re-sorted matches
+        cursor = self.staging.find({}, {'_id': 0})
+        while True:
+            docs = list(itertools.islice(cursor, self.batch_size))
+            if not docs:
+                break
+
+            keys = [doc['match_key'] for doc in docs]
+            existing = dict((doc['match_key'], doc.get('sort_order'))
+                            for doc in target.find({'match_key': {'$in': keys}}, {'match_key': 1, 'sort_order': 1}))
+
+            requests = []
+            for doc in docs:
+                if doc['match_key'] not in existing:
+                    requests.append(InsertOne(doc))
+                    self.inserted += 1
+                elif existing[doc['match_key']] != doc['sort_order']:
+                    requests.append(UpdateOne({'match_key': doc['match_key']},
+                                              {'$set': {'sort_order': doc['sort_order']}}))
+                    self.updated += 1
+
+            if requests:
+                target.bulk_write(requests, ordered=False)
+
+        # matches that are gone, including documents of an earlier version without a match key
+        self.deleted += target.delete_many({'match_key': {'$exists': False}}).deleted_count
+        cursor = target.find({}, {'match_key': 1, '_id': 0})
+        stale = []
+        while True:
+            keys = [doc['match_key'] for doc in itertools.islice(cursor, self.batch_size)]
+            if not keys:
+                break
+
+            staged = set(doc['match_key'] for doc in self.staging.find({'match_key': {'$in': keys}},
+                                                                        {'match_key': 1}))
+            stale.extend(key for key in keys if key not in staged)
+
+        for i in range(0, len(stale), self.batch_size):
+            self.deleted += target.delete_many({'match_key': {'$in': stale[i:i + self.batch_size]}}).deleted_count
+
+    def _document(self, match):
+
+        doc = {'sort_order': -1}
+        for field, val in match.iteritems():
+            if field in ('clinical_id', 'genomic_id'):
+                val = str(val)
+            elif field == 'report_date' and isinstance(val, dt.datetime):
+                val = dt.datetime.strftime(val, '%Y-%m-%d %X')
+            elif isinstance(val, float) and math.isnan(val):
+                val = None
+
+            doc[field] = val
+            self.fields[field] = self.fields.get(field, 0) + 1
+
+        # the sort order depends on the other matches of the sample and is compared separately
+        content = json.dumps(dict((field, val) for field, val in doc.iteritems()
+                                  if field != 'sort_order' and val is not None), sort_keys=True, default=str)
+        doc['match_key'] = hashlib.sha1(content).hexdigest()
+
+        self.count += 1
+        return doc
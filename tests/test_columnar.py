@@ -0,0 +1,64 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+from matchengine.engine import MatchEngine, MATCH_PROJECTION
+from matchengine.columnar import ColumnarGenomic
+from tests import TestSetUp
+
+
+class TestColumnar(TestSetUp):
+
+    def setUp(self):
+        super(TestColumnar, self).setUp()
+
+        # add genomic and clinical collections
+        self.add_clinical()
+        self.add_genomic()
+        self.add_wildtype()
+
+    def tearDown(self):
+        self.db.clinical.drop()
+        self.db.genomic.drop()
+
+    def _assert(self, store, item):
+        g, _, _ = self.me.prepare_genomic_criteria(item)
+        expected = sorted(str(doc['_id']) for doc in self.db.genomic.find(g, {'_id': 1}))
+        found = sorted(str(doc['_id']) for doc in store.find(g, {'_id': 1}))
+        assert expected == found, '%s\n%s\n%s' % (g, expected, found)
+
+    def test_find(self):
+
+        store = ColumnarGenomic(self.db, MATCH_PROJECTION)
+        assert store.size == 14, store.size
+
+        self._assert(store, {'hugo_symbol': 'EGFR'})
+        self._assert(store, {'hugo_symbol': '!BRAF'})
+        self._assert(store, {'hugo_symbol': 'EGFR', 'variant_category': 'Any Variation'})
+        self._assert(store, {'hugo_symbol': 'EGFR', 'variant_category': '!Mutation'})
+        self._assert(store, {'hugo_symbol': 'EGFR', 'protein_change': 'p.L858R'})
+        self._assert(store, {'hugo_symbol': 'EGFR', 'wildcard_protein_change': 'p.F346'})
+        self._assert(store, {'hugo_symbol': 'EGFR', 'cnv_call': 'High Amplification'})
+        self._assert(store, {'hugo_symbol': 'EGFR', 'exon': '!13'})
+        self._assert(store, {'hugo_symbol': 'EGFR', 'wildtype': 'true'})
+        self._assert(store, {'hugo_symbol': 'EGFR', 'wildtype': 'false'})
+
+        # documents without a WILDTYPE field are treated as non-wildtype
+        doc = store.find({'SAMPLE_ID': '4'}, {'SAMPLE_ID': 1, 'WILDTYPE': 1})
+        assert doc == [{'SAMPLE_ID': '4'}], doc
+
+        # queries on fields that are not in memory are rejected
+        try:
+            store.find({'STRUCTURAL_VARIANT_COMMENT': {'$regex': 'EGFR'}}, {'_id': 1})
+            assert False
+        except ValueError:
+            pass
+
+    def test_run_query(self):
+
+        me = MatchEngine(self.db)
+        in_memory = MatchEngine(self.db, in_memory=True)
+
+        for value in [{'HUGO_SYMBOL': 'EGFR'}, {'HUGO_SYMBOL': '!BRAF'}, {'HUGO_SYMBOL': 'EGFR', 'EXON': 19}]:
+            expected, expected_ginfo = me.run_query({'type': 'genomic', 'value': dict(value)})
+            found, ginfo = in_memory.run_query({'type': 'genomic', 'value': dict(value)})
+            assert expected == found, '%s\n%s' % (expected, found)
+            assert sorted(expected_ginfo) == sorted(ginfo)
@@ -0,0 +1,109 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import os
+import copy
+
+from cerberus1 import Validator
+from matchengine import schema as sch
+from matchengine.compiler import compile_schema
+from matchengine.engine import MatchEngine
+from matchengine.validation import is_valid_trial, ValidationCache, ConsentValidatorCerberus
+from tests import TestSetUp
+
+YAML_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data/yaml/'))
+
+
+class TestCompiler(TestSetUp):
+
+    def setUp(self):
+        super(TestCompiler, self).setUp()
+        self.db.normalize.drop()
+        self.db.trial.drop()
+        self.me = MatchEngine(self.db)
+        self.cache = ValidationCache(self.db)
+
+    def tearDown(self):
+        self.db.normalize.drop()
+        self.db.trial.drop()
+
+    def assert_same(self, schema, documents, **kwargs):
+        valid = compile_schema(schema, **kwargs)
+        for document in documents:
+            expected = Validator(schema, **kwargs).validate(copy.deepcopy(document))
+            assert valid(document) is expected, (document, expected)
+
+    def test_compile_schema(self):
+
+        schema = {
+            'name': {'type': 'string', 'required': True, 'empty': False},
+            'status': {'type': 'string', 'allowed': ['open', 'closed'], 'nullable': True},
+            'tags': {'type': 'list', 'allowed': ['a', 'b']},
+            'count': {'type': 'integer'},
+            'arms': {'type': 'list', 'schema': {'type': 'dict', 'schema': {'code': {'type': 'string'}}}},
+            'extra': {'type': 'dict', 'allow_unknown': True, 'schema': {'x': {'type': 'boolean'}}},
+            'match': {'type': 'dict', 'schema': 'yaml_match_schema'}
+        }
+        self.assert_same(schema, [
+            {'name': 'x'},
+            {'name': ''},
+            {},
+            {'name': None},
+            {'name': 'x', 'unknown': 1},
+            {'name': 'x', 'status': None, 'tags': ['a', 'b'], 'count': 3L},
+            {'name': 'x', 'status': 'pending'},
+            {'name': 'x', 'tags': ['c']},
+            {'name': 'x', 'count': '3'},
+            {'name': 'x', 'count': True},
+            {'name': 'x', 'arms': [{'code': 'a'}, {'code': 'b'}]},
+            {'name': 'x', 'arms': [{'code': 'a'}, {'code': 1}]},
+            {'name': 'x', 'arms': [{'code': 'a', 'unknown': 1}]},
+            {'name': 'x', 'arms': [None]},
+            {'name': 'x', 'arms': 'a'},
+            {'name': 'x', 'extra': {'x': True, 'unknown': None}},
+            {'name': 'x', 'extra': {'x': 'true'}},
+            {'name': 'x', 'match': {'and': [{'genomic': {'hugo_symbol': 'BRAF'}}, {'clinical': {'age_numerical': '>=18'}}]}},
+            {'name': 'x', 'match': {'and': [{'genomic': {'hugo_symbol': 'BRAF'}}, {'clinical': {'er_status': 'Maybe'}}]}},
+            {'name': 'x', 'match': {'or': [{'genomic': {'bogus': 'BRAF'}}]}}
+        ])
+        self.assert_same(schema, [{'name': 'x', 'unknown': 1}, {'name': 'x', 'arms': [{'unknown': 1}]}],
+                         allow_unknown=True)
+
+        # rules without a compiled equivalent are rejected instead of ignored
+        for rules in [{'type': 'string', 'regex': 'a+'}, {'type': 'set'}, {'schema': {'x': {'type': 'string'}}}]:
+            failed = False
+            try:
+                compile_schema({'field': rules})
+            except ValueError:
+                failed = True
+            assert failed, rules
+
+    def test_is_valid_trial(self):
+
+        with open(os.path.join(YAML_DIR, '00-001.yml')) as f:
+            trial = self.me.validate_yaml_format(f.read())[1]
+
+        def full(document):
+            v = ConsentValidatorCerberus(sch.parent_schema, cache=ValidationCache(self.db))
+            return v.validate(copy.deepcopy(document))
+
+        assert is_valid_trial(trial, self.cache) and full(trial)
+
+        invalid = copy.deepcopy(trial)
+        del invalid['protocol_no']
+        step = invalid['treatment_list']['step'][0]
+        step['match'] = [{'and': [{'genomic': {'hugo_symbol': 5}}]}]
+        assert not is_valid_trial(invalid, self.cache) and not full(invalid)
+
+        # custom rules read the normalize table and the trial collection through the cache
+        self.db.normalize.insert_one({'values': {'oncotree_primary_diagnosis': {'a': '_SOLID_'},
+                                                 'hugo_symbol': ['BRAF']}})
+        self.cache.invalidate()
+        assert not is_valid_trial(trial, self.cache) and not full(trial)
+
+        self.db.normalize.update_one({}, {'$push': {'values.hugo_symbol': 'EGFR'}})
+        self.cache.invalidate()
+        assert is_valid_trial(trial, self.cache)
+
+        # a duplicate protocol id makes the full validator raise, the fast path leaves that to it
+        self.cache.add_unique('protocol_id', trial['protocol_id'])
+        assert not is_valid_trial(trial, self.cache)
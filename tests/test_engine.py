@@ -2,10 +2,13 @@
 
 __author__ = 'priti,james,zachary'
 import os
+import threading
 import networkx as nx
 
 from matchengine.engine import MatchEngine
-from matchengine.utilities import build_oncotree
+from matchengine.validation import match_validator, validate_many
+from matchengine.utilities import build_oncotree, materialize_oncotree, ONCOTREE_ANCESTORS, ONCOTREE_TUMOR_TYPE, \
+    TRIAL_CACHE
 from tests import TestSetUp
 
 YAML_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data/yaml/'))
@@ -87,6 +90,116 @@ class TestMatchEngine(TestSetUp):
         status, data = self.me.validate_yaml_format(test_inp)
         assert status == 0
 
+    def test_validate_match(self):
+
+        data = self.me.validate_yaml_format(read_file(os.path.join(YAML_DIR, '00-001.yml')))[1]
+        step = data['treatment_list']['step'][0]
+        step['match'] = [{'and': [{'genomic': {'hugo_symbol': 5}}, {'clinical': {'age_numerical': '>=18'}}]}]
+        errors = self.me.validate_yaml_data(data)
+        match_errors = errors['treatment_list'][0]['step'][0][0][0]['match']
+        assert 'must be of string type' in match_errors[0], errors
+
+        # the match validator is built once per thread and does not carry errors over to the next clause
+        step = data['treatment_list']['step'][0]
+        step['match'] = [{'and': [{'genomic': {'hugo_symbol': 'BRAF', 'variant_category': 'Mutation'}},
+                                  {'clinical': {'age_numerical': '>=18'}}]}]
+        errors = self.me.validate_yaml_data(data)
+        assert errors == {}, errors
+        assert match_validator() is match_validator()
+
+        validators = []
+        thread = threading.Thread(target=lambda: validators.append(match_validator()))
+        thread.start()
+        thread.join()
+        assert validators[0] is not match_validator()
+
+    def test_reused_validator(self):
+
+        v = match_validator()
+        clause = {'and': [{'genomic': {'hugo_symbol': 5}}, {'clinical': {'er_status': 'Maybe'}}]}
+        assert not v.validate(clause)
+        errors = v.errors
+        assert v.document_error_tree['and'] is not None
+
+        # child validators are pooled and reset, errors and their trees are only built when there are errors
+        assert v.validate({'and': [{'genomic': {'hugo_symbol': 'BRAF', 'variant_category': 'Mutation'}},
+                                    {'clinical': {'er_status': 'Positive'}}]})
+        assert v.errors == {}
+        assert v.document_error_tree['and'] is None and len(v._errors) == 0
+
+        assert not v.validate(clause)
+        assert v.errors == errors, v.errors
+        assert v.schema_error_tree['and'] is not None
+
+    def test_validation_cache(self):
+
+        data = self.me.validate_yaml_format(read_file(os.path.join(YAML_DIR, '00-001.yml')))[1]
+        self.db.normalize.insert_one({'values': {'oncotree_primary_diagnosis': {'a': '_SOLID_'},
+                                                 'hugo_symbol': ['BRAF']}})
+        errors = self.me.validate_yaml_data(data)
+        assert errors == {422: ['EGFR is not a valid hugo symbol']}, errors
+
+        # the table is read once, until the cache is invalidated
+        self.db.normalize.update_one({}, {'$push': {'values.hugo_symbol': 'EGFR'}})
+        assert self.me.validate_yaml_data(data) == errors
+        assert self.me.validation_cache.normalize()['hugo_symbol'] == set(['BRAF'])
+        self.me.validation_cache.invalidate()
+        assert self.me.validate_yaml_data(data) == {}
+
+        # protocol ids of inserted trials are added to the cached ones
+        self.me.validation_cache.add_unique('protocol_id', data['protocol_id'])
+        failed = False
+        try:
+            self.me.validate_yaml_data(data)
+        except ValueError:
+            failed = True
+        assert failed
+        self.db.normalize.drop()
+
+    def test_load_trials_updates_validation_cache(self):
+
+        path = os.path.join(YAML_DIR, '00-001.yml')
+        data = self.me.validate_yaml_format(read_file(path))[1]
+        assert self.me.validate_yaml_data(data) == {}
+
+        # a duplicate of a trial loaded after the protocol ids were cached is rejected, the cached ids are
+        # updated in place instead of being read again
+        ids = self.me.validation_cache.unique_values('protocol_id')
+        assert self.me.load_trials([path]) == 1
+        assert self.me.validation_cache.unique_values('protocol_id') is ids
+        try:
+            failed = False
+            try:
+                self.me.validate_yaml_data(data)
+            except ValueError:
+                failed = True
+            assert failed
+        finally:
+            self.db.trial.delete_one({'protocol_no': data['protocol_no']})
+            self.db[TRIAL_CACHE].drop()
+
+    def test_validate_many(self):
+
+        trials = [self.me.validate_yaml_format(read_file(os.path.join(YAML_DIR, yml)))[1]
+                  for yml in ['00-001.yml', '00-002.yml', '00-004.yml']]
+        trials.append(['not', 'a', 'trial'])
+        expected = [self.me.validate_yaml_data(trial) for trial in trials[:3]]
+
+        for workers in [1, 2]:
+            results = dict(self.me.validate_many(trials, workers=workers))
+            assert sorted(results) == [0, 1, 2, 3]
+            assert [results[i] for i in range(3)] == expected, results
+            assert results[3].keys() == [None]
+
+        # without an engine, e.g. in the validate subcommand, a validation cache of its own is used
+        assert dict(validate_many(trials[:3])) == dict(enumerate(expected))
+
+        # errors that the single trial validation raises are reported with the other trial's results
+        self.me.validation_cache.add_unique('protocol_id', trials[0]['protocol_id'])
+        results = dict(self.me.validate_many(trials[:2]))
+        assert 'not a unique protocol id' in results[0][None][0], results
+        assert results[1] == expected[1]
+
     def test_run_query(self):
 
         # reinstantiate MatchEngine so that the set of all sample ids in the database includes the documents that were
@@ -119,6 +232,91 @@ class TestMatchEngine(TestSetUp):
         assert 'actionability' in matches[0]
         assert matches[0]['mmr_status'] == 'Proficient (MMR-P / MSS)'
 
+    def test_run_query_cache(self):
+
+        self.me = MatchEngine(self.db)
+
+        # the same leaf is only queried once
+        node = {'type': 'genomic', 'value': {'HUGO_SYMBOL': 'EGFR', 'VARIANT_CATEGORY': 'Mutation'}}
+        result1, matches1 = self.me.run_query(node)
+        node = {'type': 'genomic', 'value': {'HUGO_SYMBOL': 'EGFR', 'VARIANT_CATEGORY': 'Mutation'}}
+        result2, matches2 = self.me.run_query(node)
+        assert self.me.cache_misses == 1, self.me.cache_misses
+        assert self.me.cache_hits == 1, self.me.cache_hits
+        assert result1 == result2
+        assert len(matches1) == len(matches2) == 4, len(matches1)
+
+        # annotating a returned match does not leak into the cache
+        matches1[0]['protocol_no'] = '00-001'
+        _, matches3 = self.me.run_query({'type': 'genomic', 'value': {'HUGO_SYMBOL': 'EGFR',
+                                                                      'VARIANT_CATEGORY': 'Mutation'}})
+        assert 'protocol_no' not in matches3[0]
+
+        # negated leaves are cached separately from their positive counterpart
+        result4, _ = self.me.run_query({'type': 'genomic', 'value': {'HUGO_SYMBOL': '!EGFR',
+                                                                     'VARIANT_CATEGORY': 'Mutation'}})
+        assert self.me.cache_misses == 2, self.me.cache_misses
+        assert not result4 & result1
+
+        # clinical leaves with age criteria are cached as well
+        for _ in range(2):
+            self.me.run_query({'type': 'clinical', 'value': {'ONCOTREE_PRIMARY_DIAGNOSIS': 'Melanoma',
+                                                             'AGE_NUMERICAL': '>=18'}})
+        assert self.me.cache_misses == 3, self.me.cache_misses
+        assert self.me.cache_hits == 3, self.me.cache_hits
+
+    def test_clinical_documents(self):
+
+        self.me = MatchEngine(self.db)
+        sample_id = self.db.clinical.find_one()['SAMPLE_ID']
+
+        # samples are fetched once and kept for the rest of the run
+        count = self.db.clinical.count({'SAMPLE_ID': sample_id})
+        clinical = self.me._clinical_documents(set([sample_id, 'NOT-A-SAMPLE']))
+        assert len(clinical[sample_id]) == count, clinical[sample_id]
+        assert clinical['NOT-A-SAMPLE'] == []
+        assert 'SAMPLE_ID' in clinical[sample_id][0]
+        assert 'BIRTH_DATE' not in clinical[sample_id][0]
+
+        self.db.clinical.delete_many({'SAMPLE_ID': sample_id})
+        assert len(self.me._clinical_documents(set([sample_id]))[sample_id]) == count
+
+    def test_materialize_oncotree(self):
+
+        self.db.clinical.drop()
+        self.add_clinical()
+        self.db.clinical.insert_many([
+            {'SAMPLE_ID': 'AML', 'MRN': 'AML', 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': 'Acute Myeloid Leukemia'},
+            {'SAMPLE_ID': 'UNKNOWN', 'MRN': 'UNKNOWN', 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': 'Not A Diagnosis'},
+            {'SAMPLE_ID': 'NONE', 'MRN': 'NONE'}
+        ])
+
+        criteria = ['Melanoma', '!Melanoma', 'Skin', '_SOLID_', '!_SOLID_', '_LIQUID_', '!_LIQUID_',
+                    ['Melanoma', 'Glioblastoma'], ['!Melanoma', '!Glioblastoma'], ['Melanoma', '_LIQUID_']]
+
+        def find(me, criterium):
+            c = me.prepare_clinical_criteria({'oncotree_primary_diagnosis': criterium})
+            return c, set(self.db.clinical.find(c).distinct('SAMPLE_ID'))
+
+        expected = [find(MatchEngine(self.db), criterium)[1] for criterium in criteria]
+        assert not MatchEngine(self.db).oncotree_paths
+
+        materialize_oncotree(self.db)
+        me = MatchEngine(self.db)
+        assert me.oncotree_paths
+
+        doc = self.db.clinical.find_one({'SAMPLE_ID': 'AML'})
+        assert ['AML', 'BLOOD', 'LEUK'] == [code for code in doc[ONCOTREE_ANCESTORS] if code != 'root'], doc
+        assert doc[ONCOTREE_TUMOR_TYPE] == ['liquid'], doc
+        assert self.db.clinical.find_one({'SAMPLE_ID': 'NONE'})[ONCOTREE_ANCESTORS] == []
+
+        # diagnoses are matched on the materialized fields, with the same results
+        for criterium, samples in zip(criteria, expected):
+            c, results = find(me, criterium)
+            assert results == samples, '%s\n%s\n%s' % (criterium, samples, results)
+            if criterium != ['Melanoma', '_LIQUID_']:
+                assert 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME' not in c, c
+
     def test_prepare_clinical_criteria(self):
 
         onc = 'ONCOTREE_PRIMARY_DIAGNOSIS'
@@ -0,0 +1,106 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import os
+import csv
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+from bson import json_util
+from collections import OrderedDict
+
+from matchengine.export import *
+from matchengine.writer import MatchWriter
+from tests import TestSetUp
+
+
+class TestExport(TestSetUp):
+
+    def setUp(self):
+        super(TestExport, self).setUp()
+        self.db.trial_match.drop()
+        self.tmpdir = tempfile.mkdtemp()
+
+        matches = self.get_demo_trial_matches()
+        matches[0]['mrn'] = '222'
+        matches[1]['trial_accrual_status'] = 'closed'
+        matches[2]['first_last'] = u'FIRST L\xc4ST'
+        del matches[3]['allele_fraction']
+
+        writer = MatchWriter(self.db)
+        writer.write(matches)
+        writer.close()
+
+    def tearDown(self):
+        self.db.trial_match.drop()
+        shutil.rmtree(self.tmpdir)
+
+    def export(self, file_format, compression=None, **kwargs):
+        path = export_path(os.path.join(self.tmpdir, 'results'), file_format, compression)
+        count = export_results(self.db, path, file_format, compression, **kwargs)
+        return path, count
+
+    def test_export_path(self):
+
+        assert export_path('results', 'csv') == 'results.csv'
+        assert export_path('results', 'json', 'gzip') == 'results.json.gz'
+        assert export_path('results', 'json', 'zstd') == 'results.json.zst'
+        assert export_path('results', 'parquet', 'gzip') == 'results.parquet'
+
+    def test_export_csv(self):
+
+        path, count = self.export('csv')
+        assert count == 14
+        with open(path) as f:
+            reader = csv.DictReader(f)
+            rows = list(reader)
+        assert reader.fieldnames == EXPORT_FIELDS
+        assert len(rows) == 14
+
+        rows = dict((row['_id'], row) for row in rows)
+        doc = self.db.trial_match.find_one({'first_last': u'FIRST L\xc4ST'})
+        assert rows[str(doc['_id'])]['first_last'] == 'FIRST L\xc3\x84ST'
+        assert rows[str(doc['_id'])]['wildtype'] == 'false'
+        assert rows[str(doc['_id'])]['cnv_call'] == ''
+
+    def test_export_json(self):
+
+        path, _ = self.export('json', 'gzip', open_only=True, mrns=['111'])
+        with gzip.open(path) as f:
+            lines = f.read().splitlines()
+        docs = [json_util.loads(line) for line in lines]
+        assert len(docs) == 12
+        assert all(doc['mrn'] == '111' and doc['trial_accrual_status'] == 'open' for doc in docs)
+        assert json.loads(lines[0], object_pairs_hook=OrderedDict).keys() == EXPORT_FIELDS
+
+    def test_export_zstd(self):
+
+        if zstandard is None:
+            raise unittest.SkipTest('zstandard is not installed')
+
+        path, count = self.export('csv', 'zstd', mrns=['222'])
+        assert count == 1
+        with open(path, 'rb') as f:
+            rows = zstandard.ZstdDecompressor().decompressobj().decompress(f.read()).splitlines()
+        assert len(rows) == 2 and rows[0].startswith('mrn,sample_id'), rows
+
+    def test_export_parquet(self):
+
+        if pa is None:
+            raise unittest.SkipTest('pyarrow is not installed')
+
+        path, count = self.export('parquet', 'gzip')
+        assert count == 14
+        table = pq.read_table(path)
+        assert table.schema.names == EXPORT_FIELDS
+        assert str(table.schema.field_by_name('tier').type) == 'int64'
+
+        df = table.to_pandas()
+        assert df['allele_fraction'].isnull().sum() == 1
+        assert df['position'].tolist() == [140453136] * 14
+
+        path = os.path.join(self.tmpdir, 'batches.parquet')
+        assert export_matches(iter_matches(self.db), path, 'parquet', batch_size=5) == 14
+        assert pq.ParquetFile(path).num_row_groups == 3
+        assert sorted(pq.read_table(path).to_pandas()['_id']) == sorted(df['_id'])
@@ -0,0 +1,84 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import os
+
+from matchengine.engine import MatchEngine
+from matchengine.indexes import *
+from matchengine.utilities import parse_yaml
+from tests import TestSetUp
+
+YAML_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data/yaml/'))
+
+
+class TestIndexes(TestSetUp):
+
+    def setUp(self):
+        super(TestIndexes, self).setUp()
+        self.me = MatchEngine(self.db)
+
+    def tearDown(self):
+        self.db.clinical.drop_indexes()
+        self.db.genomic.drop_indexes()
+
+    def test_query_shapes(self):
+
+        g, _, _ = self.me.prepare_genomic_criteria({'hugo_symbol': 'BRAF', 'protein_change': 'p.V600E'})
+        assert query_shapes(g) == [(('TRUE_HUGO_SYMBOL', 'eq'), ('TRUE_PROTEIN_CHANGE', 'eq'), ('WILDTYPE', 'eq'))]
+
+        c = {'BIRTH_DATE': {'$lte': 1}, 'GENDER': {'$ne': 'Male'}, 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': {'$in': []}}
+        assert query_shapes(c) == [(('BIRTH_DATE', 'range'), ('GENDER', 'other'),
+                                    ('ONCOTREE_PRIMARY_DIAGNOSIS_NAME', 'eq'))]
+
+        # one shape per branch of an "or"
+        assert query_shapes({'$or': [{'A': 1}, {'B': {'$gt': 1}}], 'C': 1}) == [(('A', 'eq'), ('C', 'eq')),
+                                                                               (('B', 'range'), ('C', 'eq'))]
+
+    def test_advise_indexes(self):
+
+        shapes = {
+            ('clinical', (('BIRTH_DATE', 'range'), ('ONCOTREE_PRIMARY_DIAGNOSIS_NAME', 'eq'))): 3,
+            ('clinical', (('ONCOTREE_PRIMARY_DIAGNOSIS_NAME', 'eq'), )): 1,
+            ('clinical', (('GENDER', 'other'), )): 1,
+            ('genomic', (('ONCOTREE_PRIMARY_DIAGNOSIS_ANCESTORS', 'eq'),
+                         ('ONCOTREE_PRIMARY_DIAGNOSIS_TUMOR_TYPE', 'eq'))): 1
+        }
+        self.db.genomic.create_index([('ONCOTREE_PRIMARY_DIAGNOSIS_ANCESTORS', 1)])
+
+        # prefixes of other indexes, fields that cannot bound a scan and parallel arrays are left out
+        assert advise_indexes(self.db, shapes) == [
+            ('clinical', [('ONCOTREE_PRIMARY_DIAGNOSIS_NAME', 1), ('BIRTH_DATE', 1)])
+        ]
+
+    def test_provision_indexes(self):
+
+        shapes = collect_query_shapes(self.me, list(self.db.trial.find()))
+        assert ('genomic', (('TRUE_HUGO_SYMBOL', 'eq'), )) in shapes
+
+        # the map collection is left as it is
+        self.db.map.insert_one({'key_old': 'PROVISION', 'key_new': 'PROVISION', 'values': {}})
+        before = self.db.clinical.index_information()
+        advised, plans = provision_indexes(self.db, dry_run=True)
+        assert self.db.clinical.index_information() == before
+        assert ('clinical', [('SAMPLE_ID', 1)]) in advised, advised
+        assert set((collection, shape) for collection, shape, _, _ in plans) == set(shapes)
+
+        provision_indexes(self.db, field_map=self.me.field_map)
+        assert self.db.map.find_one({'key_old': 'PROVISION'}) is not None
+        indexes = [index['key'] for index in self.db.clinical.index_information().values()]
+        assert [('SAMPLE_ID', 1)] in indexes, indexes
+
+    def test_provision_indexes_without_map(self):
+
+        # the load subcommand leaves the map collection empty, the default map is used without being stored
+        self.db.trial.drop()
+        self.db.map.drop()
+        with open(os.path.join(YAML_DIR, '00-001.yml')) as f:
+            self.db.trial.insert_one(parse_yaml(f.read()))
+        try:
+            advised, plans = provision_indexes(self.db, dry_run=True)
+            shapes = [shape for collection, shape, _, _ in plans if collection == 'genomic']
+            assert (('TRUE_HUGO_SYMBOL', 'eq'), ('TRUE_PROTEIN_CHANGE', 'eq'), ('TRUE_TRANSCRIPT_EXON', 'eq'),
+                    ('VARIANT_CATEGORY', 'eq'), ('WILDTYPE', 'eq')) in shapes, shapes
+            assert 'map' not in self.db.collection_names()
+        finally:
+            self.db.trial.drop()
@@ -0,0 +1,155 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import datetime as dt
+import pandas as pd
+
+from matchengine.load import *
+from tests import TestSetUp
+
+
+class TestLoad(TestSetUp):
+
+    def setUp(self):
+        super(TestLoad, self).setUp()
+        self.db.clinical.drop()
+        self.db.genomic.drop()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.db.clinical.drop()
+        self.db.genomic.drop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_csv_chunks(self):
+
+        chunks = list(read_csv_chunks('./examples/clinical.example.csv', chunksize=5))
+        assert len(chunks) > 1
+        assert all(len(chunk.index) <= 5 for chunk in chunks)
+        assert all(chunk['MRN'].map(lambda x: isinstance(x, basestring)).all() for chunk in chunks)
+
+    def test_load(self):
+
+        clinical = pd.DataFrame([
+            {'MRN': '01', 'SAMPLE_ID': 'S1', 'BIRTH_DATE': '1950-01-02', 'REPORT_DATE': '2017-01-01'},
+            {'MRN': '02', 'SAMPLE_ID': 'S2', 'BIRTH_DATE': '1960-03-04', 'REPORT_DATE': None}
+        ])
+        assert load_clinical(self.db, iter_chunks(clinical, chunksize=1)) == 2
+
+        c = self.db.clinical.find_one({'SAMPLE_ID': 'S1'})
+        assert c['BIRTH_DATE'] == dt.datetime(1950, 1, 2), c
+        assert c['REPORT_DATE'] == dt.datetime(2017, 1, 1), c
+        assert self.db.clinical.find_one({'SAMPLE_ID': 'S2'})['REPORT_DATE'] is None
+
+        genomic = pd.DataFrame([
+            {'SAMPLE_ID': 'S1', 'TRUE_HUGO_SYMBOL': 'EGFR', 'TRUE_TRANSCRIPT_EXON': 13.0, 'ALLELE_FRACTION': 0.5},
+            {'SAMPLE_ID': 'S2', 'TRUE_HUGO_SYMBOL': 'BRAF', 'TRUE_TRANSCRIPT_EXON': None, 'ALLELE_FRACTION': None},
+            {'SAMPLE_ID': 'S3', 'TRUE_HUGO_SYMBOL': 'KRAS', 'TRUE_TRANSCRIPT_EXON': 2.0, 'ALLELE_FRACTION': 0.1}
+        ])
+        assert load_genomic(self.db, iter_chunks(genomic, chunksize=2)) == 3
+
+        g = self.db.genomic.find_one({'SAMPLE_ID': 'S1'})
+        assert g['CLINICAL_ID'] == c['_id'], g
+        assert g['TRUE_TRANSCRIPT_EXON'] == 13 and isinstance(g['TRUE_TRANSCRIPT_EXON'], int), g
+        g = self.db.genomic.find_one({'SAMPLE_ID': 'S2'})
+        assert g['TRUE_TRANSCRIPT_EXON'] is None and g['ALLELE_FRACTION'] is None, g
+        assert self.db.genomic.find_one({'SAMPLE_ID': 'S3'})['CLINICAL_ID'] is None
+
+    def test_load_workers(self):
+
+        clinical = pd.DataFrame([{'MRN': str(i), 'SAMPLE_ID': 'S%d' % i, 'BIRTH_DATE': '1950-01-02'}
+                                 for i in range(50)])
+        assert load_clinical(self.db, iter_chunks(clinical, chunksize=3), workers=4) == 50
+
+        genomic = pd.DataFrame([{'SAMPLE_ID': 'S%d' % (i % 60), 'TRUE_HUGO_SYMBOL': 'EGFR'} for i in range(200)])
+        assert load_genomic(self.db, iter_chunks(genomic, chunksize=7), workers=4) == 200
+        assert self.db.genomic.count() == 200
+        assert self.db.genomic.count({'CLINICAL_ID': None}) == 30
+
+        inserter = ChunkInserter(self.db.genomic, workers=2)
+        inserter.insert(pd.DataFrame([{'_id': 1}, {'_id': 1}]))
+        failed = False
+        try:
+            inserter.close()
+        except Exception:
+            failed = True
+        assert failed
+
+        # the inserting threads are stopped when reading the chunks fails
+        def chunks():
+            yield clinical[:10]
+            raise ValueError('unreadable chunk')
+
+        threads = threading.active_count()
+        failed = False
+        try:
+            load_clinical(self.db, chunks(), workers=4)
+        except ValueError:
+            failed = True
+        assert failed and threading.active_count() == threads, threading.enumerate()
+
+    def test_read_columnar_chunks(self):
+
+        if pa is None:
+            raise unittest.SkipTest('pyarrow is not installed')
+
+        clinical = pa.Table.from_pandas(pd.DataFrame({
+            'MRN': [1, 2, 3],
+            'SAMPLE_ID': ['S1', 'S2', 'S3'],
+            'BIRTH_DATE': pd.to_datetime(['1950-01-02', '1960-03-04', None]),
+            'UNUSED': ['a', 'b', 'c']
+        }), preserve_index=False)
+
+        path = os.path.join(self.tmpdir, 'clinical.parquet')
+        pq.write_table(clinical, path, row_group_size=2)
+        chunks = list(read_parquet_chunks(path, columns=CLINICAL_FIELDS))
+        assert [len(chunk.index) for chunk in chunks] == [2, 1]
+        assert sorted(chunks[0].columns) == ['BIRTH_DATE', 'MRN', 'SAMPLE_ID'], chunks[0].columns
+        assert chunks[0]['MRN'].tolist() == ['1', '2']
+        assert 'UNUSED' in list(read_parquet_chunks(path))[0]
+
+        # integer identifiers with nulls are formatted like the CSV reader's strings, not as floats
+        ids = pa.Table.from_arrays([pa.array([1, None, 123], type=pa.int64()), pa.array(['S1', 'S2', 'S3'])],
+                                   names=['MRN', 'SAMPLE_ID'])
+        pq.write_table(ids, os.path.join(self.tmpdir, 'ids.parquet'))
+        chunk = list(read_parquet_chunks(os.path.join(self.tmpdir, 'ids.parquet')))[0]
+        assert chunk['MRN'].tolist() == ['1', None, '123'], chunk['MRN'].tolist()
+
+        path = os.path.join(self.tmpdir, 'clinical.arrow')
+        sink = pa.OSFile(path, 'wb')
+        writer = pa.RecordBatchFileWriter(sink, clinical.schema)
+        for batch in clinical.to_batches(max_chunksize=2):
+            writer.write_batch(batch)
+        writer.close()
+        sink.close()
+
+        assert load_clinical(self.db, read_arrow_chunks(path, columns=CLINICAL_FIELDS)) == 3
+        c = self.db.clinical.find_one({'SAMPLE_ID': 'S1'})
+        assert c['MRN'] == '1' and c['BIRTH_DATE'] == dt.datetime(1950, 1, 2) and 'UNUSED' not in c, c
+        assert self.db.clinical.find_one({'SAMPLE_ID': 'S3'})['BIRTH_DATE'] is None
+
+        genomic = pd.DataFrame({'SAMPLE_ID': ['S1', 'S2'], 'TRUE_HUGO_SYMBOL': ['EGFR', 'BRAF'],
+                                'TRUE_TRANSCRIPT_EXON': [13, None], 'UNUSED': [1, 2]})
+        path = os.path.join(self.tmpdir, 'genomic.parquet')
+        pq.write_table(pa.Table.from_pandas(genomic, preserve_index=False), path)
+        assert load_genomic(self.db, read_parquet_chunks(path, columns=GENOMIC_FIELDS)) == 2
+        g = self.db.genomic.find_one({'SAMPLE_ID': 'S1'})
+        assert g['TRUE_TRANSCRIPT_EXON'] == 13 and g['CLINICAL_ID'] == c['_id'] and 'UNUSED' not in g, g
+
+    def test_match_columns(self):
+
+        self.db.trial.insert_one({'protocol_no': 'columns', 'treatment_list': {'step': [{
+            'match': [{'and': [{'clinical': {'er_status': 'Positive'}}, {'genomic': {'exon': 19}}]}],
+            'arm': []
+        }]}})
+        try:
+            columns = match_columns(self.db, CLINICAL_FIELDS)
+        finally:
+            self.db.trial.delete_one({'protocol_no': 'columns'})
+
+        assert columns[:len(CLINICAL_FIELDS)] == CLINICAL_FIELDS
+        assert 'ER_STATUS' in columns and 'TRUE_TRANSCRIPT_EXON' in columns and 'EXON' not in columns, columns
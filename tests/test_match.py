@@ -3,6 +3,8 @@
 import os
 import json
 
+from matchengine.engine import MatchEngine, _init_match_worker, _worker
+from matchengine.utilities import iter_match_segments
 from tests import TestSetUp
 
 YAML_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data/yaml/'))
@@ -93,6 +95,82 @@ class TestMatch(TestSetUp):
         # checks that the entire process executes successfully
         self.me.find_trial_matches()
 
+    def test_short_circuit(self):
+
+        self.me = MatchEngine(self.db)
+        match = {
+            'and': [
+                {'genomic': {'hugo_symbol': 'EGFR'}},
+                {'or': [
+                    {'genomic': {'hugo_symbol': 'BRAF'}},
+                    {'genomic': {'hugo_symbol': '!BRAF'}}
+                ]},
+                {'clinical': {'oncotree_primary_diagnosis': 'Acute Myeloid Leukemia'}}
+            ]
+        }
+
+        # no patient has the diagnosis so the genomic leaves are never queried
+        results = self._match(match)
+        assert len(results) == 0
+        assert self.me.cache_misses == 1, self.me.cache_misses
+
+        # skipped genomic leaves still contribute the genomic information of matched samples
+        match['and'][2] = {'or': [
+            {'clinical': {'age_numerical': '>=0'}},
+            {'genomic': {'hugo_symbol': 'EGFR', 'protein_change': 'p.L858R'}}
+        ]}
+        results, ginfos = self.me.traverse_match_tree(self.me.create_match_tree(match))
+        assert sorted(results) == sorted(self._find('genomic', {'TRUE_HUGO_SYMBOL': 'EGFR'}))
+        assert self.me.cache_misses == 6, self.me.cache_misses
+        alterations = [m.get('true_protein_change') for s in ginfos for m in s]
+        assert alterations.count('p.L858R') == 2, alterations
+
+    def test_plan_queries(self):
+
+        self.add_trials(trials=['00-004', '00-005'])
+        trials = list(self.db.trial.find())
+
+        planned = MatchEngine(self.db)
+        planned.plan_queries(trials)
+        misses = planned.cache_misses
+        assert misses > 0
+
+        for trial in trials:
+            for segment in iter_match_segments(trial):
+                expected, expected_ginfos = self.me.traverse_match_tree(
+                    self.me.create_match_tree(segment['match'][0]))
+                results, ginfos = planned.traverse_match_tree(planned.create_match_tree(segment['match'][0]))
+
+                assert sorted(expected) == sorted(results), '%s\n%s' % (expected, results)
+                assert sorted(m['genomic_alteration'] for s in expected_ginfos for m in s) == \
+                    sorted(m['genomic_alteration'] for s in ginfos for m in s)
+
+        # every leaf was answered from the results of the planning phase
+        assert planned.cache_misses == misses, planned.cache_misses
+
+    def test_parallel_match(self):
+
+        self.add_trials(trials=['00-004', '00-005'])
+
+        def matches():
+            return sorted(json.dumps(match, sort_keys=True) for match in self.db.trial_match.find({}, {'_id': 0}))
+
+        # matching in worker processes gives the same matches as a serial run
+        self.me.find_trial_matches()
+        serial = matches()
+        self.me.find_trial_matches(workers=2)
+        parallel = matches()
+        assert len(serial) > 0
+        assert serial == parallel
+
+        # in-memory workers share the genomic store of the parent instead of loading their own
+        me = MatchEngine(self.db, in_memory=True)
+        store = me.genomic_store
+        _init_match_worker(None, store, me.field_map, me.today, {}, True)
+        assert _worker['me'].in_memory and _worker['me'].genomic_store is store
+        me.find_trial_matches(workers=2)
+        assert matches() == serial
+
     def test_assess_match(self):
 
         p = self.mrns[1]
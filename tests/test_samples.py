@@ -0,0 +1,31 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+from matchengine.samples import SampleIndex
+from tests import TestSetUp
+
+
+class TestSamples(TestSetUp):
+
+    def setUp(self):
+        super(TestSamples, self).setUp()
+
+    def tearDown(self):
+        pass
+
+    def test_sample_index(self):
+
+        samples = SampleIndex(['S1', 'S2', 'S3'])
+        a = samples.mask(['S1', 'S2'])
+        assert samples.to_set(a) == set(['S1', 'S2'])
+
+        # negation is taken against the clinical samples only
+        b = samples.mask(['S2', 'S4'])
+        assert len(samples) == 4
+        assert samples.to_set(samples.complement(b)) == set(['S1', 'S3'])
+
+        # masks created before new samples were added are padded
+        a = samples.resize(a)
+        assert len(a) == 4
+        assert samples.to_set(a & b) == set(['S2'])
+        assert samples.to_set(a | b) == set(['S1', 'S2', 'S4'])
+        assert samples.contains(b, 'S4') and not samples.contains(a, 'S5')
@@ -1,6 +1,10 @@
 """Copyright 2016 Dana-Farber Cancer Institute"""
 
+import random
+import itertools
+
 from matchengine.sort import *
+from matchengine.writer import MatchWriter
 from tests import TestSetUp
 
 
@@ -215,3 +219,76 @@ class TestSort(TestSetUp):
                 '0002-000',  # tm12 (wildtype)
                 '0004-000',  # tm14 (clinical only)
             ]
+
+    def test_add_sort_order_collection(self):
+
+        writer = MatchWriter(self.db, batch_size=5)
+        writer.write(self.get_demo_trial_matches())
+        assert writer.close() == 14
+        assert not [name for name in self.db.collection_names() if name.startswith('trial_match_staging')]
+
+        # runs stage into their own collections
+        assert MatchWriter(self.db).staging.name != writer.staging.name
+
+        # identical matches written in separate calls get distinct match keys
+        writer = MatchWriter(self.db, collection='trial_match_keys')
+        demo = self.get_demo_trial_matches()[0]
+        writer.write([demo])
+        writer.write([demo])
+        writer.close()
+        assert len(self.db.trial_match_keys.distinct('match_key')) == 2
+        self.db.trial_match_keys.drop()
+
+        # same order as the data frame sort
+        matches = self.db.trial_match.find().sort('sort_order', 1)
+        assert [match['protocol_no'] for match in matches] == \
+            ['0003-000', '0001-000', '111-000', '000-000', '999-000', '888-000', '777-000', '444-000', '333-000',
+             '555-000', '666-000', '222-000', '0002-000', '0004-000']
+
+        # fields missing from some matches are set on all of them
+        assert self.db.trial_match.count({'clinical_only': None}) == 13
+
+    def test_sort_order_collection_equals_per_match_sort(self):
+
+        # demo matches of several samples plus random matches with ties in every sort category
+        rnd = random.Random(13)
+        matches = []
+        for i, sample_id in enumerate(['S1', 'S2', 'S3']):
+            for match in self.get_demo_trial_matches():
+                match['sample_id'] = sample_id
+                match['protocol_no'] = '%s-%03d' % (match['protocol_no'].split('-')[0], i)
+                matches.append(match)
+
+        for _ in range(600):
+            matches.append({
+                'sample_id': 'R%d' % rnd.randint(0, 7),
+                'protocol_no': '%d-%03d' % (rnd.choice([1, 2, 10, 11, 100]), rnd.randint(0, 3)),
+                'vital_status': rnd.choice(['alive', 'alive', 'alive', 'deceased']),
+                'trial_accrual_status': rnd.choice(['open', 'open', 'open', 'closed']),
+                'mmr_status': rnd.choice([None, None, None, None, 'Deficient (MMR-D / MSI-H)']),
+                'tier': rnd.choice([None, 1, 2, 3, 4]),
+                'variant_category': rnd.choice(['MUTATION', 'CNV', 'SV']),
+                'wildtype': rnd.choice([True, False, None]),
+                'match_type': rnd.choice(['variant', 'gene', None]),
+                'cancer_type_match': rnd.choice(['specific', 'all_solid', 'all_liquid', None]),
+                'coordinating_center': rnd.choice(['Dana-Farber Cancer Institute', 'Massachusetts General Hospital']),
+                'genomic_alteration': rnd.choice(['BRAF V600E', 'EGFR', 'Structural Variation'])
+            })
+
+        for match in matches:
+            match['sort_order'] = -1
+        self.db.sort_test.insert_many(matches)
+
+        # the per-match sort of every sample, as matches were sorted before they were ranked as frames
+        expected = {}
+        docs = sorted(self.db.sort_test.find({'vital_status': 'alive', 'trial_accrual_status': 'open'}),
+                      key=lambda x: (x['sample_id'], x['protocol_no']))
+        for _, sample in itertools.groupby(docs, key=lambda x: x['sample_id']):
+            sample = [match for match in sample if not is_structural_variation(match)]
+            if sample:
+                final_sort(sort_sample(sample), expected)
+
+        assert add_sort_order_collection(self.db.sort_test, batch_size=7, frame_size=50) == len(expected)
+        for doc in self.db.sort_test.find():
+            assert doc['sort_order'] == expected.get((doc['sample_id'], doc['protocol_no']), -1), doc
+        self.db.sort_test.drop()
@@ -1,9 +1,14 @@
 """Copyright 2016 Dana-Farber Cancer Institute"""
 
 import copy
+import shutil
+import tempfile
+import networkx as nx
 
 from matchengine.utilities import *
 from matchengine.settings import months
+from matchengine import utilities
+from matchengine.validation import ConsentValidatorCerberus
 from matchengine.engine import MatchEngine as me
 from tests import TestSetUp
 
@@ -27,6 +32,7 @@ class TestUtilities(TestSetUp):
     def tearDown(self):
         self.db.clinical.drop()
         self.db.trial.drop()
+        self.db[TRIAL_CACHE].drop()
 
     def test_get_sampleids_from_mrns(self):
         mrn_map = samples_from_mrns(self.db, [self.mrn])
@@ -107,10 +113,43 @@ class TestUtilities(TestSetUp):
         assert normalize_values(self.mapping, 'wildtype', 'true') == ('WILDTYPE', True)
         assert normalize_values(self.mapping, 'wildtype', 'false') == ('WILDTYPE', False)
 
+    def test_field_map(self):
+        field_map = FieldMap(self.mapping)
+        assert field_map.field('hugo_symbol')[0] == 'TRUE_HUGO_SYMBOL'
+        assert field_map.value('variant_category', '!Mutation') == ('VARIANT_CATEGORY', '!MUTATION')
+        assert field_map.value('cnv_call', 'High Amplification') == ('CNV_CALL', 'High level amplification')
+
+        # same translation as the mapping scans
+        for item in self.mapping:
+            field = item['key_old']
+            assert field_map.field(field) == normalize_fields(self.mapping, field)
+            for val in item['values'].keys() + ['unmapped']:
+                for v in [val, '!%s' % val]:
+                    assert field_map.value(field, v) == normalize_values(self.mapping, field, v)
+
     def test_build_oncotree(self):
         onco_tree = build_oncotree()
         assert onco_tree.nodes()
 
+    def test_oncotree_index(self):
+        onco_tree = build_oncotree()
+        assert build_oncotree() is onco_tree
+
+        index = oncotree_index(onco_tree)
+        assert oncotree_index(onco_tree) is index
+
+        # subtrees match a depth-first search of the tree
+        for txt in ['Melanoma', 'Glioblastoma', 'Lung', 'Blood', 'root']:
+            node = [n for n in onco_tree.nodes() if onco_tree.node[n]['text'] == txt][0]
+            expected = [onco_tree.node[n]['text'] for n in nx.dfs_tree(onco_tree, node)]
+            assert sorted(index.descendants(txt)) == sorted(expected), txt
+        assert index.descendants('Not A Diagnosis') is None
+
+        # solid and liquid tumors partition the tree
+        assert 'Acute Myeloid Leukemia' in index.liquid
+        assert 'Melanoma' in index.solid
+        assert len(index.solid) + len(index.liquid) == len(onco_tree.nodes())
+
     def test_build_gquery(self):
         # wildcard protein change
         key, txt, neg, _ = build_gquery('wildcard_protein_change', 'p.F346')
@@ -380,3 +419,89 @@ class TestUtilities(TestSetUp):
             assert int(self.today.strftime('%Y')) == int(bd.strftime('%Y')) + age
         except AssertionError:
             assert int(self.today.strftime('%Y')) == int(bd.strftime('%Y')) + age + 1
+
+    def test_load_trials(self):
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for yml in os.listdir(YAML_DIR):
+                shutil.copy(os.path.join(YAML_DIR, yml), tmpdir)
+            self.db.trial.drop()
+            self.db[TRIAL_CACHE].drop()
+
+            # 00-000.yml is not valid YAML and is skipped
+            assert add_trials(tmpdir, self.db, workers=2) == 6
+            assert self.db.trial.count() == 6
+            assert self.db[TRIAL_CACHE].count() == 6
+
+            # unchanged files are skipped
+            assert add_trials(tmpdir, self.db) == 0
+
+            # a changed file replaces its trial
+            path = os.path.join(tmpdir, '00-004.yml')
+            with open(path, 'a') as f:
+                f.write('short_title: changed\n')
+            assert add_trials(tmpdir, self.db) == 1
+            assert self.db.trial.count() == 6
+            assert self.db.trial.find_one({'protocol_no': '00-004'})['short_title'] == 'changed'
+
+            # trials removed from the database are loaded again, files that cannot be parsed are retried
+            self.db.trial.delete_one({'protocol_no': '00-002'})
+            assert load_trials(self.db, [os.path.join(tmpdir, yml) for yml in os.listdir(tmpdir)]) == 1
+            assert self.db.trial.count() == 6
+
+            # trials without a protocol number are cached by file and replaced when their file changes
+            path = os.path.join(tmpdir, 'no-protocol.yml')
+            with open(path, 'w') as f:
+                f.write('short_title: no protocol\n')
+            assert add_trials(tmpdir, self.db) == 1
+            assert add_trials(tmpdir, self.db) == 0
+            with open(path, 'a') as f:
+                f.write('long_title: changed\n')
+            assert add_trials(tmpdir, self.db) == 1
+            assert self.db.trial.count() == 7
+            assert self.db.trial.find_one({'short_title': 'no protocol'})['long_title'] == 'changed'
+
+            # empty files and documents that are not mappings are skipped like files that cannot be parsed
+            for name, text in [('empty.yml', ''), ('scalar.yml', 'trial\n'), ('list.yml', '- a\n- b\n')]:
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write(text)
+            assert add_trials(tmpdir, self.db, workers=2) == 0
+            assert self.db.trial.count() == 7
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_get_client(self):
+
+        os.environ['MONGO_MAX_POOL_SIZE'] = '7'
+        try:
+            assert client_options()['maxPoolSize'] == 7
+            assert client_options(maxPoolSize=3)['maxPoolSize'] == 3
+        finally:
+            del os.environ['MONGO_MAX_POOL_SIZE']
+        assert client_options()['readPreference'] == 'primary'
+
+        # databases, engines and validators borrow the client of their URI
+        get_db(None)
+        clients = len(utilities._clients)
+        for _ in range(5):
+            get_db(None)
+            ConsentValidatorCerberus({})
+        assert len(utilities._clients) == clients
+        assert get_client(os.environ['MONGO_URI']) is get_client(os.environ['MONGO_URI'])
+
+        get_client(os.environ['MONGO_URI'], maxPoolSize=3)
+        assert len(utilities._clients) == clients + 1
+
+        # closed clients are dropped, the clients of the other tests are put back afterwards
+        shared = dict(utilities._clients)
+        utilities._clients.clear()
+        try:
+            get_client(os.environ['MONGO_URI'])
+            close_clients()
+            assert not utilities._clients
+            get_client(os.environ['MONGO_URI'])
+            assert len(utilities._clients) == 1
+            close_clients()
+        finally:
+            utilities._clients.update(shared)
@@ -0,0 +1,61 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+from matchengine.writer import MatchWriter
+from tests import TestSetUp
+
+
+class TestWriter(TestSetUp):
+
+    def setUp(self):
+        super(TestWriter, self).setUp()
+        self.db.trial_match.drop()
+
+    def tearDown(self):
+        self.db.trial_match.drop()
+
+    def write(self, matches, mode):
+        writer = MatchWriter(self.db, mode=mode)
+        writer.write(matches)
+        writer.close()
+        return writer
+
+    def test_swap(self):
+
+        self.db.trial_match.insert_one({'protocol_no': 'stale'})
+        writer = self.write(self.get_demo_trial_matches(), 'swap')
+        assert (writer.inserted, writer.updated, writer.deleted) == (14, 0, 0)
+        assert self.db.trial_match.count() == 14
+        assert not self.db.trial_match.find_one({'protocol_no': 'stale'})
+
+        # nothing matched, the previous matches are kept
+        writer = self.write([], 'swap')
+        assert writer.inserted == 0
+        assert self.db.trial_match.count() == 14
+
+    def test_incremental(self):
+
+        matches = self.get_demo_trial_matches()
+        self.write(matches, 'incremental')
+        ids = set(doc['_id'] for doc in self.db.trial_match.find())
+
+        # an unchanged run writes nothing
+        writer = self.write(self.get_demo_trial_matches(), 'incremental')
+        assert (writer.inserted, writer.updated, writer.deleted) == (0, 0, 0)
+        assert set(doc['_id'] for doc in self.db.trial_match.find()) == ids
+
+        # a new match, a changed match and a match that is gone
+        matches = self.get_demo_trial_matches()
+        matches[0]['tier'] = 2
+        matches[-1]['protocol_no'] = '0005-000'
+        del matches[5]
+        writer = self.write(matches, 'incremental')
+        assert (writer.inserted, writer.deleted) == (2, 3), (writer.inserted, writer.deleted)
+        assert writer.updated > 0
+        assert self.db.trial_match.count() == 13
+        assert self.db.trial_match.count({'tier': 2, 'protocol_no': '111-000'}) == 1
+        assert not self.db.trial_match.find_one({'protocol_no': '0004-000'})
+
+        # sort orders equal those of a full rewrite
+        incremental = dict((doc['match_key'], doc['sort_order']) for doc in self.db.trial_match.find())
+        self.write(matches, 'swap')
+        assert incremental == dict((doc['match_key'], doc['sort_order']) for doc in self.db.trial_match.find())